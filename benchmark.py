@@ -0,0 +1,367 @@
+import json
+import asyncio
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from aiohttp import web
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory isn't reported there
+    resource = None
+
+# ------------------------
+# Benchmark Configuration
+# ------------------------
+
+# modes of main.py to benchmark, "review" and/or "update"
+modes = ["review", "update"]
+# number of portfolios in the mock collection, one benchmark run per size
+collection_sizes = [1000, 10000]
+# share of the mock portfolios with a blank public access model (the ones update mode changes)
+blank_pam_fraction = 0.3
+# response time of the mock API in seconds:
+# ("constant", seconds), ("uniform", low, high) or ("lognormal", median, sigma)
+latency = ("lognormal", 0.25, 0.5)
+# share of requests that fail with a 429 or a 5xx error before reaching the rate limit check
+error_429_rate = 0.0
+error_5xx_rate = 0.0
+# requests per second the mock API accepts before answering 429, like Alma's per second threshold
+mock_rate_limit = 25
+# the institution's daily threshold, the mock reports what is left of it in the
+# X-Exl-Api-Remaining header and answers 429 with DAILY_THRESHOLD once it is used up,
+# like Alma does
+mock_daily_threshold = 1000000
+# requests per second main.py's RateLimiter sends at, raise both this and mock_rate_limit
+# to benchmark large collections in reasonable time
+client_rate = 25
+# results of every run are written here as well as printed
+results_file = "benchmark_results.json"
+
+# ---------------------------
+# End of Configuration
+# ---------------------------
+
+COLLECTION_ID = "61000000000000000"
+SERVICE_ID = "62000000000000000"
+
+
+def mock_portfolio(number, blank_pam):
+    # shaped like an Alma portfolio so response sizes are realistic
+    portfolio_id = f"53{number:015d}"
+    return {
+        "id": portfolio_id,
+        "is_local": True,
+        "is_standalone": False,
+        "resource_metadata": {
+            "mms_id": {"value": f"99{number:014d}"},
+            "title": f"Mock title number {number}",
+            "author": "Mock, Author",
+            "issn": None,
+            "isbn": f"978{number:010d}",
+            "publisher": "Mock Publisher",
+        },
+        "electronic_collection": {
+            "id": {"value": COLLECTION_ID},
+            "service": {"value": SERVICE_ID},
+        },
+        "availability": {"value": "11", "desc": "Available"},
+        "material_type": {"value": "BOOK", "desc": "Book"},
+        "activation_date": "2020-01-01Z",
+        "linking_details": {
+            "url": f"https://example.org/resource/{number}",
+            "url_type": {"value": "static", "desc": "Static URL"},
+            "static_url": f"jkey=https://example.org/resource/{number}",
+        },
+        "public_access_model": (
+            {"value": "", "desc": ""}
+            if blank_pam
+            else {"value": "UA", "desc": "Unlimited access"}
+        ),
+        "notes": {"public_note": "", "internal_description": "x" * 512},
+    }
+
+
+def threshold_error(error_code, error_message):
+    # Alma's 429 body
+    return web.json_response(
+        {
+            "errorsExist": True,
+            "errorList": {
+                "error": [{"errorCode": error_code, "errorMessage": error_message}]
+            },
+        },
+        status=429,
+    )
+
+
+class MockAlma:
+    # aiohttp server for the e-collection, portfolio list and portfolio GET/PUT endpoints
+    # main.py uses, with configurable latency, error injection and per second and daily
+    # thresholds
+    def __init__(self, size):
+        self.portfolios = {}
+        for number in range(size):
+            portfolio = mock_portfolio(number, random.random() < blank_pam_fraction)
+            self.portfolios[portfolio["id"]] = portfolio
+        self.portfolio_ids = list(self.portfolios)
+        self.requests = 0
+        self.rejected = 0
+        self.over_daily_threshold = 0
+        self.window = 0
+        self.window_requests = 0
+
+        self.app = web.Application()
+        base = "/e-collections/{collection_id}"
+        portfolios = base + "/e-services/{service_id}/portfolios"
+        self.app.router.add_get(base, self.get_collection)
+        self.app.router.add_get(portfolios, self.get_portfolio_list)
+        self.app.router.add_get(portfolios + "/{portfolio_id}", self.get_portfolio)
+        self.app.router.add_put(portfolios + "/{portfolio_id}", self.put_portfolio)
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def respond(self, build_response):
+        response = await self.build_response(build_response)
+        response.headers["X-Exl-Api-Remaining"] = str(
+            max(mock_daily_threshold - self.requests, 0)
+        )
+        return response
+
+    async def build_response(self, build_response):
+        # every request counts against the institution, whatever the answer
+        self.requests += 1
+        if self.requests > mock_daily_threshold:
+            self.over_daily_threshold += 1
+            return threshold_error(
+                "DAILY_THRESHOLD", "Daily API Request Threshold has been reached"
+            )
+
+        window = int(time.monotonic())
+        if window != self.window:
+            self.window = window
+            self.window_requests = 0
+        self.window_requests += 1
+        if self.window_requests > mock_rate_limit:
+            self.rejected += 1
+            return threshold_error(
+                "PER_SECOND_THRESHOLD", "HTTP requests are more than allowed per second"
+            )
+
+        await asyncio.sleep(self.latency())
+        roll = random.random()
+        if roll < error_429_rate:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        if roll < error_429_rate + error_5xx_rate:
+            return web.Response(status=random.choice([500, 502, 503, 504]))
+        return await build_response()
+
+    def latency(self):
+        if latency[0] == "constant":
+            return latency[1]
+        if latency[0] == "uniform":
+            return random.uniform(latency[1], latency[2])
+        return random.lognormvariate(math.log(latency[1]), latency[2])
+
+    async def get_collection(self, request):
+        async def build_response():
+            return web.json_response(
+                {
+                    "id": request.match_info["collection_id"],
+                    "portfolios": {"value": len(self.portfolio_ids)},
+                }
+            )
+
+        return await self.respond(build_response)
+
+    async def get_portfolio_list(self, request):
+        async def build_response():
+            offset = int(request.query.get("offset", 0))
+            limit = int(request.query.get("limit", 10))
+            page = self.portfolio_ids[offset : offset + limit]
+            return web.json_response(
+                {
+                    "portfolio": [
+                        {"id": portfolio_id, "link": ""} for portfolio_id in page
+                    ],
+                    "total_record_count": len(self.portfolio_ids),
+                }
+            )
+
+        return await self.respond(build_response)
+
+    async def get_portfolio(self, request):
+        async def build_response():
+            portfolio = self.portfolios.get(request.match_info["portfolio_id"])
+            if portfolio is None:
+                return web.Response(status=400)
+            return web.json_response(portfolio)
+
+        return await self.respond(build_response)
+
+    async def put_portfolio(self, request):
+        async def build_response():
+            portfolio = json.loads(await request.read())
+            self.portfolios[request.match_info["portfolio_id"]] = portfolio
+            return web.json_response(portfolio)
+
+        return await self.respond(build_response)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def run_case_in_this_process(case, result_path):
+    # runs main.py against the mock server, the parent process keeps the server
+    # running and reads the results from result_path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    os.chdir(case["workdir"])
+    main.BASEURL = case["baseurl"]
+    main.APIKEY = "benchmark"
+    main.MAX_API_CALLS_PER_DAY = 10**9
+    main.mode = case["mode"]
+    main.collectionid = COLLECTION_ID
+    main.serviceid = SERVICE_ID
+    main.RateLimiter.RATE = case["client_rate"]
+    main.RateLimiter.MAX_TOKENS = case["client_rate"]
+
+    latencies = []
+    record_response = main.api_metrics.record_response
+
+    def record_latency(method, url, status, response_latency, bytes_sent):
+        latencies.append(response_latency)
+        record_response(method, url, status, response_latency, bytes_sent)
+
+    main.api_metrics.record_response = record_latency
+
+    # the per request progress lines aren't part of the benchmark
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        started = time.monotonic()
+        try:
+            asyncio.run(main.main())
+        finally:
+            elapsed = time.monotonic() - started
+            sys.stdout = stdout
+
+    peak_rss_kb = None
+    if resource is not None:
+        peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak_rss_kb //= 1024
+
+    with open(result_path, "w") as result_file:
+        json.dump(
+            {
+                "elapsed_seconds": elapsed,
+                "responses": len(latencies),
+                "p50_latency_seconds": percentile(latencies, 0.5),
+                "p99_latency_seconds": percentile(latencies, 0.99),
+                "peak_rss_kb": peak_rss_kb,
+                "api_calls_booked": main.global_cache.total_api_calls_past_24_hrs,
+                "errors": len(
+                    [
+                        e
+                        for e in main.collection_runs[0].errors
+                        if e != "No errors this time"
+                    ]
+                ),
+            },
+            result_file,
+        )
+
+
+async def run_case(mode, size):
+    server = MockAlma(size)
+    baseurl = await server.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        case = {
+            "mode": mode,
+            "baseurl": baseurl,
+            "workdir": workdir,
+            "client_rate": client_rate,
+        }
+        result_path = os.path.join(workdir, "benchmark_case.json")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            os.path.abspath(__file__),
+            "--case",
+            json.dumps(case),
+            result_path,
+        )
+        await process.wait()
+        await server.stop()
+        if process.returncode != 0:
+            print(f"{mode} with {size} portfolios failed")
+            return None
+        with open(result_path) as result_file:
+            result = json.load(result_file)
+
+    result["mode"] = mode
+    result["collection_size"] = size
+    result["api_calls_used"] = server.requests
+    result["rate_limited_by_mock"] = server.rejected
+    result["over_daily_threshold"] = server.over_daily_threshold
+    result["requests_per_second"] = server.requests / result["elapsed_seconds"]
+    return result
+
+
+def print_result(result):
+    peak_rss = (
+        "n/a"
+        if result["peak_rss_kb"] is None
+        else f"{result['peak_rss_kb'] / 1024:.0f} MB"
+    )
+    print(
+        f"{result['mode']:<7} {result['collection_size']:>7} portfolios | "
+        f"{result['elapsed_seconds']:8.1f} secs | "
+        f"{result['requests_per_second']:6.1f} req/s | "
+        f"p50 {result['p50_latency_seconds'] * 1000:6.0f} ms | "
+        f"p99 {result['p99_latency_seconds'] * 1000:6.0f} ms | "
+        f"peak RSS {peak_rss} | "
+        f"{result['api_calls_used']} API calls "
+        f"({result['rate_limited_by_mock']} over the per second threshold, "
+        f"{result['over_daily_threshold']} over the daily threshold)"
+    )
+
+
+async def run_benchmarks():
+    results = []
+    for size in collection_sizes:
+        for mode in modes:
+            result = await run_case(mode, size)
+            if result is not None:
+                print_result(result)
+                results.append(result)
+
+    with open(results_file, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Results saved to {results_file}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--case":
+        run_case_in_this_process(json.loads(sys.argv[2]), sys.argv[3])
+    else:
+        asyncio.run(run_benchmarks())
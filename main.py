@@ -5,7 +5,34 @@ import math
 import time
 import datetime
 import codecs
-from wakepy import keepawake
+import os
+import sys
+import sqlite3
+import random
+import email.utils
+import csv
+import bisect
+import urllib.parse
+import contextlib
+import cProfile
+import pstats
+import zlib
+import contextvars
+import glob
+import multiprocessing
+import concurrent.futures
+from collections import deque
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 # --------------------
 # Constants
@@ -17,13 +44,43 @@ BASEURL = "https://api-na.hosted.exlibrisgroup.com/almaws/v1/electronic"
 HEADERS = {"accept": "application/json", "Content-Type": "application/json"}
 START = time.monotonic()
 MAX_API_CALLS_PER_DAY = 10000  # check your institution limit and account for other systems that might also use API calls.
+CACHE_DB = "cache.db"
+# migrated into CACHE_DB the first time the tool runs
+LEGACY_CACHE_FILE = "cache.json"
+# API results not yet saved to CACHE_DB, replayed on the next start.
+# shard workers write theirs to CACHE_JOURNAL + ".shard-<n>"
+CACHE_JOURNAL = "cache.journal"
+# shared by the shard worker processes for the rate limit, the API budget and their progress
+SHARD_STORE = "shards.db"
+# requests that can be queued at once, the adaptive concurrency limit decides how many are sent
+WORKER_COUNT = 60
+# prometheus textfile rewritten after every review/update run, point it at the
+# node exporter's textfile collector directory to have the run metrics scraped
+METRICS_TEXTFILE = "alma_pam_tool.prom"
+# secs between redraws of the progress line, and between progress lines when the
+# output is redirected to a file
+PROGRESS_INTERVAL = 0.25
+PROGRESS_LOG_INTERVAL = 10
+# Alma reports how many API calls the whole institution has left today in this response header.
+# when it's present the tool also stops INSTITUTION_API_RESERVE calls short of it, raise it
+# to leave those for the other systems that share the threshold, and slows down once fewer
+# than SLOWDOWN_HEADROOM calls are left above the reserve
+API_REMAINING_HEADER = "X-Exl-Api-Remaining"
+# error code of the 429 Alma answers once the institution's daily threshold is used up,
+# unlike its per second threshold this one isn't worth retrying until the reset
+DAILY_THRESHOLD_ERROR = "DAILY_THRESHOLD"
+INSTITUTION_API_RESERVE = 0
+SLOWDOWN_HEADROOM = 2500
+# secs after midnight UTC that a run waiting for the daily API reset carries on,
+# allowing for the clocks being a little apart
+API_RESET_MARGIN = 300
 
 # ---------------------
 # Per Run Configuration
 # ---------------------
 
 # Mode
-# accepted values are 'review', 'update', "clear_cache_all", and "clear_cache_collection", "clear_cache_portfolios"
+# accepted values are 'review', 'update', 'retry_failed', 'batch', "clear_cache_all", and "clear_cache_collection", "clear_cache_portfolios"
 mode = "review"
 # Collection ID and Service ID
 collectionid = ""
@@ -34,72 +91,431 @@ public_access_model_code = "UA"
 public_access_model_description = (
     "- Please note that the platform supports unlimited access"
 )
+# Pipelined update
+# in update mode, send each portfolio's update as soon as it has been retrieved
+# instead of waiting for the whole collection to be retrieved first
+pipelined_update = False
+# Review exports
+# machine readable copies of the review report, accepted values are "jsonl", "csv" and "parquet"
+# (parquet needs the pyarrow module to be installed)
+review_export_formats = ["jsonl", "csv"]
+# Profiling
+# profile each phase of the run and save the CPU profiles and a summary next to the logs
+profile_run = False
+# Quiet
+# only print a summary line when each set of requests finishes instead of the live progress,
+# useful when the tool runs from cron
+quiet = False
+# Batch
+# in the batch mode every collection in batch_manifest is worked on at the same time, sharing
+# the API rate limit and budget. the manifest is a CSV file with the columns collection_id,
+# service_id, public_access_model_code and public_access_model_description (the last two can be
+# left empty to use the values above). batch_run_mode is "review" or "update"
+batch_manifest = "batch_manifest.csv"
+batch_run_mode = "update"
+# Wait for the API reset
+# when the daily API limit stops a review, update, retry_failed or batch run, save the progress,
+# wait for the threshold to reset at midnight UTC and carry on, until the run is finished
+wait_for_api_reset = False
+# Shards
+# split the portfolio retrievals and updates of a review or update run between this many
+# worker processes, which share the rate limit and the API budget through SHARD_STORE.
+# 1 makes every request from this process. batch runs and the pipelined update don't use shards
+shard_count = 1
 
 # ---------------------
 # End of Configuration
 # ---------------------
 
-errors = []
-update_log_data = {
-    "updated_portfolios": [],
-    "update_failed_portfolios": [],
-    "unchanged_portfolios": [],
-    "total_in_collection": 0,
-    "api_limit_reached": False,
-}
 
-review_log_data = {
-    "reviewed_portfolios": [],
-    "pam_types": set(),
-    "total_in_collection": 0,
-    "api_limit_reached": False,
-}
+class JsonSerializer:
+    # standard library json, used when orjson isn't installed
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode("utf-8")
+
+
+class OrjsonSerializer:
+    name = "orjson"
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+
+# every API response and everything written to the cache goes through the serializer.
+# loads takes bytes (or str) and dumps returns UTF-8 bytes, so responses are parsed
+# straight from the body without decoding them to text first
+serializer = OrjsonSerializer() if orjson is not None else JsonSerializer()
+
+
+class CollectionRun:
+    # the settings, log data and errors of the run for one collection.
+    # the batch mode works on several collections at once, each in its own asyncio task
+    # with its own current run, see collection_run
+    def __init__(
+        self,
+        mode,
+        collection_id,
+        service_id,
+        public_access_model_code,
+        public_access_model_description,
+        batch=False,
+    ):
+        self.mode = mode
+        self.collection_id = collection_id
+        self.service_id = service_id
+        self.public_access_model_code = public_access_model_code
+        self.public_access_model_description = public_access_model_description
+        self.batch = batch
+        self.errors = []
+        self.update_log_data = {
+            "updated_portfolios": [],
+            "update_failed_portfolios": [],
+            "unchanged_portfolios": [],
+            "total_in_collection": 0,
+            "api_limit_reached": False,
+        }
+        self.review_log_data = {
+            "reviewed_portfolios": [],
+            "pam_types": set(),
+            "total_in_collection": 0,
+            "api_limit_reached": False,
+        }
+        # secs after START when the portfolios had been retrieved and updated
+        self.portfolios_time = None
+        self.update_time = None
+
+    def file_name(self, kind, timestamp):
+        # a batch writes a set of reports for each collection
+        if self.batch:
+            return f"{self.mode}_{kind}-{self.collection_id}-{timestamp}"
+        return f"{self.mode}_{kind}-{timestamp}"
+
+    def progress_name(self, name):
+        if self.batch:
+            return f"{self.collection_id} {name}"
+        return name
+
+    def restart(self):
+        # the same collection and settings with new log data, for the next day of a run
+        # that waits for the API reset
+        return CollectionRun(
+            self.mode,
+            self.collection_id,
+            self.service_id,
+            self.public_access_model_code,
+            self.public_access_model_description,
+            self.batch,
+        )
+
+
+current_run = contextvars.ContextVar("current_run")
+# every CollectionRun of this run of the tool
+collection_runs = []
+
+
+def collection_run():
+    # the CollectionRun for the collection the current task is working on
+    return current_run.get()
+
+
+def last_utc_midnight():
+    # Ex Libris resets the daily API threshold at midnight UTC
+    utc_now = datetime.datetime.now(datetime.timezone.utc)
+    return datetime.datetime.combine(
+        utc_now, datetime.datetime.min.time(), tzinfo=datetime.timezone.utc
+    )
+
+
+class PortfolioSummary:
+    # the fields of a portfolio that the logs and exports use. kept for every cached
+    # portfolio, so review mode never needs to load the full records
+    __slots__ = (
+        "id",
+        "title",
+        "mms_id",
+        "pam_value",
+        "pam_description",
+        "has_pam_description",
+    )
+
+    def __init__(
+        self, id, title, mms_id, pam_value, pam_description, has_pam_description
+    ):
+        self.id = id
+        self.title = title
+        self.mms_id = mms_id
+        self.pam_value = pam_value
+        self.pam_description = pam_description
+        # the log tells a desc of None apart from a PAM without one
+        self.has_pam_description = bool(has_pam_description)
+
+    @classmethod
+    def from_portfolio(cls, portfolio):
+        resource_metadata = portfolio.get("resource_metadata") or {}
+        mms_id = resource_metadata.get("mms_id") or {}
+        # a missing PAM is reported the same way as a blank one
+        public_access_model = portfolio.get("public_access_model") or {}
+        return cls(
+            portfolio["id"],
+            resource_metadata.get("title", ""),
+            mms_id.get("value", ""),
+            public_access_model.get("value", ""),
+            public_access_model.get("desc"),
+            "desc" in public_access_model,
+        )
+
+    def as_row(self):
+        return (
+            self.title,
+            self.mms_id,
+            self.pam_value,
+            self.pam_description,
+            self.has_pam_description,
+        )
+
+
+class SectionRecords:
+    # the records of a cache section that keeps its own copies:
+    # collection_id -> record id -> record
+    shared = False
+
+    def __init__(self):
+        self.collections = {}
+
+    def put(self, collection_id, record):
+        self.collections.setdefault(collection_id, {})[record["id"]] = record
+
+    def get(self, collection_id, record_id):
+        return self.collections.get(collection_id, {}).get(record_id)
+
+    def get_many(self, collection_id, record_ids):
+        collection = self.collections.get(collection_id, {})
+        return [collection[record_id] for record_id in record_ids]
+
+    def touch(self, collection_id, record_ids):
+        pass
+
+    def discard(self, collection_id, record_id):
+        self.collections.get(collection_id, {}).pop(record_id, None)
+
+    def discard_collection(self, collection_id):
+        self.collections.pop(collection_id, None)
+
+    def clear(self):
+        self.collections = {}
+
+    def mark_saved(self):
+        pass
+
+
+class PortfolioRecords:
+    # one canonical copy of each portfolio, shared by the portfolio sections of the cache,
+    # which only keep the IDs that belong to them. every portfolio has a summary, the full
+    # records are read from the cache database by the loader the first time they're needed.
+    # copies no section refers to any more are dropped by prune
+    shared = True
+
+    def __init__(self, loader=None):
+        self.loader = loader
+        # collection_id -> portfolio id -> PortfolioSummary
+        self.summaries = {}
+        # collection_id -> portfolio id -> full record, for the records loaded so far
+        self.collections = {}
+        self.mark_saved()
+
+    def put(self, collection_id, record):
+        self.collections.setdefault(collection_id, {})[record["id"]] = record
+        self.summaries.setdefault(collection_id, {})[record["id"]] = (
+            PortfolioSummary.from_portfolio(record)
+        )
+        self.upserted.add((collection_id, record["id"]))
+
+    def put_summary(self, collection_id, summary):
+        self.summaries.setdefault(collection_id, {})[summary.id] = summary
+
+    def summary(self, collection_id, record_id):
+        return self.summaries.get(collection_id, {}).get(record_id)
+
+    def get(self, collection_id, record_id):
+        return self.get_many(collection_id, [record_id])[0]
+
+    def get_many(self, collection_id, record_ids):
+        collection = self.collections.setdefault(collection_id, {})
+        summaries = self.summaries.get(collection_id, {})
+        missing = [
+            record_id
+            for record_id in record_ids
+            if record_id not in collection and record_id in summaries
+        ]
+        if missing and self.loader is not None:
+            collection.update(self.loader(collection_id, missing))
+        return [collection.get(record_id) for record_id in record_ids]
+
+    def touch(self, collection_id, record_ids):
+        # the records were changed in place, so their summaries are out of date too
+        collection = self.collections.get(collection_id, {})
+        for record_id in record_ids:
+            if record_id in collection:
+                self.put(collection_id, collection[record_id])
+
+    def discard(self, collection_id, record_id):
+        pass
+
+    def discard_collection(self, collection_id):
+        pass
+
+    def clear(self):
+        pass
+
+    def prune(self, referenced):
+        # referenced is collection_id -> the portfolio ids some section still has
+        for collection_id in list(self.summaries):
+            keep = referenced.get(collection_id, set())
+            for records in (self.summaries, self.collections):
+                collection = records.get(collection_id, {})
+                for record_id in [id for id in collection if id not in keep]:
+                    del collection[record_id]
+        self.upserted = {
+            key for key in self.upserted if key[1] in referenced.get(key[0], set())
+        }
+
+    def mark_saved(self):
+        self.upserted = set()
+
+
+class CacheSection:
+    # index of cached records for one section of the cache:
+    # collection_id -> record id -> timestamp, with the records themselves in self.records
+    # the records keep their insertion order, so views come out in the order they were added
+    # changes since the last save are tracked so the cache store only writes what changed
+    def __init__(self, time_key, wrappers=None, records=None):
+        self.time_key = time_key
+        self.collections = {}
+        self.records = records if records is not None else SectionRecords()
+        self.mark_saved()
+        if wrappers is not None:
+            for wrapper in wrappers:
+                self.add(wrapper["collection_id"], wrapper["data"], wrapper[time_key])
+
+    def add(self, collection_id, records, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        collection = self.collections.setdefault(collection_id, {})
+        for record in records:
+            self.records.put(collection_id, record)
+            collection[record["id"]] = timestamp
+            self.upserted.add((collection_id, record["id"]))
+            self.deleted.discard((collection_id, record["id"]))
+
+    def add_reference(self, collection_id, record_id, timestamp):
+        # membership of a record that is already in a shared record store
+        self.collections.setdefault(collection_id, {})[record_id] = timestamp
+
+    def touch(self, collection_id, record_ids):
+        # records that were changed in place still need to be written out
+        record_ids = [
+            record_id
+            for record_id in record_ids
+            if self.contains(collection_id, record_id)
+        ]
+        for record_id in record_ids:
+            self.upserted.add((collection_id, record_id))
+        self.records.touch(collection_id, record_ids)
+
+    def get(self, collection_id):
+        return self.records.get_many(collection_id, self.ids(collection_id))
+
+    def summaries(self, collection_id):
+        # only for sections backed by PortfolioRecords
+        return [
+            self.records.summary(collection_id, record_id)
+            for record_id in self.collections.get(collection_id, {})
+        ]
+
+    def replace_record(self, collection_id, record):
+        # swap in a newer copy of a record without resetting when it was cached
+        timestamp = self.collections.get(collection_id, {}).get(record["id"])
+        if timestamp is not None:
+            self.add(collection_id, [record], timestamp)
+
+    def get_record(self, collection_id, record_id):
+        if not self.contains(collection_id, record_id):
+            return None
+        return self.records.get(collection_id, record_id)
+
+    def ids(self, collection_id):
+        return list(self.collections.get(collection_id, {}))
+
+    def contains(self, collection_id, record_id):
+        return record_id in self.collections.get(collection_id, {})
+
+    def count(self, collection_id):
+        return len(self.collections.get(collection_id, {}))
+
+    def first_timestamp(self, collection_id):
+        collection = self.collections.get(collection_id, {})
+        if not collection:
+            return 0
+        return min(collection.values())
+
+    def remove(self, collection_id, record_id):
+        self.collections.get(collection_id, {}).pop(record_id, None)
+        self.records.discard(collection_id, record_id)
+        self.upserted.discard((collection_id, record_id))
+        self.deleted.add((collection_id, record_id))
+
+    def remove_collection(self, collection_id):
+        self.collections.pop(collection_id, None)
+        self.records.discard_collection(collection_id)
+        self.upserted = {key for key in self.upserted if key[0] != collection_id}
+        self.deleted = {key for key in self.deleted if key[0] != collection_id}
+        self.removed_collections.add(collection_id)
+
+    def clear(self):
+        self.collections = {}
+        self.records.clear()
+        self.mark_saved()
+        self.cleared = True
+
+    def mark_saved(self):
+        self.upserted = set()
+        self.deleted = set()
+        self.removed_collections = set()
+        self.cleared = False
+
+    def expire(self, cutoff):
+        for collection_id in list(self.collections):
+            collection = self.collections[collection_id]
+            expired = [
+                record_id
+                for record_id, timestamp in collection.items()
+                if timestamp <= cutoff
+            ]
+            for record_id in expired:
+                del collection[record_id]
+                self.records.discard(collection_id, record_id)
+            if not collection:
+                del self.collections[collection_id]
 
 
 class Cache:
     CACHE_TTL = 60 * 60 * 24 * 7
     EMPTY_CACHE = {
-        "collection_overviews": [
-            {
-                "collection_id": "",
-                "retrieved": 0.0,
-                "data": {},
-            },
-        ],
-        "portfolios_retrieved": [
-            {
-                "collection_id": "",
-                "retrieved": 0.0,
-                "data": [],
-            },
-        ],
-        "portfolios_updated": [
-            {
-                "collection_id": "",
-                "updated": 0.0,
-                "data": [],
-            },
-        ],
-        "portfolios_ready_to_update": [
-            {
-                "collection_id": "",
-                "saved": 0.0,
-                "data": [],
-            },
-        ],
-        "portfolios_not_updating": [
-            {
-                "collection_id": "",
-                "saved": 0.0,
-                "data": [],
-            },
-        ],
-        "api_calls_logged": [
-            {
-                "count": 0,
-                "time": datetime.datetime.now().astimezone().isoformat(),
-            },
-        ],
+        "collection_overviews": [],
+        "portfolios_retrieved": [],
+        "portfolios_updated": [],
+        "portfolios_ready_to_update": [],
+        "portfolios_not_updating": [],
+        "failed_requests": [],
+        "api_calls_logged": [],
         "total_api_calls_past_24_hrs": 0,
     }
 
@@ -107,88 +523,119 @@ class Cache:
         if loadedcache is None:
             loadedcache = self.EMPTY_CACHE
 
-        self.collection_overviews = loadedcache["collection_overviews"]
-        self.portfolios_retrieved = loadedcache["portfolios_retrieved"]
-        self.portfolios_updated = loadedcache["portfolios_updated"]
-        self.portfolios_ready_to_update = loadedcache["portfolios_ready_to_update"]
-        self.portfolios_not_updating = loadedcache["portfolios_not_updating"]
-        self.api_calls_logged = loadedcache["api_calls_logged"]
+        self.collection_overviews = CacheSection(
+            "retrieved", loadedcache["collection_overviews"]
+        )
+        # the four portfolio sections share one copy of each portfolio
+        self.portfolio_records = PortfolioRecords()
+        self.portfolios_retrieved = CacheSection(
+            "retrieved", loadedcache["portfolios_retrieved"], self.portfolio_records
+        )
+        self.portfolios_updated = CacheSection(
+            "updated", loadedcache["portfolios_updated"], self.portfolio_records
+        )
+        self.portfolios_ready_to_update = CacheSection(
+            "saved", loadedcache["portfolios_ready_to_update"], self.portfolio_records
+        )
+        self.portfolios_not_updating = CacheSection(
+            "saved", loadedcache["portfolios_not_updating"], self.portfolio_records
+        )
+        # portfolio GETs/PUTs that failed, for the retry_failed mode.
+        # caches from older versions don't have this section
+        self.failed_requests = CacheSection(
+            "failed", loadedcache.get("failed_requests", [])
+        )
+        self.api_calls_logged = list(loadedcache["api_calls_logged"])
+        # the set the calls made by this run are counted in
+        self.current_api_call_set = None
         self.total_api_calls_past_24_hrs = loadedcache["total_api_calls_past_24_hrs"]
         self.expire_all()
         self.sum_api_calls()
 
-    # methods to return portfolio objects for the current collectionid
+    # methods to return portfolio objects for the current collection_run().collection_id
     # could be empty lists
     def get_overview_port_ids(self):
-        # check self.collection_overviews for collection_id
-        # return the ids of each portfolio in the object
-        portfolio_ids = []
-        for collection in self.collection_overviews:
-            if collection["collection_id"] == collectionid:
-                for portfolio in collection["data"]:
-                    portfolio_ids.append(portfolio["id"])
-        return portfolio_ids
+        return self.collection_overviews.ids(collection_run().collection_id)
 
     def get_overview_port_first_retrieved_timestamp(self):
-        retrieval_dates = []
-        for collection in self.collection_overviews:
-            if collection["collection_id"] == collectionid:
-                retrieval_dates.append(collection["retrieved"])
-
-        if retrieval_dates == []:
-            return 0
-        else:
-            retrieval_dates.sort()
-            return retrieval_dates[0]
+        return self.collection_overviews.first_timestamp(collection_run().collection_id)
 
     def get_retrieved_port_ids(self):
-        portfolio_ids = []
-        for portfolio in self.portfolios_retrieved:
-            if portfolio["collection_id"] == collectionid:
-                for port in portfolio["data"]:
-                    portfolio_ids.append(port["id"])
-        return portfolio_ids
+        return self.portfolios_retrieved.ids(collection_run().collection_id)
 
     def get_retrieved_portfolios(self):
-        portfolios = []
-        for portfolio in self.portfolios_retrieved:
-            if portfolio["collection_id"] == collectionid:
-                portfolios = portfolios + portfolio["data"]
-        return portfolios
+        return self.portfolios_retrieved.get(collection_run().collection_id)
 
-    def get_portfolios_first_retrieved(self):
-        retrieval_dates = []
-        for portfolio in self.portfolios_retrieved:
-            if portfolio["collection_id"] == collectionid:
-                retrieval_dates.append(portfolio["retrieved"])
+    def get_retrieved_portfolio(self, portfolio_id):
+        return self.portfolios_retrieved.get_record(
+            collection_run().collection_id, portfolio_id
+        )
 
-        if retrieval_dates == []:
-            return 0
-        else:
-            retrieval_dates.sort()
-            return retrieval_dates[0]
+    def has_retrieved_portfolio(self, portfolio_id):
+        return self.portfolios_retrieved.contains(
+            collection_run().collection_id, portfolio_id
+        )
+
+    def count_retrieved_portfolios(self):
+        return self.portfolios_retrieved.count(collection_run().collection_id)
+
+    def get_retrieved_summaries(self):
+        return self.portfolios_retrieved.summaries(collection_run().collection_id)
+
+    def get_portfolios_first_retrieved(self):
+        return self.portfolios_retrieved.first_timestamp(collection_run().collection_id)
 
     def get_updated_portfolios(self):
-        portfolios = []
-        for portfolio in self.portfolios_updated:
-            if portfolio["collection_id"] == collectionid:
-                portfolios = portfolios + portfolio["data"]
+        return self.portfolios_updated.get(collection_run().collection_id)
+
+    def count_updated_portfolios(self):
+        return self.portfolios_updated.count(collection_run().collection_id)
 
-        return portfolios
+    def has_updated_portfolio(self, portfolio_id):
+        return self.portfolios_updated.contains(
+            collection_run().collection_id, portfolio_id
+        )
+
+    def has_ready_to_update_portfolio(self, portfolio_id):
+        return self.portfolios_ready_to_update.contains(
+            collection_run().collection_id, portfolio_id
+        )
+
+    def has_not_updating_portfolio(self, portfolio_id):
+        return self.portfolios_not_updating.contains(
+            collection_run().collection_id, portfolio_id
+        )
+
+    def get_ready_to_update_portfolio(self, portfolio_id):
+        return self.portfolios_ready_to_update.get_record(
+            collection_run().collection_id, portfolio_id
+        )
 
     def get_ready_to_update_portfolios(self):
-        portfolios_to_update = []
-        for portfolio in self.portfolios_ready_to_update:
-            if portfolio["collection_id"] == collectionid:
-                portfolios_to_update = portfolios_to_update + portfolio["data"]
-        return portfolios_to_update
+        return self.portfolios_ready_to_update.get(collection_run().collection_id)
+
+    def count_ready_to_update_portfolios(self):
+        return self.portfolios_ready_to_update.count(collection_run().collection_id)
 
     def get_not_updating_portfolios(self):
-        portfolios_not_to_update = []
-        for portfolio in self.portfolios_not_updating:
-            if portfolio["collection_id"] == collectionid:
-                portfolios_not_to_update = portfolios_not_to_update + portfolio["data"]
-        return portfolios_not_to_update
+        return self.portfolios_not_updating.get(collection_run().collection_id)
+
+    def get_not_updating_summaries(self):
+        return self.portfolios_not_updating.summaries(collection_run().collection_id)
+
+    def count_not_updating_portfolios(self):
+        return self.portfolios_not_updating.count(collection_run().collection_id)
+
+    def get_failed_requests(self):
+        return self.failed_requests.get(collection_run().collection_id)
+
+    def get_failed_request(self, portfolio_id):
+        return self.failed_requests.get_record(
+            collection_run().collection_id, portfolio_id
+        )
+
+    def count_failed_requests(self):
+        return self.failed_requests.count(collection_run().collection_id)
 
     def get_remaining_api_calls(self):
         return MAX_API_CALLS_PER_DAY - self.total_api_calls_past_24_hrs
@@ -199,48 +646,29 @@ class Cache:
         self.expire_portfolios_updated()
         self.expire_portfolios_ready_to_update()
         self.expire_portfolios_not_updating()
+        self.expire_failed_requests()
         self.expire_api_calls()
 
     def expire_overviews(self):
-        overviews_to_keep = []
-        for overview in self.collection_overviews:
-            if overview["retrieved"] > (time.time() - self.CACHE_TTL):
-                overviews_to_keep.append(overview)
-        self.collection_overviews = overviews_to_keep
+        self.collection_overviews.expire(time.time() - self.CACHE_TTL)
 
     def expire_portfolios_retrieved(self):
-        portfolios_to_keep = []
-        for portfolio in self.portfolios_retrieved:
-            if portfolio["retrieved"] > (time.time() - self.CACHE_TTL):
-                portfolios_to_keep.append(portfolio)
-        self.portfolios_retrieved = portfolios_to_keep
+        self.portfolios_retrieved.expire(time.time() - self.CACHE_TTL)
 
     def expire_portfolios_updated(self):
-        portfolios_to_keep = []
-        for portfolio in self.portfolios_updated:
-            if portfolio["updated"] > (time.time() - self.CACHE_TTL):
-                portfolios_to_keep.append(portfolio)
-        self.portfolios_updated = portfolios_to_keep
+        self.portfolios_updated.expire(time.time() - self.CACHE_TTL)
 
     def expire_portfolios_ready_to_update(self):
-        portfolios_to_keep = []
-        for portfolio in self.portfolios_ready_to_update:
-            if portfolio["saved"] > (time.time() - self.CACHE_TTL):
-                portfolios_to_keep.append(portfolio)
-        self.portfolios_ready_to_update = portfolios_to_keep
+        self.portfolios_ready_to_update.expire(time.time() - self.CACHE_TTL)
 
     def expire_portfolios_not_updating(self):
-        portfolios_to_keep = []
-        for portfolio in self.portfolios_not_updating:
-            if portfolio["saved"] > (time.time() - self.CACHE_TTL):
-                portfolios_to_keep.append(portfolio)
-        self.portfolios_not_updating = portfolios_to_keep
+        self.portfolios_not_updating.expire(time.time() - self.CACHE_TTL)
+
+    def expire_failed_requests(self):
+        self.failed_requests.expire(time.time() - self.CACHE_TTL)
 
     def expire_api_calls(self):
-        utc_now = datetime.datetime.now(datetime.timezone.utc)
-        utc_midnight = datetime.datetime.combine(
-            utc_now, datetime.datetime.min.time(), tzinfo=datetime.timezone.utc
-        )
+        utc_midnight = last_utc_midnight()
         api_calls_to_keep = []
         for session in self.api_calls_logged:
             if datetime.datetime.fromisoformat(session["time"]) > utc_midnight:
@@ -257,310 +685,2069 @@ class Cache:
         self.total_api_calls_past_24_hrs = total
 
     def add_collection_overview(self, overview):
-        # get collection id, time, and build overview wrapper,
-        # then append it to the list
-        newoverview = {
-            "collection_id": collectionid,
-            "retrieved": time.time(),
-            "data": overview,
-        }
-        self.collection_overviews.append(newoverview)
+        self.collection_overviews.add(collection_run().collection_id, overview)
 
     def add_portfolios_retrieved(self, portfolios):
-        # get collection id, time, and build wrapper,
-        # then append it to the list
-        newportfoliolist = {
-            "collection_id": collectionid,
-            "retrieved": time.time(),
-            "data": portfolios,
-        }
-        self.portfolios_retrieved.append(newportfoliolist)
+        self.portfolios_retrieved.add(collection_run().collection_id, portfolios)
 
     def add_portfolios_updated(self, portfolios):
-        # get collection id, time, and build wrapper,
-        # then append it to the list
-        newportfoliolist = {
-            "collection_id": collectionid,
-            "updated": time.time(),
-            "data": portfolios,
-        }
-        self.portfolios_updated.append(newportfoliolist)
+        self.portfolios_updated.add(collection_run().collection_id, portfolios)
 
     def add_portfolios_ready_to_update(self, portfolios):
-        # get collection id, time, and build wrapper,
-        # then append it to the list
-        newportfoliolist = {
-            "collection_id": collectionid,
-            "saved": time.time(),
-            "data": portfolios,
-        }
-        self.portfolios_ready_to_update.append(newportfoliolist)
+        self.portfolios_ready_to_update.add(collection_run().collection_id, portfolios)
 
     def add_portfolios_not_updating(self, portfolios):
-        # get collection id, time, and build wrapper,
-        # then append it to the list
-        newportfoliolist = {
-            "collection_id": collectionid,
-            "saved": time.time(),
-            "data": portfolios,
-        }
-        self.portfolios_not_updating.append(newportfoliolist)
-
-    def add_api_call_set(self, count):
-        # get time and build wrapper,
-        # then append it to the list
-        newapicallset = {
-            "count": count,
-            "time": datetime.datetime.now().astimezone().isoformat(),
-        }
-        self.api_calls_logged.append(newapicallset)
-        self.sum_api_calls()
+        self.portfolios_not_updating.add(collection_run().collection_id, portfolios)
+
+    def add_failed_request(self, failure):
+        self.failed_requests.add(collection_run().collection_id, [failure])
+
+    def log_api_call(self):
+        # every call this run sends is added to one set, a new set is started after
+        # midnight UTC so the calls from before it still expire on time
+        api_call_set = self.current_api_call_set
+        if api_call_set is None or (
+            datetime.datetime.fromisoformat(api_call_set["time"]) <= last_utc_midnight()
+        ):
+            api_call_set = {
+                "count": 0,
+                "time": datetime.datetime.now().astimezone().isoformat(),
+            }
+            self.current_api_call_set = api_call_set
+            self.api_calls_logged.append(api_call_set)
+            self.sum_api_calls()
+        api_call_set["count"] += 1
+        self.total_api_calls_past_24_hrs += 1
 
     def remove_collection_overview(self):
-        overviews_to_keep = []
-        for overview in self.collection_overviews:
-            if overview["collection_id"] != collectionid:
-                overviews_to_keep.append(overview)
-        self.collection_overviews = overviews_to_keep
+        self.collection_overviews.remove_collection(collection_run().collection_id)
 
     def remove_all_portfolios_retrieved_by_collection(self):
-        portset_to_keep = []
-        for portset in self.portfolios_retrieved:
-            if portset["collection_id"] != collectionid:
-                portset_to_keep.append(portset)
-
-        self.portfolios_retrieved = portset_to_keep
+        self.portfolios_retrieved.remove_collection(collection_run().collection_id)
 
     def remove_portfolio_from_portfolios_retrieved(self, portfolio):
-        # find the portfolio in the cache and remove it
-        portset_to_keep = []
-        for portset in self.portfolios_retrieved:
-            ports_to_keep = []
-            if portset["collection_id"] == collectionid:
-                for port in portset["data"]:
-                    if port != portfolio:
-                        ports_to_keep.append(port)
-                portset["data"] = ports_to_keep
-                portset_to_keep.append(portset)
-            else:
-                ports_to_keep.append(portset)
-        self.portfolios_retrieved = portset_to_keep
+        self.portfolios_retrieved.remove(
+            collection_run().collection_id, portfolio["id"]
+        )
 
     def remove_all_portfolios_updated_by_collection(self):
-        portset_to_keep = []
-        for portset in self.portfolios_updated:
-            if portset["collection_id"] != collectionid:
-                portset_to_keep.append(portset)
-
-        self.portfolios_updated = portset_to_keep
+        self.portfolios_updated.remove_collection(collection_run().collection_id)
 
     def remove_portfolio_from_portfolios_updated(self, portfolio):
-        # find the portfolio in the cache and remove it
-        portset_to_keep = []
-        for portset in self.portfolios_updated:
-            ports_to_keep = []
-            if portset["collection_id"] == collectionid:
-                for port in portset["data"]:
-                    if port != portfolio:
-                        ports_to_keep.append(port)
-                portset["data"] = ports_to_keep
-                portset_to_keep.append(portset)
-            else:
-                portset_to_keep.append(portset)
-        self.portfolios_updated = portset_to_keep
+        self.portfolios_updated.remove(collection_run().collection_id, portfolio["id"])
 
     def remove_portfolio_from_portfolios_not_updating(self, portfolio):
-        # find the portfolio in the cache and remove it
-        portset_to_keep = []
-        for portset in self.portfolios_not_updating:
-            ports_to_keep = []
-            if portset["collection_id"] == collectionid:
-                for port in portset["data"]:
-                    if port != portfolio:
-                        ports_to_keep.append(port)
-                portset["data"] = ports_to_keep
-                portset_to_keep.append(portset)
-            else:
-                portset_to_keep.append(portset)
-        self.portfolios_not_updating = portset_to_keep
+        self.portfolios_not_updating.remove(
+            collection_run().collection_id, portfolio["id"]
+        )
 
     def remove_all_portfolios_not_updating_by_collection(self):
-        portset_to_keep = []
-        for portset in self.portfolios_not_updating:
-            if portset["collection_id"] != collectionid:
-                portset_to_keep.append(portset)
-
-        self.portfolios_not_updating = portset_to_keep
+        self.portfolios_not_updating.remove_collection(collection_run().collection_id)
 
     def remove_all_portfolios_ready_to_update_by_collection(self):
-        portset_to_keep = []
-        for portset in self.portfolios_ready_to_update:
-            if portset["collection_id"] != collectionid:
-                portset_to_keep.append(portset)
-
-        self.portfolios_ready_to_update = portset_to_keep
+        self.portfolios_ready_to_update.remove_collection(
+            collection_run().collection_id
+        )
 
     def remove_portfolio_from_portfolios_ready_to_update(self, portfolio):
-        # find the portfolio in the cache and remove it
-        ports_to_keep = []
-        portset_to_keep = []
-        for portset in self.portfolios_ready_to_update:
-            if portset["collection_id"] == collectionid:
-                for port in portset["data"]:
-                    if port != portfolio:
-                        ports_to_keep.append(port)
-                portset["data"] = ports_to_keep
-                portset_to_keep.append(portset)
-            else:
-                ports_to_keep.append(portset)
-        self.portfolios_ready_to_update = portset_to_keep
+        self.portfolios_ready_to_update.remove(
+            collection_run().collection_id, portfolio["id"]
+        )
+
+    def remove_failed_request(self, portfolio_id):
+        # called after every successful request, so only portfolios in the ledger are touched
+        if self.failed_requests.contains(collection_run().collection_id, portfolio_id):
+            self.failed_requests.remove(collection_run().collection_id, portfolio_id)
+
+    def remove_all_failed_requests_by_collection(self):
+        self.failed_requests.remove_collection(collection_run().collection_id)
+
+    def mark_portfolios_retrieved_changed(self, portfolios):
+        self.portfolios_retrieved.touch(
+            collection_run().collection_id,
+            [portfolio["id"] for portfolio in portfolios],
+        )
+
+    def remove_portfolio_from_all_sections(self, portfolio_id):
+        for section in self.sections().values():
+            section.remove(collection_run().collection_id, portfolio_id)
 
     def remove_all_but_api(self):
-        self.collection_overviews = self.EMPTY_CACHE["collection_overviews"]
-        self.portfolios_retrieved = self.EMPTY_CACHE["portfolios_retrieved"]
-        self.portfolios_updated = self.EMPTY_CACHE["portfolios_updated"]
-        self.portfolios_ready_to_update = self.EMPTY_CACHE["portfolios_ready_to_update"]
-        self.portfolios_not_updating = self.EMPTY_CACHE["portfolios_not_updating"]
-
-    def json(self):
-        # return json object (for saving to file)
-        obj = {
+        self.collection_overviews.clear()
+        self.portfolios_retrieved.clear()
+        self.portfolios_updated.clear()
+        self.portfolios_ready_to_update.clear()
+        self.portfolios_not_updating.clear()
+        self.failed_requests.clear()
+
+    def sections(self):
+        return {
             "collection_overviews": self.collection_overviews,
             "portfolios_retrieved": self.portfolios_retrieved,
             "portfolios_updated": self.portfolios_updated,
             "portfolios_ready_to_update": self.portfolios_ready_to_update,
             "portfolios_not_updating": self.portfolios_not_updating,
-            "api_calls_logged": self.api_calls_logged,
-            "total_api_calls_past_24_hrs": self.total_api_calls_past_24_hrs,
+            "failed_requests": self.failed_requests,
+        }
+
+    def portfolio_sections(self):
+        return [
+            section
+            for section in self.sections().values()
+            if section.records is self.portfolio_records
+        ]
+
+    def prune_portfolio_records(self):
+        # drop the shared copies of portfolios that no section has any more
+        referenced = {}
+        for section in self.portfolio_sections():
+            for collection_id, collection in section.collections.items():
+                referenced.setdefault(collection_id, set()).update(collection)
+        self.portfolio_records.prune(referenced)
+
+    def mark_saved(self):
+        for section in self.sections().values():
+            section.mark_saved()
+        self.portfolio_records.mark_saved()
+
+
+class CacheStore:
+    # sqlite storage for the cache with one row per portfolio per section.
+    # only the rows for the configured collection are loaded, and saving writes
+    # just the rows that changed since the last save.
+    # the portfolio sections' rows only hold the ID, each portfolio is stored once in
+    # portfolio_records along with the fields the logs need, so the full records are
+    # only parsed when a run actually uses them.
+    # the records are stored zlib compressed in a BLOB, the compressed column tells
+    # them apart from rows written before that, which are read as they are
+    RECORD_BATCH_SIZE = 500
+    COMPRESSION_LEVEL = 6
+
+    def __init__(self, path=CACHE_DB):
+        self.connection = sqlite3.connect(path)
+        # only takes effect when the database is created, lets save hand freed pages back
+        self.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS portfolios ("
+                " section TEXT NOT NULL,"
+                " collection_id TEXT NOT NULL,"
+                " portfolio_id TEXT NOT NULL,"
+                " timestamp REAL NOT NULL,"
+                " data BLOB NOT NULL,"
+                " compressed INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (section, collection_id, portfolio_id))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS portfolios_by_collection"
+                " ON portfolios (collection_id, portfolio_id)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS portfolio_records ("
+                " collection_id TEXT NOT NULL,"
+                " portfolio_id TEXT NOT NULL,"
+                " title TEXT,"
+                " mms_id TEXT,"
+                " pam_value TEXT,"
+                " pam_description TEXT,"
+                " has_pam_description INTEGER NOT NULL DEFAULT 0,"
+                " data BLOB NOT NULL,"
+                " compressed INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (collection_id, portfolio_id))"
+            )
+            for table in ("portfolios", "portfolio_records"):
+                if "compressed" not in self.columns(table):
+                    self.add_compressed(table)
+            if "has_pam_description" not in self.columns("portfolio_records"):
+                self.add_has_pam_description()
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS api_calls ("
+                " count INTEGER NOT NULL,"
+                " time TEXT NOT NULL)"
+            )
+
+    def load(self, collection_ids):
+        # loads the rows of the given collections only
+        cache = Cache()
+        cache.portfolio_records.loader = self.load_portfolio_records
+        # portfolio rows written before the records were shared still have their own copy
+        full_copies = []
+        for collection_id in collection_ids:
+            for portfolio_id, *fields in self.connection.execute(
+                "SELECT portfolio_id, title, mms_id, pam_value, pam_description,"
+                " has_pam_description FROM portfolio_records WHERE collection_id = ?",
+                (collection_id,),
+            ):
+                cache.portfolio_records.put_summary(
+                    collection_id, PortfolioSummary(portfolio_id, *fields)
+                )
+
+            for name, section in cache.sections().items():
+                rows = self.connection.execute(
+                    "SELECT portfolio_id, timestamp, data, compressed FROM portfolios"
+                    " WHERE section = ? AND collection_id = ?",
+                    (name, collection_id),
+                )
+                for portfolio_id, timestamp, data, compressed in rows:
+                    if data:
+                        section.add(
+                            collection_id, [self.decode(data, compressed)], timestamp
+                        )
+                        if section.records.shared:
+                            full_copies.append((section, collection_id, portfolio_id))
+                    elif cache.portfolio_records.summary(collection_id, portfolio_id):
+                        section.add_reference(collection_id, portfolio_id, timestamp)
+
+        cache.api_calls_logged = [
+            {"count": count, "time": logged_time}
+            for count, logged_time in self.connection.execute(
+                "SELECT count, time FROM api_calls"
+            )
+        ]
+        cache.expire_all()
+        cache.sum_api_calls()
+        cache.mark_saved()
+        # rewritten in the shared layout on the next save
+        for section, collection_id, portfolio_id in full_copies:
+            section.touch(collection_id, [portfolio_id])
+        return cache
+
+    def columns(self, table):
+        return [
+            row[1] for row in self.connection.execute(f"PRAGMA table_info({table})")
+        ]
+
+    def add_compressed(self, table):
+        # databases written before the column was added. their compressed rows are the
+        # zlib streams, which start with 0x78 ("x") where plain JSON never does
+        self.connection.execute(
+            f"ALTER TABLE {table} ADD COLUMN compressed INTEGER NOT NULL DEFAULT 0"
+        )
+        self.connection.execute(
+            f"UPDATE {table} SET compressed = 1 WHERE substr(data, 1, 1) = X'78'"
+        )
+
+    def add_has_pam_description(self):
+        # databases written before the column was added, worked out once from the records
+        self.connection.execute(
+            "ALTER TABLE portfolio_records"
+            " ADD COLUMN has_pam_description INTEGER NOT NULL DEFAULT 0"
+        )
+        rows = self.connection.execute(
+            "SELECT collection_id, portfolio_id, data, compressed FROM portfolio_records"
+        ).fetchall()
+        self.connection.executemany(
+            "UPDATE portfolio_records SET has_pam_description = ?"
+            " WHERE collection_id = ? AND portfolio_id = ?",
+            [
+                (
+                    PortfolioSummary.from_portfolio(
+                        self.decode(data, compressed)
+                    ).has_pam_description,
+                    collection_id,
+                    portfolio_id,
+                )
+                for collection_id, portfolio_id, data, compressed in rows
+            ],
+        )
+
+    def load_portfolio_records(self, collection_id, portfolio_ids):
+        records = {}
+        for start in range(0, len(portfolio_ids), self.RECORD_BATCH_SIZE):
+            batch = portfolio_ids[start : start + self.RECORD_BATCH_SIZE]
+            rows = self.connection.execute(
+                "SELECT portfolio_id, data, compressed FROM portfolio_records"
+                " WHERE collection_id = ?"
+                f" AND portfolio_id IN ({','.join('?' * len(batch))})",
+                [collection_id, *batch],
+            )
+            for portfolio_id, data, compressed in rows:
+                records[portfolio_id] = self.decode(data, compressed)
+        return records
+
+    def encode(self, record):
+        return zlib.compress(serializer.dumps(record), self.COMPRESSION_LEVEL)
+
+    def decode(self, data, compressed):
+        if compressed:
+            data = zlib.decompress(data)
+        return serializer.loads(data)
+
+    def save(self, cache):
+        cache.prune_portfolio_records()
+        with self.connection:
+            for name, section in cache.sections().items():
+                if section.cleared:
+                    self.connection.execute(
+                        "DELETE FROM portfolios WHERE section = ?", (name,)
+                    )
+                self.connection.executemany(
+                    "DELETE FROM portfolios WHERE section = ? AND collection_id = ?",
+                    [
+                        (name, collection_id)
+                        for collection_id in section.removed_collections
+                    ],
+                )
+                self.connection.executemany(
+                    "DELETE FROM portfolios"
+                    " WHERE section = ? AND collection_id = ? AND portfolio_id = ?",
+                    [
+                        (name, collection_id, portfolio_id)
+                        for collection_id, portfolio_id in section.deleted
+                    ],
+                )
+                upserts = []
+                for collection_id, portfolio_id in section.upserted:
+                    timestamp = section.collections.get(collection_id, {}).get(
+                        portfolio_id
+                    )
+                    if timestamp is None:
+                        continue
+                    if section.records.shared:
+                        data = b""
+                        compressed = False
+                    else:
+                        data = self.encode(
+                            section.records.get(collection_id, portfolio_id)
+                        )
+                        compressed = True
+                    upserts.append(
+                        (name, collection_id, portfolio_id, timestamp, data, compressed)
+                    )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO portfolios"
+                    " (section, collection_id, portfolio_id, timestamp, data, compressed)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    upserts,
+                )
+
+            records = cache.portfolio_records
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO portfolio_records"
+                " (collection_id, portfolio_id, title, mms_id, pam_value,"
+                " pam_description, has_pam_description, data, compressed)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)",
+                [
+                    (
+                        collection_id,
+                        portfolio_id,
+                        *records.summary(collection_id, portfolio_id).as_row(),
+                        self.encode(records.get(collection_id, portfolio_id)),
+                    )
+                    for collection_id, portfolio_id in records.upserted
+                ],
+            )
+
+            # expire the collections that weren't loaded this run too
+            self.connection.execute(
+                "DELETE FROM portfolios WHERE timestamp <= ?",
+                (time.time() - Cache.CACHE_TTL,),
+            )
+            # and drop the portfolios no portfolio section refers to any more
+            portfolio_sections = [
+                name
+                for name, section in cache.sections().items()
+                if section.records.shared
+            ]
+            self.connection.execute(
+                "DELETE FROM portfolio_records WHERE NOT EXISTS ("
+                " SELECT 1 FROM portfolios"
+                " WHERE portfolios.collection_id = portfolio_records.collection_id"
+                " AND portfolios.portfolio_id = portfolio_records.portfolio_id"
+                f" AND portfolios.section IN ({','.join('?' * len(portfolio_sections))}))",
+                portfolio_sections,
+            )
+
+            # the api call log only holds today's sessions, so it is rewritten whole
+            self.connection.execute("DELETE FROM api_calls")
+            self.connection.executemany(
+                "INSERT INTO api_calls (count, time) VALUES (?, ?)",
+                [
+                    (api_call_set["count"], api_call_set["time"])
+                    for api_call_set in cache.api_calls_logged
+                ],
+            )
+        # each freed page is handed back as a result row
+        self.connection.execute("PRAGMA incremental_vacuum").fetchall()
+        cache.mark_saved()
+
+    def close(self):
+        self.connection.close()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative_counts(self):
+        # prometheus buckets count everything at or below each bound, ending with +Inf
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {
+            "buckets": {str(bound): count for bound, count in self.cumulative_counts()},
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class Metrics:
+    # request metrics for one run, split by HTTP method and endpoint
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    WAIT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.endpoints = {}
+        self.rate_limit_wait = Histogram(self.WAIT_BUCKETS)
+        self.concurrency_wait = Histogram(self.WAIT_BUCKETS)
+
+    def endpoint(self, method, url):
+        path = urllib.parse.urlsplit(url).path
+        if path.endswith("/portfolios"):
+            name = "portfolio_list"
+        elif "/portfolios/" in path:
+            name = "portfolio"
+        else:
+            name = "e_collection"
+
+        key = (method, name)
+        if key not in self.endpoints:
+            self.endpoints[key] = {
+                "requests": 0,
+                "statuses": {},
+                "connection_errors": 0,
+                "latency": Histogram(self.LATENCY_BUCKETS),
+                "bytes_sent": 0,
+                "bytes_received": 0,
+            }
+        return self.endpoints[key]
+
+    def record_response(self, method, url, status, latency, bytes_sent):
+        endpoint = self.endpoint(method, url)
+        endpoint["requests"] += 1
+        endpoint["statuses"][status] = endpoint["statuses"].get(status, 0) + 1
+        endpoint["latency"].observe(latency)
+        endpoint["bytes_sent"] += bytes_sent
+
+    def record_connection_error(self, method, url, bytes_sent):
+        endpoint = self.endpoint(method, url)
+        endpoint["requests"] += 1
+        endpoint["connection_errors"] += 1
+        endpoint["bytes_sent"] += bytes_sent
+
+    def record_bytes_received(self, method, url, bytes_received):
+        # the size of the body after aiohttp has decompressed it, gzipped responses
+        # take fewer bytes than this on the wire
+        self.endpoint(method, url)["bytes_received"] += bytes_received
+
+    def merge(self, other):
+        # adds in the metrics of a shard worker process
+        for key, theirs in other.endpoints.items():
+            if key not in self.endpoints:
+                self.endpoints[key] = theirs
+                continue
+            endpoint = self.endpoints[key]
+            for field in (
+                "requests",
+                "connection_errors",
+                "bytes_sent",
+                "bytes_received",
+            ):
+                endpoint[field] += theirs[field]
+            for status, count in theirs["statuses"].items():
+                endpoint["statuses"][status] = (
+                    endpoint["statuses"].get(status, 0) + count
+                )
+            endpoint["latency"].merge(theirs["latency"])
+        self.rate_limit_wait.merge(other.rate_limit_wait)
+        self.concurrency_wait.merge(other.concurrency_wait)
+
+    def as_dict(self):
+        return {
+            "endpoints": [
+                {
+                    "method": method,
+                    "endpoint": name,
+                    "requests": endpoint["requests"],
+                    "statuses": {
+                        str(status): count
+                        for status, count in endpoint["statuses"].items()
+                    },
+                    "connection_errors": endpoint["connection_errors"],
+                    "latency_seconds": endpoint["latency"].as_dict(),
+                    "bytes_sent": endpoint["bytes_sent"],
+                    "bytes_received": endpoint["bytes_received"],
+                }
+                for (method, name), endpoint in self.endpoints.items()
+            ],
+            "rate_limit_wait_seconds": self.rate_limit_wait.as_dict(),
+            "concurrency_wait_seconds": self.concurrency_wait.as_dict(),
+        }
+
+    def prometheus_text(self, extra_gauges):
+        # prometheus text exposition format, for the node exporter textfile collector
+        prefix = "alma_pam_tool"
+        lines = []
+
+        def metric_type(name, kind, help_text):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        def sample(name, labels, value):
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            if label_text:
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}")
+            else:
+                lines.append(f"{prefix}_{name} {value}")
+
+        def histogram_samples(name, histogram, labels):
+            for bound, count in histogram.cumulative_counts():
+                sample(f"{name}_bucket", {**labels, "le": bound}, count)
+            sample(f"{name}_sum", labels, histogram.sum)
+            sample(f"{name}_count", labels, histogram.count)
+
+        endpoints = [
+            ({"method": method, "endpoint": name}, endpoint)
+            for (method, name), endpoint in self.endpoints.items()
+        ]
+
+        # the file is rewritten after every run with that run's figures alone, so they
+        # are gauges, a counter would look to prometheus like it kept being reset
+        metric_type("requests", "gauge", "API requests in the last run by status.")
+        for labels, endpoint in endpoints:
+            for status, count in endpoint["statuses"].items():
+                sample("requests", {**labels, "status": status}, count)
+
+        metric_type(
+            "connection_errors",
+            "gauge",
+            "API requests in the last run that failed without a response.",
+        )
+        for labels, endpoint in endpoints:
+            sample("connection_errors", labels, endpoint["connection_errors"])
+
+        metric_type(
+            "request_duration_seconds", "histogram", "Time until the API responded."
+        )
+        for labels, endpoint in endpoints:
+            histogram_samples("request_duration_seconds", endpoint["latency"], labels)
+
+        metric_type(
+            "request_body_bytes", "gauge", "Request body bytes sent in the last run."
+        )
+        for labels, endpoint in endpoints:
+            sample("request_body_bytes", labels, endpoint["bytes_sent"])
+        metric_type(
+            "response_body_bytes",
+            "gauge",
+            "Response body bytes received in the last run, counted after decompression.",
+        )
+        for labels, endpoint in endpoints:
+            sample("response_body_bytes", labels, endpoint["bytes_received"])
+
+        metric_type(
+            "rate_limit_wait_seconds",
+            "histogram",
+            "Time requests waited for a rate limiter token.",
+        )
+        histogram_samples("rate_limit_wait_seconds", self.rate_limit_wait, {})
+        metric_type(
+            "concurrency_wait_seconds",
+            "histogram",
+            "Time requests queued for a concurrency slot.",
+        )
+        histogram_samples("concurrency_wait_seconds", self.concurrency_wait, {})
+
+        for name, (value, help_text) in extra_gauges.items():
+            metric_type(name, "gauge", help_text)
+            sample(name, {}, value)
+
+        return "\n".join(lines) + "\n"
+
+
+api_metrics = Metrics()
+
+
+class PhaseProfiler:
+    # CPU profile, wall/CPU time and asyncio task timing for each phase of a run,
+    # only collected when profile_run is set
+    TOP_FUNCTIONS = 25
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.phases = []
+        self.current = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # phases can't overlap, the collections of a batch are profiled as one phase
+        if not self.enabled or self.current is not None:
+            yield
+            return
+
+        phase = {"name": name, "profile": cProfile.Profile(), "tasks": {}}
+        self.current = phase
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+        phase["profile"].enable()
+        try:
+            yield
+        finally:
+            phase["profile"].disable()
+            phase["wall"] = time.perf_counter() - wall_started
+            phase["cpu"] = time.process_time() - cpu_started
+            self.current = None
+            self.phases.append(phase)
+
+    def install_task_timer(self, loop):
+        # time every task the event loop starts, grouped by coroutine, in the phase that started it
+        if not self.enabled:
+            return
+
+        def task_factory(loop, coro, **kwargs):
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+            phase = self.current
+            if phase is not None:
+                name = getattr(coro, "__qualname__", type(coro).__name__)
+                started = time.perf_counter()
+                task.add_done_callback(
+                    lambda task: self.record_task(
+                        phase, name, time.perf_counter() - started
+                    )
+                )
+            return task
+
+        loop.set_task_factory(task_factory)
+
+    def record_task(self, phase, name, duration):
+        task_stats = phase["tasks"].setdefault(
+            name, {"count": 0, "total": 0.0, "max": 0.0}
+        )
+        task_stats["count"] += 1
+        task_stats["total"] += duration
+        task_stats["max"] = max(task_stats["max"], duration)
+
+    def save(self):
+        if not self.enabled or not self.phases:
+            return
+        timestamp = time.strftime("%Y-%m-%d-%H_%M", time.localtime())
+        name = f"{mode}_profile-{timestamp}"
+
+        with open(f"{name}.txt", "w") as summary:
+            summary.write(
+                f"{'Phase':<20}{'Wall secs':>12}{'CPU secs':>12}{'CPU %':>8}\n"
+            )
+            for phase in self.phases:
+                cpu_share = phase["cpu"] / phase["wall"] * 100 if phase["wall"] else 0
+                summary.write(
+                    f"{phase['name']:<20}{phase['wall']:>12.3f}{phase['cpu']:>12.3f}"
+                    f"{cpu_share:>7.0f}%\n"
+                )
+
+            for phase in self.phases:
+                stats_file = f"{name}-{phase['name']}.pstats"
+                phase["profile"].dump_stats(stats_file)
+
+                summary.write(f"\n{'-'*20} {phase['name']} ({stats_file}) {'-'*20}\n")
+                if phase["tasks"]:
+                    summary.write(
+                        f"\n{'Task':<60}{'Count':>8}{'Total secs':>12}{'Max secs':>10}\n"
+                    )
+                    for task_name, task_stats in sorted(
+                        phase["tasks"].items(), key=lambda item: -item[1]["total"]
+                    ):
+                        summary.write(
+                            f"{task_name:<60}{task_stats['count']:>8}"
+                            f"{task_stats['total']:>12.3f}{task_stats['max']:>10.3f}\n"
+                        )
+                    summary.write("\n")
+                stats = pstats.Stats(phase["profile"], stream=summary)
+                stats.sort_stats("cumulative").print_stats(self.TOP_FUNCTIONS)
+
+        print(f"Profile saved to {name}.txt")
+
+
+profiler = PhaseProfiler(False)
+
+
+class AdaptiveConcurrency:
+    # AIMD (additive increase, multiplicative decrease) limit on in-flight requests,
+    # shared by the overview, detail and update phases in place of a fixed semaphore.
+    # the limit grows by about one request per round trip while recent latency stays in line
+    # with the longer term average, and is cut sharply on 429/5xx responses, timeouts and
+    # dropped connections.
+    # requests waiting for a slot are queued per collection and the collections take turns,
+    # so in a batch a large collection can't hold up the others
+    INITIAL_LIMIT = 30
+    MIN_LIMIT = 2
+    MAX_LIMIT = 60
+    DECREASE_FACTOR = 0.5
+    # recent latency above 1.5x the baseline stops the limit growing
+    LATENCY_TOLERANCE = 1.5
+    LATENCY_SMOOTHING = 0.1
+    BASELINE_SMOOTHING = 0.01
+
+    def __init__(self, initial_limit=INITIAL_LIMIT):
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        # collection_id -> deque of waiters, in the order the collections get their turn
+        self.waiters = {}
+        self.smoothed_latency = None
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    async def acquire(self):
+        if not self.waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            api_metrics.concurrency_wait.observe(0.0)
+            return
+
+        queued_at = time.monotonic()
+        key = collection_run().collection_id
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as we were cancelled
+                self.release()
+            else:
+                # wake_waiters may already have dropped the cancelled waiter
+                queue = self.waiters.get(key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self.waiters[key]
+            raise
+        api_metrics.concurrency_wait.observe(time.monotonic() - queued_at)
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        while self.waiters and self.in_flight < int(self.limit):
+            # serve the collection whose turn it is, then send it to the back of the line
+            key = next(iter(self.waiters))
+            queue = self.waiters.pop(key)
+            waiter = queue.popleft()
+            if queue:
+                self.waiters[key] = queue
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def record_response(self, status, latency):
+        if status == 429 or status >= 500:
+            self.record_failure()
+            return
+
+        if self.smoothed_latency is None:
+            self.smoothed_latency = latency
+            self.baseline_latency = latency
+        else:
+            self.smoothed_latency += self.LATENCY_SMOOTHING * (
+                latency - self.smoothed_latency
+            )
+            # the baseline follows improvements straight away but only drifts up slowly,
+            # so a lasting change in the API isn't mistaken for congestion forever
+            self.baseline_latency = min(
+                self.baseline_latency
+                + self.BASELINE_SMOOTHING * (latency - self.baseline_latency),
+                self.smoothed_latency,
+            )
+
+        # only grow while the current limit is actually being used
+        if (
+            self.in_flight >= self.limit / 2
+            and self.smoothed_latency <= self.baseline_latency * self.LATENCY_TOLERANCE
+        ):
+            self.limit = min(self.limit + 1 / self.limit, self.MAX_LIMIT)
+            self.wake_waiters()
+
+    def record_failure(self):
+        # back off at most once per round trip, the requests already in flight
+        # were sent before the last decrease took effect
+        now = time.monotonic()
+        if now - self.last_decrease < (self.smoothed_latency or 1.0):
+            return
+        self.limit = max(self.limit * self.DECREASE_FACTOR, self.MIN_LIMIT)
+        self.last_decrease = now
+        self.decreases += 1
+
+
+class ApiBudgetExhausted(Exception):
+    # raised instead of sending a request when the daily API budget can't cover it
+    pass
+
+
+class ApiBudget:
+    # per request ledger of the daily API budget. a call is reserved before a request
+    # waits for the rate limiter, committed to the cache's count when it is actually sent,
+    # and refunded if it is cancelled before that. every commit is journaled straight away,
+    # so the count survives a crash without ever including requests that weren't sent.
+    # the cache's count only knows about this tool, so once Alma has reported how many calls
+    # the institution has left the budget never goes beyond that either
+    def __init__(self):
+        self.reserved = 0
+        self.committed = 0
+        self.refunded = 0
+        self.institution_remaining = None
+        self.committed_at_report = 0
+
+    def observe_remaining(self, value):
+        # value of the API_REMAINING_HEADER on a response, None when it wasn't sent
+        try:
+            self.institution_remaining = int(value)
+        except (TypeError, ValueError):
+            return
+        self.committed_at_report = self.committed
+
+    def institution_headroom(self):
+        # calls left above the reserve according to the latest report, less the calls sent
+        # since then, or None if Alma hasn't reported it
+        if self.institution_remaining is None:
+            return None
+        return (
+            self.institution_remaining
+            - (self.committed - self.committed_at_report)
+            - INSTITUTION_API_RESERVE
+        )
+
+    def remaining(self):
+        remaining = global_cache.get_remaining_api_calls()
+        headroom = self.institution_headroom()
+        if headroom is not None:
+            remaining = min(remaining, headroom)
+        return max(remaining, 0)
+
+    def available(self):
+        return max(self.remaining() - self.reserved, 0)
+
+    def reserve(self):
+        if self.available() < 1:
+            return False
+        self.reserved += 1
+        return True
+
+    def commit(self):
+        self.reserved -= 1
+        self.committed += 1
+        global_cache.log_api_call()
+        cache_journal.record_api_call()
+
+    def refund(self):
+        self.reserved -= 1
+        self.refunded += 1
+
+    def merge(self, stats, headroom):
+        # adds in the calls of a shard worker process, headroom is the institution headroom
+        # the workers last worked out from Alma's reports
+        self.committed += stats["committed"]
+        self.refunded += stats["refunded"]
+        if headroom is not None:
+            self.institution_remaining = headroom + INSTITUTION_API_RESERVE
+            self.committed_at_report = self.committed
+
+    def threshold_reached(self):
+        # Alma turned a request away because the institution has no calls left today
+        self.observe_remaining(0)
+
+    def new_day(self):
+        # Alma's report is from before the daily reset
+        self.institution_remaining = None
+        self.committed_at_report = self.committed
+
+    def stats(self):
+        return {
+            "committed": self.committed,
+            "refunded": self.refunded,
+            "reserved": self.reserved,
+            "institution_remaining": self.institution_remaining,
+        }
+
+
+api_budget = ApiBudget()
+
+
+class SharedApiBudget(ApiBudget):
+    # the ApiBudget of a shard worker process. calls are reserved from the ShardStore,
+    # so between them the workers never make more calls than the parent process had left
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def observe_remaining(self, value):
+        try:
+            self.institution_remaining = int(value)
+        except (TypeError, ValueError):
+            return
+        self.store.observe_remaining(self.institution_remaining)
+
+    def institution_headroom(self):
+        return self.store.budget()[1]
+
+    def remaining(self):
+        return self.store.budget()[0]
+
+    def available(self):
+        # the store only counts the calls nobody has reserved yet
+        return self.remaining()
+
+    def reserve(self):
+        if not self.store.reserve_call():
+            return False
+        self.reserved += 1
+        return True
+
+    def commit(self):
+        super().commit()
+        self.store.commit_call()
+
+    def refund(self):
+        super().refund()
+        self.store.refund_call()
+
+
+class ApiRequest:
+    # context manager for one API request made through the RateLimiter.
+    # every attempt's status and latency is reported back to the limiter and the run
+    # metrics, and 429/5xx responses and dropped connections are retried with
+    # exponential backoff. the RateLimiter has reserved the first attempt's API call,
+    # each retry reserves its own. the 429 for the daily threshold isn't retried, it
+    # raises ApiBudgetExhausted like running out of the budget does
+    def __init__(self, limiter, method_name, method, args, kwargs):
+        self.limiter = limiter
+        self.method_name = method_name
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.url = str(args[0])
+        self.bytes_sent = len(kwargs.get("data") or b"")
+        self.request = None
+        self.response = None
+        self.attempts = 0
+
+    async def __aenter__(self):
+        attempt = 1
+        while True:
+            self.attempts = attempt
+            self.request = self.method(*self.args, **self.kwargs)
+            api_budget.commit()
+            started = time.monotonic()
+            try:
+                response = await self.request.__aenter__()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.limiter.record_failure()
+                api_metrics.record_connection_error(
+                    self.method_name, self.url, self.bytes_sent
+                )
+                if not self.limiter.should_retry(None, attempt):
+                    raise
+                if not api_budget.reserve():
+                    raise
+                delay = self.limiter.retry_delay(attempt, None)
+            else:
+                latency = time.monotonic() - started
+                api_budget.observe_remaining(response.headers.get(API_REMAINING_HEADER))
+                self.limiter.record_response(response.status, latency)
+                api_metrics.record_response(
+                    self.method_name,
+                    self.url,
+                    response.status,
+                    latency,
+                    self.bytes_sent,
+                )
+                if response.status == 429 and await daily_threshold_reached(response):
+                    # nothing more gets through today, stop like the budget had run out
+                    api_budget.threshold_reached()
+                    api_metrics.record_bytes_received(
+                        self.method_name, self.url, response.content_length or 0
+                    )
+                    await self.request.__aexit__(None, None, None)
+                    raise ApiBudgetExhausted()
+                if (
+                    not self.limiter.should_retry(response.status, attempt)
+                    or not api_budget.reserve()
+                ):
+                    self.response = response
+                    return response
+                delay = self.limiter.retry_delay(
+                    attempt, response.headers.get("Retry-After")
+                )
+                api_metrics.record_bytes_received(
+                    self.method_name, self.url, response.content_length or 0
+                )
+                await self.request.__aexit__(None, None, None)
+
+            await self.limiter.wait_to_retry(delay)
+            attempt += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.response is not None:
+            api_metrics.record_bytes_received(
+                self.method_name, self.url, self.response.content.total_bytes
+            )
+        return await self.request.__aexit__(exc_type, exc, tb)
+
+
+async def daily_threshold_reached(response):
+    # Alma answers 429 both for too many requests in a second and once the daily threshold
+    # is used up, the remaining header or the error code in the body tell them apart
+    try:
+        if int(response.headers.get(API_REMAINING_HEADER)) <= 0:
+            return True
+    except (TypeError, ValueError):
+        pass
+    try:
+        body = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return False
+    return DAILY_THRESHOLD_ERROR.encode() in body
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+class HttpTransport:
+    # the aiohttp session every request goes through. the connection pool holds as many
+    # connections as AdaptiveConcurrency ever lets requests run at once and keeps them open
+    # between requests, DNS lookups are cached, the timeouts stop a hung connection holding
+    # a request slot, and responses are compressed. new and reused connections are counted
+    # for the metrics
+    POOL_SIZE = AdaptiveConcurrency.MAX_LIMIT
+    KEEPALIVE_TIMEOUT = 60
+    DNS_CACHE_TTL = 300
+    # secs allowed for a whole request, for opening a connection and between reads
+    TOTAL_TIMEOUT = 120
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 60
+    COMPRESSION = True
+
+    def __init__(self):
+        self.client = None
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.pool_waits = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.POOL_SIZE,
+            limit_per_host=self.POOL_SIZE,
+            keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=self.DNS_CACHE_TTL,
+        )
+        # sock_connect rather than connect, which would also count the wait for the pool
+        timeout = aiohttp.ClientTimeout(
+            total=self.TOTAL_TIMEOUT,
+            sock_connect=self.CONNECT_TIMEOUT,
+            sock_read=self.READ_TIMEOUT,
+        )
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.on_connection_opened)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reused)
+        trace_config.on_connection_queued_start.append(self.on_pool_wait)
+        trace_config.on_dns_cache_hit.append(self.on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(self.on_dns_cache_miss)
+        self.client = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={
+                "Accept-Encoding": "gzip, deflate" if self.COMPRESSION else "identity"
+            },
+            trace_configs=[trace_config],
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.client.close()
+
+    async def on_connection_opened(self, client, trace_config_ctx, params):
+        self.connections_opened += 1
+
+    async def on_connection_reused(self, client, trace_config_ctx, params):
+        self.connections_reused += 1
+
+    async def on_pool_wait(self, client, trace_config_ctx, params):
+        self.pool_waits += 1
+
+    async def on_dns_cache_hit(self, client, trace_config_ctx, params):
+        self.dns_cache_hits += 1
+
+    async def on_dns_cache_miss(self, client, trace_config_ctx, params):
+        self.dns_cache_misses += 1
+
+    def merge(self, stats):
+        # adds in the connections of a shard worker process
+        self.connections_opened += stats["connections_opened"]
+        self.connections_reused += stats["connections_reused"]
+        self.pool_waits += stats["pool_waits"]
+        self.dns_cache_hits += stats["dns_cache_hits"]
+        self.dns_cache_misses += stats["dns_cache_misses"]
+
+    def stats(self):
+        connections = self.connections_opened + self.connections_reused
+        return {
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+            "reuse_ratio": (
+                self.connections_reused / connections if connections else 0.0
+            ),
+            "pool_waits": self.pool_waits,
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
         }
-        return json.dumps(obj)
 
 
 class RateLimiter:
     RATE = 25
     MAX_TOKENS = 25
-
-    def __init__(self, client):
-        self.client = client
+    # slowest rate when the institution's threshold is nearly used up
+    MIN_RATE = 1
+    # attempts allowed per response status, None is for dropped connections and timeouts
+    RETRY_ATTEMPTS = {
+        429: 6,
+        500: 3,
+        502: 4,
+        503: 4,
+        504: 4,
+        None: 4,
+    }
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 60.0
+
+    def __init__(self, transport, concurrency=None):
+        self.transport = transport
+        self.client = transport.client
+        if concurrency is None:
+            concurrency = AdaptiveConcurrency()
+        self.concurrency = concurrency
         self.tokens = self.MAX_TOKENS
         self.updated_at = time.monotonic()
+        self.tokens_granted = 0
+        self.total_wait = 0.0
+        self.first_granted_at = None
+        self.last_granted_at = None
+        self.retries = 0
+
+    async def get(self, *args, **kwargs):
+        await self.reserve_call()
+        return ApiRequest(self, "GET", self.client.get, args, kwargs)
+
+    async def put(self, *args, **kwargs):
+        await self.reserve_call()
+        return ApiRequest(self, "PUT", self.client.put, args, kwargs)
+
+    async def reserve_call(self):
+        if not api_budget.reserve():
+            raise ApiBudgetExhausted()
+        try:
+            await self.wait_for_token()
+        except asyncio.CancelledError:
+            api_budget.refund()
+            raise
+
+    def should_retry(self, status, attempt):
+        # retries also need a call reserved from the daily budget, see ApiRequest
+        if status not in self.RETRY_ATTEMPTS:
+            return False
+        return attempt < self.RETRY_ATTEMPTS[status]
+
+    def retry_delay(self, attempt, retry_after):
+        # full jitter, so requests that failed together don't all retry together
+        delay = random.uniform(
+            0, min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** (attempt - 1))
+        )
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.RETRY_MAX_DELAY))
+        return delay
+
+    async def wait_to_retry(self, delay):
+        self.retries += 1
+        try:
+            await asyncio.sleep(delay)
+            await self.wait_for_token()
+        except asyncio.CancelledError:
+            api_budget.refund()
+            raise
+
+    def record_response(self, status, latency):
+        self.concurrency.record_response(status, latency)
+
+    def record_failure(self):
+        self.concurrency.record_failure()
+
+    async def wait_for_token(self):
+        # reserve the next token straight away. the bucket is allowed to go negative,
+        # which queues callers in the order they arrive, and each caller sleeps once
+        # until the moment its own token is refilled instead of polling
+        wait = await self.schedule_token()
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # give the reservation back so later callers aren't held up by it
+                self.return_token()
+                raise
+
+        granted_at = time.monotonic()
+        if self.first_granted_at is None:
+            self.first_granted_at = granted_at
+        self.last_granted_at = granted_at
+        self.tokens_granted += 1
+        self.total_wait += wait
+        api_metrics.rate_limit_wait.observe(wait)
+
+    async def schedule_token(self):
+        return self.take_token()
+
+    def take_token(self):
+        # returns the secs until the token is refilled
+        self.add_new_tokens()
+        self.tokens -= 1
+        if self.tokens < 0:
+            return -self.tokens / self.rate()
+        return 0.0
+
+    def return_token(self):
+        self.tokens += 1
+
+    def rate(self):
+        # slow down as the institution's threshold runs low, so the calls left over are
+        # spread out rather than used up before the other systems get to them
+        headroom = api_budget.institution_headroom()
+        if headroom is None or headroom >= SLOWDOWN_HEADROOM:
+            return self.RATE
+        return max(self.RATE * headroom / SLOWDOWN_HEADROOM, self.MIN_RATE)
+
+    def add_new_tokens(self):
+        now = time.monotonic()
+        time_since_update = now - self.updated_at
+        self.tokens = min(
+            self.tokens + time_since_update * self.rate(), self.MAX_TOKENS
+        )
+        self.updated_at = now
+
+    def merge(self, stats, started, finished):
+        # adds in the requests of a shard worker process, which were made between
+        # started and finished by this process's clock
+        self.tokens_granted += stats["requests"]
+        self.retries += stats["retries"]
+        self.total_wait += stats["total_wait"]
+        if self.first_granted_at is None or started < self.first_granted_at:
+            self.first_granted_at = started
+        if self.last_granted_at is None or finished > self.last_granted_at:
+            self.last_granted_at = finished
+
+    def stats(self):
+        elapsed = 0.0
+        if self.first_granted_at is not None:
+            elapsed = self.last_granted_at - self.first_granted_at
+        return {
+            "requests": self.tokens_granted,
+            "retries": self.retries,
+            "achieved_rate": (self.tokens_granted - 1) / elapsed if elapsed else 0.0,
+            "total_wait": self.total_wait,
+            "average_wait": (
+                self.total_wait / self.tokens_granted if self.tokens_granted else 0.0
+            ),
+        }
+
+
+class SharedRateLimiter(RateLimiter):
+    # the RateLimiter of a shard worker process, the tokens come from the ShardStore's
+    # bucket so the workers between them keep to the rate. taking a token can wait for
+    # another worker's write lock, so the bucket is used from a thread of its own with
+    # its own connection and the event loop carries on in the meantime
+    def __init__(self, transport, store, concurrency=None):
+        super().__init__(transport, concurrency)
+        self.RATE, self.MAX_TOKENS = store.bucket_settings()
+        self.bucket = ShardStore(store.path)
+        self.bucket_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def schedule_token(self):
+        taken = self.bucket_thread.submit(self.bucket.take_token, self.rate())
+        try:
+            return await asyncio.wrap_future(taken)
+        except asyncio.CancelledError:
+            # the token was taken unless the thread hadn't got to it yet
+            if not taken.cancel():
+                self.return_token()
+            raise
+
+    def return_token(self):
+        self.bucket_thread.submit(self.bucket.return_token)
+
+    def close(self):
+        self.bucket_thread.shutdown()
+        self.bucket.close()
+
+
+def time_convert(sec):
+    mins = sec // 60
+    sec = sec % 60
+    hours = mins // 60
+    mins = mins % 60
+    return " {:02d} hrs: {:02d} mins: {:02d} secs.".format(
+        int(hours), int(mins), int(sec)
+    )
+
+
+class ProgressReporter:
+    # one aggregate status line for the requests being made, redrawn at most every
+    # PROGRESS_INTERVAL secs instead of printing a line for every response.
+    # in a batch the names are prefixed with the collection ID of the current run
+    def __init__(self):
+        self.tasks = {}
+        self.started = None
+        self.last_render = 0.0
+        self.line_length = 0
+
+    def start(self, name, total):
+        if not self.tasks:
+            self.started = time.monotonic()
+        self.tasks[collection_run().progress_name(name)] = {
+            "total": total,
+            "done": 0,
+            "failed": 0,
+            "run": collection_run(),
+        }
+
+    def grow(self, name, count=1):
+        # for sets of requests whose size is only known as they go,
+        # a negative count drops requests that won't be made after all
+        self.tasks[collection_run().progress_name(name)]["total"] += count
+
+    def advance(self, name):
+        self.tasks[collection_run().progress_name(name)]["done"] += 1
+        self.render()
+
+    def update(self, name, total, done, failed):
+        # for sets of requests that other processes are making
+        self.tasks[collection_run().progress_name(name)].update(
+            total=total, done=done, failed=failed
+        )
+        self.render()
+
+    def fail(self, name):
+        self.tasks[collection_run().progress_name(name)]["failed"] += 1
+        self.render()
+
+    def message(self, text):
+        # printed on its own line rather than into the middle of the status line
+        self.clear_line()
+        print(text)
+
+    def finish(self):
+        # ends the current run's sets of requests, their final status is printed
+        # even in quiet mode
+        run = collection_run()
+        finished_tasks = {
+            name: task for name, task in self.tasks.items() if task["run"] is run
+        }
+        if not finished_tasks:
+            return
+        line = self.status(finished_tasks)
+        if self.line_length:
+            sys.stdout.write("\r" + line.ljust(self.line_length) + "\n")
+            sys.stdout.flush()
+        else:
+            print(line)
+        for name in finished_tasks:
+            del self.tasks[name]
+        self.line_length = 0
+
+    def status(self, tasks=None):
+        if tasks is None:
+            tasks = self.tasks
+        finished = sum(task["done"] + task["failed"] for task in tasks.values())
+        total = sum(task["total"] for task in tasks.values())
+        failed = sum(task["failed"] for task in tasks.values())
+        elapsed = time.monotonic() - self.started
+        rate = finished / elapsed if elapsed else 0.0
+
+        parts = []
+        for name, task in tasks.items():
+            task_finished = task["done"] + task["failed"]
+            percent = (
+                round(task_finished / task["total"] * 100) if task["total"] else 100
+            )
+            parts.append(f"{name} {percent}% {task_finished}/{task['total']}")
+        parts.append(f"{rate:.1f} requests/sec")
+        if finished < total and rate:
+            parts.append(f"ETA{time_convert((total - finished) / rate)}")
+        else:
+            parts.append(f"took{time_convert(elapsed)}")
+        parts.append(f"{failed} errors")
+        parts.append(f"{api_budget.remaining()} API calls left today")
+        return " | ".join(parts)
+
+    def render(self):
+        now = time.monotonic()
+        terminal = sys.stdout.isatty()
+        interval = PROGRESS_INTERVAL if terminal else PROGRESS_LOG_INTERVAL
+        if quiet or now - self.last_render < interval:
+            return
+        self.last_render = now
+
+        line = self.status()
+        if terminal:
+            sys.stdout.write("\r" + line.ljust(self.line_length))
+            sys.stdout.flush()
+            self.line_length = len(line)
+        else:
+            print(line)
+
+    def clear_line(self):
+        if self.line_length:
+            sys.stdout.write("\r" + " " * self.line_length + "\r")
+            self.line_length = 0
+
+
+progress = ProgressReporter()
+
+
+class ShardProgress(ProgressReporter):
+    # the progress of a shard worker process, written to the ShardStore at most every
+    # PROGRESS_INTERVAL secs for the parent process to show instead of being printed
+    def __init__(self, store, shard):
+        super().__init__()
+        self.store = store
+        self.shard = shard
+
+    def render(self):
+        now = time.monotonic()
+        if now - self.last_render < PROGRESS_INTERVAL:
+            return
+        self.last_render = now
+        self.save()
+
+    def finish(self):
+        self.save()
+        self.tasks = {}
+
+    def save(self):
+        tasks = self.tasks.values()
+        self.store.set_progress(
+            self.shard,
+            sum(task["total"] for task in tasks),
+            sum(task["done"] for task in tasks),
+            sum(task["failed"] for task in tasks),
+        )
+
+
+def print_port_details(portfolio):
+    print(portfolio["id"])
+    print(portfolio["public_access_model"]["value"])
+    print(portfolio["public_access_model"]["desc"])
+    print("\n")
+
+
+def add_to_error_log(custom_error_string, status_code, now):
+
+    custom_error_string = (
+        f"{custom_error_string} after{time_convert(now)} elapsed"
+        if status_code == ""
+        else f"{custom_error_string} with error code: {status_code} after{time_convert(now)} elapsed"
+    )
+
+    collection_run().errors.append(custom_error_string)
+
+
+def add_to_failure_ledger(portfolio_id, operation, status_code, request):
+    # failed portfolio GETs/PUTs are kept in the cache, so the retry_failed mode can
+    # re-issue just those requests. status_code is None when the connection dropped
+    attempts = request.attempts if request is not None else 0
+    previous = global_cache.get_failed_request(portfolio_id)
+    if previous is not None:
+        attempts += previous["attempts"]
+    failure = {
+        "id": portfolio_id,
+        "operation": operation,
+        "status_code": status_code,
+        "attempts": attempts,
+        "failed_at": datetime.datetime.now().astimezone().isoformat(),
+    }
+    global_cache.add_failed_request(failure)
+    cache_journal.record_failed(failure)
+
+
+def port_log_format(port, count, total):
+    # port is a PortfolioSummary
+    if port.has_pam_description:
+        desc = str(port.pam_description)
+    else:
+        desc = " "
+
+    log_lines = (
+        str(count)
+        + "/"
+        + str(total)
+        + "\n"
+        + "Title: "
+        + port.title
+        + "\n"
+        + "MMS ID: "
+        + port.mms_id
+        + "\n"
+        + "Public Access Model: "
+        + str(port.pam_value + "; ")
+        + " Description: "
+        + desc
+        + "\n"
+        + "Portfolio ID: "
+        + port.id
+        + ("\n" * 2)
+    )
+
+    return log_lines
+
+
+class CacheJournal:
+    # append-only log of API results that haven't been saved to the cache database yet.
+    # each successful GET/PUT is written and flushed as soon as it completes, so if a run
+    # crashes or is killed the next start can replay it instead of spending the calls again
+    def __init__(self, path=CACHE_JOURNAL):
+        self.path = path
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, "ab")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, entry):
+        if self.file is None:
+            return
+        entry["collection_id"] = collection_run().collection_id
+        entry["time"] = time.time()
+        self.file.write(serializer.dumps(entry) + b"\n")
+        self.file.flush()
+
+    def record_overview(self, overview, complete, removed_ids):
+        self.write(
+            {
+                "op": "overview",
+                "complete": complete,
+                "removed": removed_ids,
+                "data": overview,
+            }
+        )
+
+    def record_retrieved(self, portfolio, prepared="collection"):
+        # prepared is what the caller does with the collection's prepared portfolios:
+        # "collection" clears all of them like get_portfolios, "portfolio" only this
+        # portfolio's like the pipelined update, and None keeps them like retry_failed
+        self.write({"op": "retrieved", "prepared": prepared, "data": portfolio})
+
+    def record_updated(self, portfolio):
+        self.write({"op": "updated", "data": portfolio})
+
+    def record_failed(self, failure):
+        self.write({"op": "failed", "data": failure})
+
+    def record_api_call(self):
+        # written as each request is sent, whether or not it gets an answer
+        self.write({"op": "api_call", "api_calls": 1, "data": None})
+
+    def entries(self):
+        try:
+            with open(self.path, "rb") as journal:
+                for line in journal:
+                    try:
+                        yield serializer.loads(line)
+                    except ValueError:
+                        # the last line can be cut off if the run was killed mid-write
+                        return
+        except OSError:
+            return
+
+    def replay(self, cache):
+        # apply the journal to the cache the same way the run would have,
+        # returns the number of entries replayed
+        replayed = 0
+        api_calls = 0
+        last_time = None
+        refetched_collections = set()
+        for entry in self.entries():
+            collection_id = entry["collection_id"]
+            record = entry["data"]
+            if entry["op"] == "overview":
+                for portfolio_id in entry["removed"]:
+                    for section in cache.sections().values():
+                        section.remove(collection_id, portfolio_id)
+                if entry["complete"]:
+                    cache.collection_overviews.remove_collection(collection_id)
+                cache.collection_overviews.add(collection_id, record, entry["time"])
+
+            elif entry["op"] == "retrieved":
+                # newly retrieved portfolios invalidate the prepared sections the same way
+                # they did in the run, see record_retrieved. older journals don't say and
+                # always came from get_portfolios
+                prepared = entry.get("prepared", "collection")
+                if prepared == "collection":
+                    if collection_id not in refetched_collections:
+                        refetched_collections.add(collection_id)
+                        cache.portfolios_updated.remove_collection(collection_id)
+                        cache.portfolios_ready_to_update.remove_collection(
+                            collection_id
+                        )
+                        cache.portfolios_not_updating.remove_collection(collection_id)
+                elif prepared == "portfolio":
+                    cache.portfolios_updated.remove(collection_id, record["id"])
+                    cache.portfolios_ready_to_update.remove(collection_id, record["id"])
+                    cache.portfolios_not_updating.remove(collection_id, record["id"])
+                cache.portfolios_retrieved.add(collection_id, [record], entry["time"])
+                cache.failed_requests.remove(collection_id, record["id"])
+
+            elif entry["op"] == "updated":
+                cache.portfolios_updated.add(collection_id, [record], entry["time"])
+                cache.portfolios_ready_to_update.remove(collection_id, record["id"])
+                cache.portfolios_retrieved.replace_record(collection_id, record)
+                cache.failed_requests.remove(collection_id, record["id"])
+
+            elif entry["op"] == "failed":
+                cache.failed_requests.add(collection_id, [record], entry["time"])
+
+            # journals from older versions counted the calls on the other entries
+            api_calls += entry.get("api_calls", 0)
+            last_time = entry["time"]
+            replayed += 1
+
+        if api_calls:
+            cache.api_calls_logged.append(
+                {
+                    "count": api_calls,
+                    "time": datetime.datetime.fromtimestamp(last_time)
+                    .astimezone()
+                    .isoformat(),
+                }
+            )
+            cache.sum_api_calls()
+        return replayed
+
+    def clear(self):
+        reopen = self.file is not None
+        self.close()
+        open(self.path, "w").close()
+        if reopen:
+            self.open()
+
+
+def shard_journal_path(shard):
+    return f"{CACHE_JOURNAL}.shard-{shard}"
+
+
+def shard_journal_paths():
+    return sorted(glob.glob(glob.escape(CACHE_JOURNAL) + ".shard-*"))
+
+
+def shard_store_paths():
+    # the ShardStore database and the files sqlite keeps next to it in WAL mode
+    return [
+        path
+        for path in (SHARD_STORE, SHARD_STORE + "-wal", SHARD_STORE + "-shm")
+        if os.path.exists(path)
+    ]
+
+
+class ShardStore:
+    # sqlite file the shard worker processes share the rate limit and the API budget
+    # through, and report their progress in. the token bucket works the same way as
+    # RateLimiter's but with the wall clock, since the processes don't share a monotonic
+    # one. the budget starts as the calls the parent process had available and comes
+    # down further if Alma reports the institution has fewer left, like ApiBudget
+    def __init__(self, path=SHARD_STORE):
+        self.path = path
+        # the workers wait for each other's writes rather than failing. a connection is
+        # only ever used by one thread at a time, but not always the one that opened it,
+        # see SharedRateLimiter
+        self.connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # takes the write lock straight away, so two workers can't both read the bucket
+        # before either has written it back
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def create(self, rate, max_tokens, budget, headroom, shard_sizes):
+        with self.transaction():
+            for table in ("bucket", "budget", "progress"):
+                self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self.connection.execute(
+                "CREATE TABLE bucket ("
+                " rate REAL NOT NULL,"
+                " max_tokens REAL NOT NULL,"
+                " tokens REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "INSERT INTO bucket VALUES (?, ?, ?, ?)",
+                (rate, max_tokens, max_tokens, time.time()),
+            )
+            # remaining is the calls nobody has reserved, outstanding the ones reserved
+            # but not sent yet and headroom is ApiBudget.institution_headroom
+            self.connection.execute(
+                "CREATE TABLE budget ("
+                " remaining INTEGER NOT NULL,"
+                " outstanding INTEGER NOT NULL,"
+                " headroom INTEGER)"
+            )
+            self.connection.execute(
+                "INSERT INTO budget VALUES (?, 0, ?)", (budget, headroom)
+            )
+            self.connection.execute(
+                "CREATE TABLE progress ("
+                " shard INTEGER PRIMARY KEY,"
+                " total INTEGER NOT NULL,"
+                " done INTEGER NOT NULL,"
+                " failed INTEGER NOT NULL)"
+            )
+            self.connection.executemany(
+                "INSERT INTO progress VALUES (?, ?, 0, 0)", enumerate(shard_sizes)
+            )
+
+    def bucket_settings(self):
+        return self.connection.execute("SELECT rate, max_tokens FROM bucket").fetchone()
+
+    def take_token(self, rate):
+        # returns the secs until the token is refilled, see RateLimiter.wait_for_token
+        with self.transaction():
+            max_tokens, tokens, updated_at = self.connection.execute(
+                "SELECT max_tokens, tokens, updated_at FROM bucket"
+            ).fetchone()
+            now = max(time.time(), updated_at)
+            tokens = min(tokens + (now - updated_at) * rate, max_tokens) - 1
+            self.connection.execute(
+                "UPDATE bucket SET tokens = ?, updated_at = ?", (tokens, now)
+            )
+        if tokens < 0:
+            return -tokens / rate
+        return 0.0
+
+    def return_token(self):
+        self.connection.execute("UPDATE bucket SET tokens = tokens + 1")
+
+    def budget(self):
+        # the calls nobody has reserved yet and the institution headroom
+        return self.connection.execute(
+            "SELECT remaining, headroom FROM budget"
+        ).fetchone()
+
+    def reserve_call(self):
+        cursor = self.connection.execute(
+            "UPDATE budget SET remaining = remaining - 1, outstanding = outstanding + 1"
+            " WHERE remaining > 0"
+        )
+        return cursor.rowcount == 1
+
+    def commit_call(self):
+        # the headroom stays NULL until Alma has reported it
+        self.connection.execute(
+            "UPDATE budget SET outstanding = outstanding - 1, headroom = headroom - 1"
+        )
+
+    def refund_call(self):
+        self.connection.execute(
+            "UPDATE budget SET remaining = remaining + 1, outstanding = outstanding - 1"
+        )
+
+    def observe_remaining(self, institution_remaining):
+        headroom = institution_remaining - INSTITUTION_API_RESERVE
+        self.connection.execute(
+            "UPDATE budget SET headroom = ?,"
+            " remaining = MAX(MIN(remaining, ? - outstanding), 0)",
+            (headroom, headroom),
+        )
+
+    def set_progress(self, shard, total, done, failed):
+        self.connection.execute(
+            "UPDATE progress SET total = ?, done = ?, failed = ? WHERE shard = ?",
+            (total, done, failed, shard),
+        )
+
+    def progress(self):
+        return self.connection.execute(
+            "SELECT SUM(total), SUM(done), SUM(failed) FROM progress"
+        ).fetchone()
+
+    def close(self):
+        self.connection.close()
+
+
+def migrate_legacy_cache():
+    # one time import of the old single file cache into the cache database
+    print(f"Migrating {LEGACY_CACHE_FILE} to {CACHE_DB}...")
+    try:
+        with open(LEGACY_CACHE_FILE, "rb") as cache:
+            legacy_cache = Cache(serializer.loads(cache.read()))
+    except Exception as error:
+        print(f"Could not read {LEGACY_CACHE_FILE}, starting a new cache: {error}")
+        return
+
+    cache_store.save(legacy_cache)
+    os.replace(LEGACY_CACHE_FILE, LEGACY_CACHE_FILE + ".migrated")
+    print("Migration complete.")
+
+
+def load_cache():
+    print("Loading cache...")
+    global global_cache, cache_store, cache_journal
+    needs_migration = not os.path.exists(CACHE_DB) and os.path.exists(LEGACY_CACHE_FILE)
+    cache_store = CacheStore(CACHE_DB)
+    if needs_migration:
+        migrate_legacy_cache()
+
+    global_cache = cache_store.load([run.collection_id for run in collection_runs])
+    cache_journal = CacheJournal(CACHE_JOURNAL)
+    replayed = cache_journal.replay(global_cache)
+    # left behind if the tool stopped before it merged a sharded run's results
+    for path in shard_journal_paths():
+        replayed += CacheJournal(path).replay(global_cache)
+    if replayed:
+        print(f"Recovered {replayed} API results from an unfinished run.")
+        save_cache()
+    cache_journal.open()
+    print("Cache loaded.")
+    return
+
+
+def save_cache():
+    cache_store.save(global_cache)
+    # everything in the journal is in the database now. the shard workers' journals are
+    # always replayed into the cache before it's saved, see sharded_requests.
+    # the workers' shared store is only needed while they run
+    cache_journal.clear()
+    for path in shard_journal_paths() + shard_store_paths():
+        os.remove(path)
+    return
+
+
+EXPORT_FIELDS = ["portfolio_id", "mms_id", "title", "pam_value", "pam_description"]
 
-    async def get(self, *args, **kwargs):
-        await self.wait_for_token()
-        return self.client.get(*args, **kwargs)
 
-    async def put(self, *args, **kwargs):
-        await self.wait_for_token()
-        return self.client.put(*args, **kwargs)
+def port_export_record(port):
+    return {
+        "portfolio_id": port.id,
+        "mms_id": port.mms_id,
+        "title": port.title,
+        "pam_value": port.pam_value,
+        "pam_description": (
+            "" if port.pam_description is None else port.pam_description
+        ),
+    }
 
-    async def wait_for_token(self):
-        while self.tokens < 1:
-            self.add_new_tokens()
-            await asyncio.sleep(0.1)
-        self.tokens -= 1
 
-    def add_new_tokens(self):
-        now = time.monotonic()
-        time_since_update = now - self.updated_at
-        new_tokens = time_since_update * self.RATE
-        if self.tokens + new_tokens >= 1:
-            self.tokens = min(self.tokens + new_tokens, self.MAX_TOKENS)
-            self.updated_at = now
+class JsonlExporter:
+    extension = "jsonl"
 
+    def __init__(self, path):
+        self.file = open(path, "wb")
 
-def time_convert(sec):
-    mins = sec // 60
-    sec = sec % 60
-    hours = mins // 60
-    mins = mins % 60
-    return " {:02d} hrs: {:02d} mins: {:02d} secs.".format(
-        int(hours), int(mins), int(sec)
-    )
+    def write(self, record):
+        self.file.write(serializer.dumps(record) + b"\n")
 
+    def close(self):
+        self.file.close()
 
-def print_port_details(portfolio):
-    print(portfolio["id"])
-    print(portfolio["public_access_model"]["value"])
-    print(portfolio["public_access_model"]["desc"])
-    print("\n")
 
+class CsvExporter:
+    extension = "csv"
 
-def clean_port_list(port):
-    if port is None:
-        return False
-    else:
-        return True
+    def __init__(self, path):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=EXPORT_FIELDS)
+        self.writer.writeheader()
 
+    def write(self, record):
+        self.writer.writerow(record)
 
-def add_to_error_log(custom_error_string, status_code, now):
+    def close(self):
+        self.file.close()
 
-    custom_error_string = (
-        f"{custom_error_string} after{time_convert(now)} elapsed"
-        if status_code == ""
-        else f"{custom_error_string} with error code: {status_code} after{time_convert(now)} elapsed"
-    )
 
-    errors.append(custom_error_string)
+class ParquetExporter:
+    # rows are collected into column batches and written a row group at a time
+    extension = "parquet"
+    BATCH_SIZE = 10000
 
+    def __init__(self, path):
+        self.schema = pyarrow.schema(
+            [(field, pyarrow.string()) for field in EXPORT_FIELDS]
+        )
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.batch = {field: [] for field in EXPORT_FIELDS}
+        self.batch_length = 0
+
+    def write(self, record):
+        for field in EXPORT_FIELDS:
+            self.batch[field].append(record[field])
+        self.batch_length += 1
+        if self.batch_length >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch_length == 0:
+            return
+        self.writer.write_batch(
+            pyarrow.RecordBatch.from_pydict(self.batch, schema=self.schema)
+        )
+        self.batch = {field: [] for field in EXPORT_FIELDS}
+        self.batch_length = 0
 
-def port_log_format(port, count, total):
-    if "desc" in port["public_access_model"]:
-        desc = str(port["public_access_model"]["desc"])
-    else:
-        desc = " "
+    def close(self):
+        self.flush()
+        self.writer.close()
 
-    log_lines = (
-        str(count)
-        + "/"
-        + str(total)
-        + "\n"
-        + "Title: "
-        + port["resource_metadata"]["title"]
-        + "\n"
-        + "MMS ID: "
-        + port["resource_metadata"]["mms_id"]["value"]
-        + "\n"
-        + "Public Access Model: "
-        + str(port["public_access_model"]["value"] + "; ")
-        + " Description: "
-        + desc
-        + "\n"
-        + "Portfolio ID: "
-        + port["id"]
-        + ("\n" * 2)
-    )
 
-    return log_lines
+EXPORTERS = {
+    "jsonl": JsonlExporter,
+    "csv": CsvExporter,
+    "parquet": ParquetExporter,
+}
 
 
-def load_cache():
-    print("Loading cache...")
-    global global_cache
-    try:
-        with open("cache.json", "r") as cache:
-            rawcache = cache.read()
-    except OSError:
-        global_cache = Cache()
+def save_review_exports():
+    # every requested format is written in the same pass over the reviewed portfolios
+    timestamp = time.strftime("%Y-%m-%d-%H_%M", time.localtime())
+    exporters = []
+    for export_format in review_export_formats:
+        if export_format not in EXPORTERS:
+            print(f"Unknown review export format: {export_format}")
+            continue
+        if export_format == "parquet" and pyarrow is None:
+            print("Skipping the parquet export, the pyarrow module is not installed")
+            continue
+        exporter = EXPORTERS[export_format]
+        exporters.append(
+            exporter(
+                f"{collection_run().file_name('port_export', timestamp)}.{exporter.extension}"
+            )
+        )
 
     try:
-        cache = json.loads(rawcache)
-        global_cache = Cache(cache)
-    except Exception:
-        global_cache = Cache()
-    print("Cache loaded.")
-    return
+        for port in collection_run().review_log_data["reviewed_portfolios"]:
+            record = port_export_record(port)
+            for exporter in exporters:
+                exporter.write(record)
+    finally:
+        for exporter in exporters:
+            exporter.close()
 
 
-def save_cache():
-    with codecs.open("cache.json", "w", "utf-8") as cache:
-        cache.write(global_cache.json())
-    return
+def save_metrics(session):
+    timestamp = time.strftime("%Y-%m-%d-%H_%M", time.localtime())
+    run_time = time.monotonic() - START
+    limiter_stats = session.stats()
+
+    metrics = api_metrics.as_dict()
+    metrics["mode"] = mode
+    metrics["collection_id"] = ", ".join(run.collection_id for run in collection_runs)
+    metrics["run_seconds"] = run_time
+    metrics["rate_limiter"] = limiter_stats
+    metrics["concurrency_limit"] = session.concurrency.limit
+    metrics["api_calls_past_24_hrs"] = global_cache.total_api_calls_past_24_hrs
+    metrics["api_budget"] = api_budget.stats()
+    metrics["transport"] = session.transport.stats()
+    with open(f"{mode}_metrics-{timestamp}.json", "wb") as metrics_file:
+        metrics_file.write(serializer.dumps(metrics))
+
+    gauges = {
+        "run_duration_seconds": (run_time, "Length of the last run."),
+        "last_run_timestamp_seconds": (time.time(), "When the last run ended."),
+        "achieved_request_rate": (
+            limiter_stats["achieved_rate"],
+            "Requests per second the rate limiter let through.",
+        ),
+        "concurrency_limit": (
+            session.concurrency.limit,
+            "Adaptive concurrency limit at the end of the run.",
+        ),
+        "api_calls_past_24_hrs": (
+            global_cache.total_api_calls_past_24_hrs,
+            "API calls logged since midnight UTC.",
+        ),
+        "connections_opened": (
+            session.transport.connections_opened,
+            "Connections opened to the API during the last run.",
+        ),
+        "connection_reuse_ratio": (
+            session.transport.stats()["reuse_ratio"],
+            "Share of the last run's requests sent on an already open connection.",
+        ),
+    }
+    if api_budget.institution_remaining is not None:
+        gauges["institution_api_calls_remaining"] = (
+            api_budget.institution_remaining,
+            "API calls Alma last reported the institution has left today.",
+        )
+    prometheus_text = api_metrics.prometheus_text(gauges)
+    # written to a temporary file and renamed so the collector never reads half a file
+    with open(METRICS_TEXTFILE + ".tmp", "w") as prometheus_file:
+        prometheus_file.write(prometheus_text)
+    os.replace(METRICS_TEXTFILE + ".tmp", METRICS_TEXTFILE)
 
 
 def save_error_log():
     timestamp = time.strftime("%Y-%m-%d-%H_%M", time.localtime())
+    errors = collection_run().errors
 
-    name = f"{mode}_error_log-{timestamp}.txt"
+    name = collection_run().file_name("error_log", timestamp) + ".txt"
 
     if errors == []:
         errors.append("No errors this time")
@@ -570,153 +2757,161 @@ def save_error_log():
             e.write(error + "\n")
 
 
+def write_port_log_entries(log_file, ports):
+    total = len(ports)
+    for count, port in enumerate(ports, start=1):
+        log_file.write(port_log_format(port, count, total))
+
+
 def save_port_log():
+    # the header is built first and each section is then written straight to the file,
+    # rather than building the whole report as one string
     now = time.monotonic() - START
     timestamp = time.strftime("%Y-%m-%d-%H_%M", time.localtime())
-
-    log = ""
-    if mode == "review":
-        name = f"review_port_log-{timestamp}.txt"
-        num_portfolios_reviewed = len(review_log_data["reviewed_portfolios"])
-        list_of_pam_types = list(review_log_data["pam_types"])
-        detailed_log = ""
-        if review_log_data["api_limit_reached"]:
+    run = collection_run()
+    name = run.file_name("port_log", timestamp) + ".txt"
+    # the run can stop before the portfolios are retrieved or updated
+    port_fetch_time = run.portfolios_time if run.portfolios_time is not None else now
+
+    if run.mode == "review":
+        num_portfolios_reviewed = len(run.review_log_data["reviewed_portfolios"])
+        if run.review_log_data["api_limit_reached"]:
             api_limit_reached = "\n API limit prevented finishing the review. \n"
         else:
             api_limit_reached = ""
 
-        list_of_pams_log_header = "Following PAMS found in collected portfolios:\n"
-
-        for pam in list_of_pam_types:
-            temp_list = []
-
-            detailed_log += f"\n{'-'*20} Portfolios with a PAM that is {'blank' if pam == '' else pam } {'-'*20}\n\n"
-            for port in review_log_data["reviewed_portfolios"]:
-                if port["public_access_model"]["value"] == pam:
-                    temp_list.append(port)
+        # group the portfolios by PAM in a single pass, keeping the order of the PAM types
+        ports_by_pam = {pam: [] for pam in run.review_log_data["pam_types"]}
+        for port in run.review_log_data["reviewed_portfolios"]:
+            pam_ports = ports_by_pam.get(port.pam_value)
+            if pam_ports is not None:
+                pam_ports.append(port)
 
-            total = len(temp_list)
-
-            for count, port in enumerate(temp_list, start=1):
-                port_log = port_log_format(port, count, total)
-                detailed_log += port_log
-
-            list_of_pams_log_header += f"{'blank' if pam == '' else pam }: {total}\n"
+        list_of_pams_log_header = "Following PAMS found in collected portfolios:\n"
+        sections = []
+        for pam, pam_ports in ports_by_pam.items():
+            list_of_pams_log_header += (
+                f"{'blank' if pam == '' else pam }: {len(pam_ports)}\n"
+            )
+            sections.append(
+                (
+                    f"\n{'-'*20} Portfolios with a PAM that is {'blank' if pam == '' else pam } {'-'*20}\n\n",
+                    pam_ports,
+                )
+            )
 
-        log = (
+        header = (
             (
-                f"Number of Portfolios Reviewed: {num_portfolios_reviewed} out of {review_log_data['total_in_collection']} \n"
-                f"Portfolio Review time: {time_convert(get_portfolios.time)} \n"
+                f"Number of Portfolios Reviewed: {num_portfolios_reviewed} out of {run.review_log_data['total_in_collection']} \n"
+                f"Portfolio Review time: {time_convert(port_fetch_time)} \n"
                 f"Total time elapsed: {time_convert(now)} \n"
-                f"\n {'-'*20} {num_portfolios_reviewed}/{review_log_data['total_in_collection']} Portfolios Reviewed {'-'*20} \n"
+                f"\n {'-'*20} {num_portfolios_reviewed}/{run.review_log_data['total_in_collection']} Portfolios Reviewed {'-'*20} \n"
             )
             + list_of_pams_log_header
             + api_limit_reached
-            + detailed_log
         )
 
-    elif mode == "update":
-        port_fetch_time = get_portfolios.time
-        port_update_time = time_convert(update_portfolios_api.time - port_fetch_time)
-        name = f"update_port_log-{timestamp}.txt"
+    elif run.mode in ("update", "retry_failed"):
+        port_update_time = time_convert(
+            (run.update_time if run.update_time is not None else port_fetch_time)
+            - port_fetch_time
+        )
 
-        num_portfolios_updated = len(update_log_data["updated_portfolios"])
-        total_num_portfolios_updated = len(global_cache.get_updated_portfolios())
-        not_updating_portfolios = global_cache.get_not_updating_portfolios()
-        num_of_unchanged_ports = len(not_updating_portfolios)
-        num_update_failed_portfolios = len(update_log_data["update_failed_portfolios"])
+        num_portfolios_updated = len(run.update_log_data["updated_portfolios"])
+        total_num_portfolios_updated = global_cache.count_updated_portfolios()
+        not_updating_portfolios = global_cache.get_not_updating_summaries()
+        num_update_failed_portfolios = len(
+            run.update_log_data["update_failed_portfolios"]
+        )
 
-        if update_log_data["api_limit_reached"]:
+        if run.update_log_data["api_limit_reached"]:
             api_limit_reached = "\n API limit prevented finishing the review. \n"
         else:
             api_limit_reached = ""
 
-        detailed_log = f"\n{'-'*20}Portfolios That Failed to Update{'-'*20}\n\n"
-
-        for num, port in enumerate(
-            update_log_data["update_failed_portfolios"], start=1
-        ):
-            detailed_log += port_log_format(port, num, num_update_failed_portfolios)
-
-        detailed_log += f"\n{'-'*20}Portfolios That Updated This Run{'-'*20}\n\n"
-
-        for num, port in enumerate(update_log_data["updated_portfolios"], start=1):
-            detailed_log += port_log_format(port, num, num_portfolios_updated)
-
-        detailed_log += (
-            f"\n{'-'*20}Portfolios That Were Set In Alma Already{'-'*20}\n\n"
-        )
-
-        for num, port in enumerate(not_updating_portfolios, start=1):
-            detailed_log += port_log_format(port, num, num_of_unchanged_ports)
-
-        log = (
+        sections = [
             (
-                f"Total Portfolios Updated Across All Runs (according to cache): {total_num_portfolios_updated} out of {total_num_portfolios_updated + len(global_cache.get_ready_to_update_portfolios())} \n"
-                f"Portfolio Update time: {port_update_time} \n"
-                f"Total time elapsed: {time_convert(now)} \n"
-                f"{'-'*20} {num_portfolios_updated}/{num_portfolios_updated + num_update_failed_portfolios} Portfolios Updated This Run {'-'*20}\n"
-            )
-            + api_limit_reached
-            + detailed_log
-        )
+                f"\n{'-'*20}Portfolios That Failed to Update{'-'*20}\n\n",
+                run.update_log_data["update_failed_portfolios"],
+            ),
+            (
+                f"\n{'-'*20}Portfolios That Updated This Run{'-'*20}\n\n",
+                run.update_log_data["updated_portfolios"],
+            ),
+            (
+                f"\n{'-'*20}Portfolios That Were Set In Alma Already{'-'*20}\n\n",
+                not_updating_portfolios,
+            ),
+        ]
+
+        header = (
+            f"Total Portfolios Updated Across All Runs (according to cache): {total_num_portfolios_updated} out of {total_num_portfolios_updated + global_cache.count_ready_to_update_portfolios()} \n"
+            f"Portfolio Update time: {port_update_time} \n"
+            f"Total time elapsed: {time_convert(now)} \n"
+            f"{'-'*20} {num_portfolios_updated}/{num_portfolios_updated + num_update_failed_portfolios} Portfolios Updated This Run {'-'*20}\n"
+        ) + api_limit_reached
     else:
         return
 
     with codecs.open(name, "w", "utf-8") as p:
-        p.write(log)
+        p.write(header)
+        for section_header, ports in sections:
+            p.write(section_header)
+            write_port_log_entries(p, ports)
 
 
 # API Request Functions
-async def get_port_api(sem, session, ID, counter, total):
+async def get_port_api(sem, session, ID, prepared="collection"):
     requesturl = (
         BASEURL
         + "/e-collections/"
-        + collectionid
+        + collection_run().collection_id
         + "/e-services/"
-        + serviceid
+        + collection_run().service_id
         + "/portfolios/"
         + ID
         + "?apikey="
         + APIKEY
     )
+    request = None
     try:
         async with sem:
-            async with await session.get(requesturl, headers=HEADERS) as response:
+            request = await session.get(requesturl, headers=HEADERS)
+            async with request as response:
                 now = time.monotonic() - START
                 if response.status == 200:
-                    print(
-                        str(round((counter / total) * 100))
-                        + "% "
-                        + str(counter)
-                        + "/"
-                        + str(total)
-                        + time_convert(now)
-                    )
-                    portfolio = json.loads(await response.text())
+                    portfolio = serializer.loads(await response.read())
+                    cache_journal.record_retrieved(portfolio, prepared)
+                    global_cache.remove_failed_request(ID)
+                    progress.advance("Retrieving")
                     return portfolio
 
                 else:
                     error_message = "Failed to retrieve porfolio: " + str(ID)
                     add_to_error_log(error_message, str(response.status), now)
+                    add_to_failure_ledger(ID, "get", response.status, request)
+                    progress.fail("Retrieving")
                     return
-    except (
-        aiohttp.ServerDisconnectedError,
-        aiohttp.ClientResponseError,
-        aiohttp.ClientConnectorError,
-    ) as error:
+    except ApiBudgetExhausted:
+        collection_run().review_log_data["api_limit_reached"] = True
+        collection_run().update_log_data["api_limit_reached"] = True
+        progress.grow("Retrieving", -1)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        now = time.monotonic() - START
         error_message = f"The server connection was dropped on {requesturl} : {error}"
         add_to_error_log(error_message, "", now)
-        print(error_message)
+        add_to_failure_ledger(ID, "get", None, request)
+        progress.fail("Retrieving")
+        progress.message(error_message)
 
 
-async def get_port_list_api(sem, session, offset, counter, total):
+async def get_port_list_api(sem, session, offset):
     requesturl = (
         BASEURL
         + "/e-collections/"
-        + collectionid
+        + collection_run().collection_id
         + "/e-services/"
-        + serviceid
+        + collection_run().service_id
         + "/portfolios"
         + "?apikey="
         + APIKEY
@@ -730,33 +2925,32 @@ async def get_port_list_api(sem, session, offset, counter, total):
             async with await session.get(requesturl, headers=HEADERS) as response:
                 now = time.monotonic() - START
                 if response.status == 200:
-                    print(
-                        f"{round((counter / total) * 100)}% {counter}/{total} {time_convert(now)} |"
-                        f" portfolios {offset} to {offset + 100} retrieved from collection list"
-                    )
-                    partial_response = await response.json()
+                    partial_response = serializer.loads(await response.read())
+                    progress.advance("Portfolio list")
 
                     return partial_response["portfolio"]
 
                 else:
                     error_message = "Failed to retrieve partial porfolio list"
                     add_to_error_log(error_message, str(response.status), now)
+                    progress.fail("Portfolio list")
                     return
-    except (
-        aiohttp.ServerDisconnectedError,
-        aiohttp.ClientResponseError,
-        aiohttp.ClientConnectorError,
-    ) as error:
+    except ApiBudgetExhausted:
+        collection_run().review_log_data["api_limit_reached"] = True
+        collection_run().update_log_data["api_limit_reached"] = True
+        progress.grow("Portfolio list", -1)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        now = time.monotonic() - START
         error_message = f"The server connection was dropped on {requesturl} : {error}"
         add_to_error_log(error_message, "", now)
-        print(error_message)
+        progress.fail("Portfolio list")
+        progress.message(error_message)
 
 
 async def get_all_collection_portfolio_overview_api(session, number_of_portfolios):
-    semaphore = asyncio.Semaphore(30)
+    semaphore = session.concurrency
     now = time.monotonic() - START
     tasks = []
-    counter = 0
     number_of_queries = range(0, (number_of_portfolios % 100) + 1)
 
     if number_of_portfolios > 100:
@@ -765,93 +2959,267 @@ async def get_all_collection_portfolio_overview_api(session, number_of_portfolio
     else:
         number_of_queries = [0]
 
-    if global_cache.get_remaining_api_calls() < len(number_of_queries):
-        review_log_data["api_limit_reached"] = True
-        update_log_data["api_limit_reached"] = True
+    if api_budget.available() < len(number_of_queries):
+        collection_run().review_log_data["api_limit_reached"] = True
+        collection_run().update_log_data["api_limit_reached"] = True
 
         add_to_error_log(
             "couldn't retrieve the overview", "api limit insufficient", now
         )
-        return []
+        return [], False
 
+    progress.start("Portfolio list", len(number_of_queries))
     for query in number_of_queries:
-        counter += 1
-
         if query != 0:
             offset = query * 100
         else:
             offset = query
 
-        task = asyncio.ensure_future(
-            get_port_list_api(
-                semaphore, session, offset, counter, len(number_of_queries)
-            )
-        )
+        task = asyncio.ensure_future(get_port_list_api(semaphore, session, offset))
         tasks.append(task)
 
     results = await asyncio.gather(*tasks)
+    progress.finish()
 
-    global_cache.add_api_call_set(len(number_of_queries))
-
+    # pages that failed are skipped rather than throwing away the ones that arrived.
+    # returns the portfolios and whether the list is the whole collection
     portfolios = []
+    seen_ids = set()
+    failed_pages = 0
     for partiallist in results:
+        if partiallist is None:
+            failed_pages += 1
+            continue
         for port in partiallist:
-            portfolios.append(port)
-    if len(portfolios) == number_of_portfolios:
-        return portfolios
-    else:
-        print("Failed to get all portfolios!")
-        return []
+            if port["id"] not in seen_ids:
+                seen_ids.add(port["id"])
+                portfolios.append(port)
+
+    complete = failed_pages == 0 and len(portfolios) == number_of_portfolios
+    if not complete:
+        print(
+            f"Failed to get all portfolios! Kept {len(portfolios)} of {number_of_portfolios}"
+            f" from the pages that were retrieved ({failed_pages} pages failed)."
+        )
+    return portfolios, complete
 
 
-async def get_all_portfolio_details_api(session, portfolio_ids):
-    semaphore = asyncio.Semaphore(30)
-    tasks = []
-    counter = 0
-    total_portfolios = len(portfolio_ids)
-    if global_cache.get_remaining_api_calls() < total_portfolios:
-        review_log_data["api_limit_reached"] = True
-        update_log_data["api_limit_reached"] = True
-        return []
+async def run_worker_pool(items, handle_item, worker_count=WORKER_COUNT):
+    # a fixed number of workers take turns pulling from the same iterator, so no matter
+    # how many items there are only worker_count coroutines exist at once
+    work = iter(items)
+
+    async def worker():
+        for item in work:
+            await handle_item(item)
+
+    await asyncio.gather(*(worker() for _ in range(worker_count)))
 
-    for id in portfolio_ids:
-        counter += 1
-        task = asyncio.ensure_future(
-            get_port_api(semaphore, session, id, counter, total_portfolios)
-        )
-        tasks.append(task)
-    results = await asyncio.gather(*tasks)
 
-    global_cache.add_api_call_set(total_portfolios)
+async def get_all_portfolio_details_api(session, portfolio_ids, prepared="collection"):
+    # retrieved portfolios go into the cache as they arrive,
+    # returns how many were retrieved. prepared is passed on to record_retrieved
+    semaphore = session.concurrency
+    total_portfolios = len(portfolio_ids)
+    retrieved = 0
+    if api_budget.available() < total_portfolios:
+        collection_run().review_log_data["api_limit_reached"] = True
+        collection_run().update_log_data["api_limit_reached"] = True
+        return retrieved
+
+    async def get_port(id):
+        nonlocal retrieved
+        portfolio = await get_port_api(semaphore, session, id, prepared)
+        if portfolio is not None:
+            global_cache.add_portfolios_retrieved([portfolio])
+            retrieved += 1
 
-    results = list(filter(clean_port_list, results))
+    progress.start("Retrieving", total_portfolios)
+    await run_worker_pool(portfolio_ids, get_port)
+    progress.finish()
 
-    return results
+    return retrieved
 
 
 async def update_portfolios_api(session, portfolio_list):
-    semaphore = asyncio.Semaphore(30)
-    tasks = []
-    counter = 0
+    # updated portfolios are moved from ready to update to updated in the cache as they finish
+    semaphore = session.concurrency
     total_portfolios = len(portfolio_list)
-    for port in portfolio_list:
-        counter += 1
-        if port["id"]:
-            task = asyncio.ensure_future(
-                update_port(semaphore, session, port, counter, total_portfolios)
-            )
-            tasks.append(task)
-    results = await asyncio.gather(*tasks)
-    global_cache.add_api_call_set(total_portfolios)
-    update_portfolios_api.time = time.monotonic() - START
+
+    async def update(port):
+        if not port["id"]:
+            progress.grow("Updating", -1)
+            return
+        portfolio = await update_port(semaphore, session, port)
+        if portfolio is not None:
+            global_cache.add_portfolios_updated([portfolio])
+            global_cache.remove_portfolio_from_portfolios_ready_to_update(portfolio)
+
+    progress.start("Updating", total_portfolios)
+    await run_worker_pool(portfolio_list, update)
+    progress.finish()
+    collection_run().update_time = time.monotonic() - START
 
     return
 
 
+def sharded():
+    # a batch already shares this process's rate limit and budget between its collections
+    return shard_count > 1 and not collection_run().batch
+
+
+async def sharded_requests(session, operation, items):
+    # splits the portfolio GETs ("get", a list of portfolio IDs) or PUTs ("put", a list of
+    # portfolios) between shard_count worker processes. each worker journals its results
+    # to its own file, and once they have all finished the journals are replayed into the
+    # cache the same way an unfinished run's journal is, and the cache is saved
+    if not items:
+        return
+    run = collection_run()
+    name = "Retrieving" if operation == "get" else "Updating"
+    shards = [items[shard::shard_count] for shard in range(shard_count)]
+    ids = [item if operation == "get" else item["id"] for item in items]
+    failures = [
+        failure
+        for failure in map(global_cache.get_failed_request, ids)
+        if failure is not None
+    ]
+    # spawned workers import main.py afresh, these can be changed after it's imported
+    settings = {"BASEURL": BASEURL, "APIKEY": APIKEY, "shard_count": shard_count}
+
+    store = ShardStore(SHARD_STORE)
+    store.create(
+        session.RATE,
+        session.MAX_TOKENS,
+        api_budget.available(),
+        api_budget.institution_headroom(),
+        [len(shard_items) for shard_items in shards],
+    )
+    print(f"Splitting {len(items)} requests between {shard_count} processes...")
+    progress.start(name, len(items))
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=shard_count, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        workers = asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    executor,
+                    run_shard,
+                    shard,
+                    operation,
+                    shard_items,
+                    run.restart(),
+                    failures,
+                    settings,
+                )
+                for shard, shard_items in enumerate(shards)
+            )
+        )
+        while not workers.done():
+            await asyncio.wait([workers], timeout=PROGRESS_INTERVAL)
+            progress.update(name, *store.progress())
+        results = workers.result()
+    progress.finish()
+    finished = time.monotonic()
+    headroom = store.budget()[1]
+    store.close()
+
+    for shard, result in enumerate(results):
+        CacheJournal(shard_journal_path(shard)).replay(global_cache)
+        run.errors.extend(result["errors"])
+        for key in ("updated_portfolios", "update_failed_portfolios"):
+            run.update_log_data[key].extend(result[key])
+        if result["api_limit_reached"]:
+            run.review_log_data["api_limit_reached"] = True
+            run.update_log_data["api_limit_reached"] = True
+        api_metrics.merge(result["metrics"])
+        api_budget.merge(result["api_budget"], headroom)
+        session.merge(result["limiter"], started, finished)
+        session.transport.merge(result["transport"])
+    save_cache()
+
+
+def shard_share(limit):
+    # a worker's share of a concurrency limit
+    return max(limit // shard_count, AdaptiveConcurrency.MIN_LIMIT)
+
+
+def run_shard(shard, operation, items, run, failures, settings):
+    # the entry point of a shard worker process
+    globals().update(settings)
+    return asyncio.run(shard_worker(shard, operation, items, run, failures))
+
+
+async def shard_worker(shard, operation, items, run, failures):
+    # makes this shard's requests and journals the results for the parent process,
+    # the worker's own cache only holds what the request functions need
+    global global_cache, cache_journal, api_budget, progress
+    current_run.set(run)
+    global_cache = Cache()
+    for failure in failures:
+        global_cache.add_failed_request(failure)
+    cache_journal = CacheJournal(shard_journal_path(shard))
+    cache_journal.clear()
+    cache_journal.open()
+    store = ShardStore(SHARD_STORE)
+    api_budget = SharedApiBudget(store)
+    progress = ShardProgress(store, shard)
+
+    # the workers share the concurrency limit and the connection pool a single process
+    # would have, so together they don't hold more requests open at Alma than it would
+    concurrency = AdaptiveConcurrency(shard_share(AdaptiveConcurrency.INITIAL_LIMIT))
+    concurrency.MAX_LIMIT = shard_share(AdaptiveConcurrency.MAX_LIMIT)
+    transport = HttpTransport()
+    transport.POOL_SIZE = concurrency.MAX_LIMIT
+
+    async with transport:
+        session = SharedRateLimiter(transport, store, concurrency)
+        semaphore = session.concurrency
+
+        async def get(id):
+            await get_port_api(semaphore, session, id)
+
+        async def update(port):
+            if not port["id"]:
+                progress.grow("Updating", -1)
+                return
+            await update_port(semaphore, session, port)
+
+        if operation == "get":
+            progress.start("Retrieving", len(items))
+            await run_worker_pool(items, get)
+        else:
+            progress.start("Updating", len(items))
+            await run_worker_pool(items, update)
+        progress.finish()
+        session.close()
+
+    cache_journal.close()
+    store.close()
+    return {
+        "errors": run.errors,
+        "updated_portfolios": run.update_log_data["updated_portfolios"],
+        "update_failed_portfolios": run.update_log_data["update_failed_portfolios"],
+        "api_limit_reached": run.update_log_data["api_limit_reached"],
+        "metrics": api_metrics,
+        "api_budget": api_budget.stats(),
+        "limiter": session.stats(),
+        "transport": transport.stats(),
+    }
+
+
 async def get_collection_overview_api(session):
     now = time.monotonic() - START
-    requesturl = BASEURL + "/e-collections/" + collectionid + "?apikey=" + APIKEY
-    if global_cache.get_remaining_api_calls() < 1:
+    requesturl = (
+        BASEURL
+        + "/e-collections/"
+        + collection_run().collection_id
+        + "?apikey="
+        + APIKEY
+    )
+    if api_budget.available() < 1:
         add_to_error_log(
             "Ran out of API requests, couldn't check the number of portfolios in the collection",
             "API limit exceeded",
@@ -859,12 +3227,10 @@ async def get_collection_overview_api(session):
         )
         return
 
-    global_cache.add_api_call_set(1)
-
     try:
         async with await session.get(requesturl, headers=HEADERS) as response:
             if response.status == 200:
-                collection = json.loads(await response.text())
+                collection = serializer.loads(await response.read())
                 number_of_portfolios = collection["portfolios"]["value"]
                 return number_of_portfolios
 
@@ -883,56 +3249,69 @@ async def get_collection_overview_api(session):
                     now,
                 )
                 return
-    except (
-        aiohttp.ServerDisconnectedError,
-        aiohttp.ClientResponseError,
-        aiohttp.ClientConnectorError,
-    ) as error:
+    except ApiBudgetExhausted:
+        add_to_error_log(
+            "Ran out of API requests, couldn't check the number of portfolios in the collection",
+            "API limit exceeded",
+            time.monotonic() - START,
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        now = time.monotonic() - START
         error_message = f"The server connection was dropped on {requesturl} : {error}"
         add_to_error_log(error_message, "", now)
         print(error_message)
 
 
-async def update_port(sem, session, portfolio, counter, total):
+async def update_port(sem, session, portfolio):
     requesturl = (
         BASEURL
         + "/e-collections/"
-        + collectionid
+        + collection_run().collection_id
         + "/e-services/"
-        + serviceid
+        + collection_run().service_id
         + "/portfolios/"
         + portfolio["id"]
         + "?apikey="
         + APIKEY
     )
+    request = None
     try:
         async with sem:
-            async with await session.put(
-                requesturl, headers=HEADERS, json=portfolio
-            ) as response:
+            request = await session.put(
+                requesturl, headers=HEADERS, data=serializer.dumps(portfolio)
+            )
+            async with request as response:
                 now = time.monotonic() - START
                 if response.status == 200:
-                    print(
-                        str(round((counter / total) * 100))
-                        + "% "
-                        + str(counter)
-                        + "/"
-                        + str(total)
-                        + time_convert(now)
+                    collection_run().update_log_data["updated_portfolios"].append(
+                        PortfolioSummary.from_portfolio(portfolio)
                     )
-                    update_log_data["updated_portfolios"].append(portfolio)
+                    cache_journal.record_updated(portfolio)
+                    global_cache.remove_failed_request(portfolio["id"])
+                    progress.advance("Updating")
+                    return portfolio
                 else:
                     error_message = "Failed to update porfolio: " + str(portfolio["id"])
                     add_to_error_log(error_message, str(response.status), now)
-                    update_log_data["update_failed_portfolios"].append(portfolio)
-    except (
-        aiohttp.ServerDisconnectedError,
-        aiohttp.ClientResponseError,
-        aiohttp.ClientConnectorError,
-    ) as error:
+                    add_to_failure_ledger(
+                        portfolio["id"], "put", response.status, request
+                    )
+                    collection_run().update_log_data["update_failed_portfolios"].append(
+                        PortfolioSummary.from_portfolio(portfolio)
+                    )
+                    progress.fail("Updating")
+                    return
+    except ApiBudgetExhausted:
+        collection_run().review_log_data["api_limit_reached"] = True
+        collection_run().update_log_data["api_limit_reached"] = True
+        progress.grow("Updating", -1)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        now = time.monotonic() - START
         error_message = f"The server connection was dropped on {requesturl} : {error}"
         add_to_error_log(error_message, "", now)
-        print(error_message)
+        add_to_failure_ledger(portfolio["id"], "put", None, request)
+        progress.fail("Updating")
+        progress.message(error_message)
 
 
 async def get_collection_overview(session):
@@ -956,69 +3335,111 @@ async def get_port_ids(session, number_of_portfolios):
     portfolio_ids = global_cache.get_overview_port_ids()
 
     if len(portfolio_ids) != number_of_portfolios:
-        portfolio_list = await get_all_collection_portfolio_overview_api(
+        portfolio_list, complete = await get_all_collection_portfolio_overview_api(
             session, number_of_portfolios
         )
 
         if portfolio_list == []:
             print("Error retrieving portfolios from API")
         else:
-            global_cache.remove_collection_overview()
+            # diff against what was cached so only new portfolios get fetched later
+            cached_ids = set(portfolio_ids)
+            new_ids = {port["id"] for port in portfolio_list}
+            added_ids = new_ids - cached_ids
+            removed_ids = []
+            if complete:
+                # only a complete list can say a portfolio has left the collection
+                removed_ids = [id for id in portfolio_ids if id not in new_ids]
+                for id in removed_ids:
+                    global_cache.remove_portfolio_from_all_sections(id)
+                global_cache.remove_collection_overview()
             global_cache.add_collection_overview(portfolio_list)
+            cache_journal.record_overview(portfolio_list, complete, removed_ids)
+            print(
+                f"{len(added_ids)} portfolios added and {len(removed_ids)} removed"
+                " since the last overview."
+            )
             portfolio_ids = global_cache.get_overview_port_ids()
     print("Portfolio IDs have been retrieved.")
     return portfolio_ids
 
 
 async def get_portfolios(session, number_of_portfolios, portfolio_ids):
-    # only get portfolio details from the api if not in cache
+    # only get portfolio details from the api if not in cache,
+    # returns how many of the collection's portfolios are in the cache
     print("Getting portfolios...")
 
-    portfolios = global_cache.get_retrieved_portfolios()
-
-    if len(portfolios) < number_of_portfolios:
-        existing_ids = global_cache.get_retrieved_port_ids()
+    if global_cache.count_retrieved_portfolios() < number_of_portfolios:
         # filter the already retrieved ids out of the portfolios_ids list
-        filtered_ids = list(filter(lambda id: id not in existing_ids, portfolio_ids))
+        filtered_ids = [
+            id for id in portfolio_ids if not global_cache.has_retrieved_portfolio(id)
+        ]
 
         # limit the number of ids to look up to less than the remaining api limit
-        if global_cache.get_remaining_api_calls() >= len(filtered_ids):
+        if api_budget.available() >= len(filtered_ids):
             api_limited_ids = filtered_ids
         else:
-            review_log_data["api_limit_reached"] = True
-            update_log_data["api_limit_reached"] = True
-            api_limited_ids = filtered_ids[: global_cache.get_remaining_api_calls()]
+            collection_run().review_log_data["api_limit_reached"] = True
+            collection_run().update_log_data["api_limit_reached"] = True
+            api_limited_ids = filtered_ids[: api_budget.available()]
             print(
                 f"Not enough API requests left, retrieving only {len(api_limited_ids)} portfolios."
             )
 
-        new_portfolios = await get_all_portfolio_details_api(session, api_limited_ids)
-        global_cache.add_portfolios_retrieved(new_portfolios)
+        if sharded():
+            await sharded_requests(session, "get", api_limited_ids)
+        else:
+            await get_all_portfolio_details_api(session, api_limited_ids)
 
         global_cache.remove_all_portfolios_updated_by_collection()
         global_cache.remove_all_portfolios_ready_to_update_by_collection()
         global_cache.remove_all_portfolios_not_updating_by_collection()
 
-        portfolios = global_cache.get_retrieved_portfolios()
-
-    get_portfolios.time = time.monotonic() - START
+    collection_run().portfolios_time = time.monotonic() - START
     print("Portfolios retrieved.")
-    return portfolios
+    return global_cache.count_retrieved_portfolios()
 
 
 def all_prepared_portfolios_are_in_cache(number_of_portfolios):
-    updated_ports = global_cache.get_updated_portfolios()
-    ready_to_update_ports = global_cache.get_ready_to_update_portfolios()
-    not_updating_ports = global_cache.get_not_updating_portfolios()
-    total = updated_ports + ready_to_update_ports + not_updating_ports
-    if len(total) == number_of_portfolios:
+    total = (
+        global_cache.count_updated_portfolios()
+        + global_cache.count_ready_to_update_portfolios()
+        + global_cache.count_not_updating_portfolios()
+    )
+    if total == number_of_portfolios:
         return True
     else:
         return False
 
 
 def all_retrieved_portfolios_are_in_cache(number_of_portfolios):
-    return len(global_cache.get_retrieved_portfolios()) == number_of_portfolios
+    return global_cache.count_retrieved_portfolios() == number_of_portfolios
+
+
+def prepare_portfolio_for_update(portfolio):
+    # set the new PAM on a portfolio with a blank or missing one,
+    # returns whether the portfolio needs to be updated in Alma
+    if portfolio["public_access_model"] is None:
+        # we needed to add a new dictionary since it is currently a None object rather than
+        # an existing dictionary with the necessary keys
+        portfolio["public_access_model"] = {
+            "value": collection_run().public_access_model_code,
+            "desc": collection_run().public_access_model_description,
+        }
+        return True
+
+    elif portfolio["public_access_model"]["value"] == "":
+        # we updated the existing key value pairs rather than creating a new dictionary
+        # because "public_access_model" might have other keys that we don't want to overwrite
+        portfolio["public_access_model"][
+            "value"
+        ] = collection_run().public_access_model_code
+        portfolio["public_access_model"][
+            "desc"
+        ] = collection_run().public_access_model_description
+        return True
+
+    return False
 
 
 def prepare_portfolios_for_update(portfolios):
@@ -1026,25 +3447,22 @@ def prepare_portfolios_for_update(portfolios):
     not_updated_ports = []
     for portfolio in portfolios:
 
-        if portfolio["public_access_model"]["value"] == "":
-            # we updated the existing key value pairs rather than creating a new dictionary
-            # because "public_access_model" might have other keys that we don't want to overwrite
-            portfolio["public_access_model"]["value"] = public_access_model_code
-            portfolio["public_access_model"]["desc"] = public_access_model_description
+        if global_cache.has_updated_portfolio(portfolio["id"]):
+            # already updated by a run that was interrupted before it finished
+            continue
+
+        elif global_cache.has_ready_to_update_portfolio(portfolio["id"]):
+            # prepared by an earlier run, its retrieved copy already has the new PAM
             portfolios_to_update.append(portfolio)
 
-        elif portfolio["public_access_model"] is None:
-            # we needed to add a new dictionary since it is currently a None object rather than
-            # an existing dictionary with the necessary keys
-            portfolio["public_access_model"] = {
-                "value": public_access_model_code,
-                "desc": public_access_model_description,
-            }
+        elif prepare_portfolio_for_update(portfolio):
             portfolios_to_update.append(portfolio)
 
         else:
             not_updated_ports.append(portfolio)
 
+    # the retrieved copies were changed in place above
+    global_cache.mark_portfolios_retrieved_changed(portfolios_to_update)
     global_cache.add_portfolios_not_updating(not_updated_ports)
     global_cache.add_portfolios_ready_to_update(portfolios_to_update)
     return portfolios_to_update
@@ -1053,74 +3471,426 @@ def prepare_portfolios_for_update(portfolios):
 async def update_mode(session):
     portfolios_to_update = []
 
-    number_of_portfolios = await get_collection_overview(session)
+    with profiler.phase("overview"):
+        number_of_portfolios = await get_collection_overview(session)
     if number_of_portfolios is None:
         return
 
-    portfolio_ids = await get_port_ids(session, number_of_portfolios)
+    with profiler.phase("port_ids"):
+        portfolio_ids = await get_port_ids(session, number_of_portfolios)
     if portfolio_ids == []:
         return
 
-    portfolios = await get_portfolios(session, number_of_portfolios, portfolio_ids)
-    if portfolios == []:
+    with profiler.phase("details"):
+        retrieved = await get_portfolios(session, number_of_portfolios, portfolio_ids)
+    if retrieved == 0:
         return
 
-    # Check if we have the prepared collection in cache or need to prepare it
-    if all_prepared_portfolios_are_in_cache(number_of_portfolios):
-        portfolios_to_update = global_cache.get_ready_to_update_portfolios()
+    with profiler.phase("prepare"):
+        # Check if we have the prepared collection in cache or need to prepare it
+        if all_prepared_portfolios_are_in_cache(number_of_portfolios):
+            portfolios_to_update = global_cache.get_ready_to_update_portfolios()
 
-    elif all_retrieved_portfolios_are_in_cache(number_of_portfolios):
-        portfolios_to_update = prepare_portfolios_for_update(portfolios)
+        elif all_retrieved_portfolios_are_in_cache(number_of_portfolios):
+            portfolios_to_update = prepare_portfolios_for_update(
+                global_cache.get_retrieved_portfolios()
+            )
 
-    else:
-        print("Not all portfolios have been retrieved, can't start updating yet")
-        return
+        else:
+            print("Not all portfolios have been retrieved, can't start updating yet")
+            return
 
-    # Make update calls within the number of api calls left; update cache accordingly
-    if global_cache.get_remaining_api_calls() >= len(portfolios_to_update):
-        await update_portfolios_api(session, portfolios_to_update)
+    with profiler.phase("update"):
+        # Make update calls within the number of api calls left; update cache accordingly
+        if api_budget.available() >= len(portfolios_to_update):
+            ready_to_update_now = portfolios_to_update
 
-        global_cache.add_portfolios_updated(update_log_data["updated_portfolios"])
+        else:
+            remaining_calls = api_budget.available()
+            collection_run().review_log_data["api_limit_reached"] = True
+            collection_run().update_log_data["api_limit_reached"] = True
+            ready_to_update_now = portfolios_to_update[0:remaining_calls]
+
+        if sharded():
+            await sharded_requests(session, "put", ready_to_update_now)
+            collection_run().update_time = time.monotonic() - START
+        else:
+            await update_portfolios_api(session, ready_to_update_now)
 
-        for port in update_log_data["updated_portfolios"]:
-            global_cache.remove_portfolio_from_portfolios_ready_to_update(port)
 
-    else:
-        remaining_calls = global_cache.get_remaining_api_calls()
-        review_log_data["api_limit_reached"] = True
-        update_log_data["api_limit_reached"] = True
-        ready_to_update_now = portfolios_to_update[0:remaining_calls]
+async def pipelined_update_mode(session):
+    # update mode with the phases overlapped: each portfolio is checked as soon as it is
+    # retrieved and, if its PAM is blank or missing, queued straight away for updating
+    with profiler.phase("overview"):
+        number_of_portfolios = await get_collection_overview(session)
+    if number_of_portfolios is None:
+        return
 
-        await update_portfolios_api(session, ready_to_update_now)
+    with profiler.phase("port_ids"):
+        portfolio_ids = await get_port_ids(session, number_of_portfolios)
+    if portfolio_ids == []:
+        return
+
+    print("Retrieving and updating portfolios...")
+    collection_run().portfolios_time = time.monotonic() - START
+    semaphore = session.concurrency
+    # bounded so retrieval can't run far ahead of the updates
+    update_queue = asyncio.Queue(maxsize=WORKER_COUNT)
+
+    async def queue_for_update(portfolio):
+        progress.grow("Updating")
+        await update_queue.put(portfolio)
+
+    async def prepare(portfolio):
+        if prepare_portfolio_for_update(portfolio):
+            # the retrieved copy was changed in place
+            global_cache.mark_portfolios_retrieved_changed([portfolio])
+            global_cache.add_portfolios_ready_to_update([portfolio])
+            await queue_for_update(portfolio)
+        else:
+            global_cache.add_portfolios_not_updating([portfolio])
+
+    ids_to_fetch = [
+        id for id in portfolio_ids if not global_cache.has_retrieved_portfolio(id)
+    ]
+
+    async def fetch(id):
+        # requests the daily budget can't cover are dropped by get_port_api and update_port
+        portfolio = await get_port_api(semaphore, session, id, "portfolio")
+        if portfolio is not None:
+            global_cache.add_portfolios_retrieved([portfolio])
+            # each portfolio is prepared as it's retrieved, so only this one's earlier
+            # preparation is out of date. the rest of the collection's is kept, a run that
+            # was stopped carries on with the portfolios it had queued for updating
+            global_cache.remove_portfolio_from_portfolios_updated(portfolio)
+            global_cache.remove_portfolio_from_portfolios_ready_to_update(portfolio)
+            global_cache.remove_portfolio_from_portfolios_not_updating(portfolio)
+            await prepare(portfolio)
+
+    async def produce():
+        # portfolios that are already in the cache go first
+        for portfolio in global_cache.get_retrieved_portfolios():
+            if global_cache.has_updated_portfolio(
+                portfolio["id"]
+            ) or global_cache.has_not_updating_portfolio(portfolio["id"]):
+                continue
+            elif global_cache.has_ready_to_update_portfolio(portfolio["id"]):
+                await queue_for_update(portfolio)
+            else:
+                await prepare(portfolio)
+
+        await run_worker_pool(ids_to_fetch, fetch)
+        for _ in range(WORKER_COUNT):
+            await update_queue.put(None)
+
+    async def update_worker():
+        while True:
+            port = await update_queue.get()
+            if port is None:
+                return
+            portfolio = await update_port(semaphore, session, port)
+            if portfolio is not None:
+                global_cache.add_portfolios_updated([portfolio])
+                global_cache.remove_portfolio_from_portfolios_ready_to_update(portfolio)
 
-        global_cache.add_portfolios_updated(update_log_data["updated_portfolios"])
+    progress.start("Retrieving", len(ids_to_fetch))
+    progress.start("Updating", 0)
+    with profiler.phase("details_and_update"):
+        await asyncio.gather(produce(), *(update_worker() for _ in range(WORKER_COUNT)))
+    progress.finish()
 
-        for port in update_log_data["updated_portfolios"]:
-            global_cache.remove_portfolio_from_portfolios_ready_to_update(port)
+    collection_run().update_time = time.monotonic() - START
+    print("Portfolios retrieved and updated.")
 
 
 async def review_mode(session):
-    number_of_portfolios = await get_collection_overview(session)
+    with profiler.phase("overview"):
+        number_of_portfolios = await get_collection_overview(session)
     if number_of_portfolios is None:
         return
 
-    portfolio_ids = await get_port_ids(session, number_of_portfolios)
+    with profiler.phase("port_ids"):
+        portfolio_ids = await get_port_ids(session, number_of_portfolios)
     if portfolio_ids == []:
         return
 
-    portfolios = await get_portfolios(session, number_of_portfolios, portfolio_ids)
-    if portfolios == []:
+    with profiler.phase("details"):
+        retrieved = await get_portfolios(session, number_of_portfolios, portfolio_ids)
+    if retrieved == 0:
         return
 
     print("Preparing log data...")
-    for port in portfolios:
-        review_log_data["pam_types"].add(port["public_access_model"]["value"])
-        review_log_data["reviewed_portfolios"].append(port)
+    with profiler.phase("prepare"):
+        # the review only needs the summaries, the full records are never loaded
+        for port in global_cache.get_retrieved_summaries():
+            collection_run().review_log_data["pam_types"].add(port.pam_value)
+            collection_run().review_log_data["reviewed_portfolios"].append(port)
 
-    review_log_data["total_in_collection"] = number_of_portfolios
+    collection_run().review_log_data["total_in_collection"] = number_of_portfolios
     print("Log data complete.")
 
 
+async def retry_failed_mode(session):
+    # re-issue only the portfolio GETs/PUTs recorded in the failure ledger,
+    # instead of working through the whole collection again
+    failures = global_cache.get_failed_requests()
+    if failures == []:
+        print("No failed requests are recorded for this collection.")
+        return
+
+    get_ids = [failure["id"] for failure in failures if failure["operation"] == "get"]
+    put_ids = [failure["id"] for failure in failures if failure["operation"] == "put"]
+    print(
+        f"Retrying {len(get_ids)} failed portfolio retrievals and"
+        f" {len(put_ids)} failed updates..."
+    )
+
+    remaining_calls = api_budget.available()
+    if remaining_calls < len(get_ids) + len(put_ids):
+        collection_run().review_log_data["api_limit_reached"] = True
+        collection_run().update_log_data["api_limit_reached"] = True
+        print(f"Not enough API requests left, retrying only {remaining_calls}.")
+        get_ids = get_ids[:remaining_calls]
+        put_ids = put_ids[: remaining_calls - len(get_ids)]
+
+    if get_ids:
+        # if the collection has been prepared for updating, the retrieved portfolios are
+        # prepared too so the next update run can pick up where it left off
+        prepared = (
+            global_cache.count_updated_portfolios()
+            + global_cache.count_ready_to_update_portfolios()
+            + global_cache.count_not_updating_portfolios()
+        ) > 0
+        before = set(global_cache.get_retrieved_port_ids())
+        await get_all_portfolio_details_api(session, get_ids, None)
+        if prepared:
+            for id in get_ids:
+                portfolio = global_cache.get_retrieved_portfolio(id)
+                if portfolio is None or id in before:
+                    continue
+                if prepare_portfolio_for_update(portfolio):
+                    global_cache.mark_portfolios_retrieved_changed([portfolio])
+                    global_cache.add_portfolios_ready_to_update([portfolio])
+                else:
+                    global_cache.add_portfolios_not_updating([portfolio])
+    collection_run().portfolios_time = time.monotonic() - START
+
+    portfolios_to_update = []
+    for id in put_ids:
+        portfolio = global_cache.get_ready_to_update_portfolio(id)
+        if portfolio is None:
+            print(
+                f"Portfolio {id} is no longer ready to update in the cache,"
+                " run the update mode to prepare it again."
+            )
+            continue
+        portfolios_to_update.append(portfolio)
+    if portfolios_to_update:
+        await update_portfolios_api(session, portfolios_to_update)
+
+    print(f"{global_cache.count_failed_requests()} failed requests are still recorded.")
+
+
+def read_batch_manifest():
+    # one CollectionRun per row of the manifest
+    runs = []
+    with open(batch_manifest, newline="", encoding="utf-8") as manifest:
+        for row in csv.DictReader(manifest):
+            if not row.get("collection_id"):
+                continue
+            runs.append(
+                CollectionRun(
+                    batch_run_mode,
+                    row["collection_id"].strip(),
+                    row["service_id"].strip(),
+                    row.get("public_access_model_code") or public_access_model_code,
+                    row.get("public_access_model_description")
+                    or public_access_model_description,
+                    batch=True,
+                )
+            )
+    return runs
+
+
+async def batch_mode(session):
+    # all the collections are worked on at once through the same session, rate limiter and
+    # API budget. AdaptiveConcurrency gives the collections turns at the request slots,
+    # and each collection's logs are written as soon as it finishes
+    async def run_collection(run):
+        # gather runs each collection in its own task, so this only sets its current run
+        current_run.set(run)
+        print(f"Starting the {run.mode} of collection {run.collection_id}...")
+        if run.mode == "update":
+            if pipelined_update:
+                await pipelined_update_mode(session)
+            else:
+                await update_mode(session)
+        else:
+            await review_mode(session)
+        save_port_log()
+        if run.mode == "review":
+            save_review_exports()
+        save_error_log()
+        print(f"Finished the {run.mode} of collection {run.collection_id}.")
+
+    with profiler.phase("batch"):
+        await asyncio.gather(*(run_collection(run) for run in collection_runs))
+
+    for run in collection_runs:
+        current_run.set(run)
+        print_failed_requests()
+
+
+def print_failed_requests():
+    count = global_cache.count_failed_requests()
+    if count:
+        run = collection_run()
+        collection = f" of collection {run.collection_id}" if run.batch else ""
+        print(
+            f"{count} portfolio requests{collection} have failed and are recorded in the cache,"
+            " use the retry_failed mode to retry just those."
+        )
+
+
+def print_request_rate(session):
+    stats = session.stats()
+    if stats["requests"] == 0:
+        return
+    print(
+        f"{stats['requests']} API requests at {stats['achieved_rate']:.1f} requests/sec "
+        f"(target {session.RATE}), {stats['total_wait']:.1f} secs spent waiting for the rate limit"
+    )
+    if stats["retries"]:
+        print(f"{stats['retries']} requests were retried")
+    if api_budget.institution_remaining is not None:
+        print(
+            f"Alma reported {api_budget.institution_remaining} API calls left today"
+            " for the whole institution"
+        )
+    print(
+        f"Concurrent requests settled at {int(session.concurrency.limit)} "
+        f"after {session.concurrency.decreases} back-offs"
+    )
+    transport_stats = session.transport.stats()
+    print(
+        f"{transport_stats['connections_opened']} connections were opened,"
+        f" {transport_stats['reuse_ratio']:.0%} of requests reused an open connection"
+    )
+
+
+async def run_mode(session):
+    if mode == "update":
+        if pipelined_update:
+            await pipelined_update_mode(session)
+        else:
+            await update_mode(session)
+        print_request_rate(session)
+        print_failed_requests()
+        print("Preparing logs. Please wait ...")
+        with profiler.phase("logs"):
+            save_port_log()
+            save_error_log()
+            save_metrics(session)
+        print("Logs complete.")
+
+    elif mode == "review":
+        await review_mode(session)
+        print_request_rate(session)
+        print_failed_requests()
+        print("Preparing logs. Please wait ...")
+        with profiler.phase("logs"):
+            save_port_log()
+            save_review_exports()
+            save_error_log()
+            save_metrics(session)
+        print("Logs complete.")
+
+    elif mode == "retry_failed":
+        await retry_failed_mode(session)
+        print_request_rate(session)
+        print("Preparing logs. Please wait ...")
+        with profiler.phase("logs"):
+            save_port_log()
+            save_error_log()
+            save_metrics(session)
+        print("Logs complete.")
+
+    elif mode == "batch":
+        await batch_mode(session)
+        print_request_rate(session)
+        with profiler.phase("logs"):
+            save_metrics(session)
+
+
+async def wait_until_api_reset():
+    # Ex Libris resets the daily threshold at midnight UTC
+    reset = last_utc_midnight() + datetime.timedelta(days=1, seconds=API_RESET_MARGIN)
+    print(
+        "The daily API limit has been reached, waiting until"
+        f" {reset.astimezone():%Y-%m-%d %H:%M} to carry on..."
+    )
+    # the event loop's clock doesn't count time the computer spends asleep
+    while True:
+        delay = (reset - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        if delay <= 0:
+            break
+        await asyncio.sleep(min(delay, 3600))
+    # the calls from before midnight no longer count
+    global_cache.sum_api_calls()
+    api_budget.new_day()
+
+
+def cached_portfolio_count():
+    # the portfolios listed, retrieved and updated so far for the runs' collections
+    return sum(
+        section.count(run.collection_id)
+        for run in collection_runs
+        for section in (
+            global_cache.collection_overviews,
+            global_cache.portfolios_retrieved,
+            global_cache.portfolios_updated,
+        )
+    )
+
+
+async def run_until_finished(session):
+    # runs the mode again after each daily API reset until the API limit no longer stops it.
+    # the cache has everything the earlier days did, so each day carries on where the last
+    # one stopped without repeating any requests
+    global collection_runs, START
+    waited = False
+    while True:
+        count_before = cached_portfolio_count()
+        if api_budget.remaining() > 0:
+            await run_mode(session)
+            if not any(
+                run.update_log_data["api_limit_reached"] for run in collection_runs
+            ):
+                return
+
+        # the first day starts with whatever calls were left, but a whole day that got
+        # nothing done would go the same way every day after it
+        if waited and cached_portfolio_count() == count_before:
+            print(
+                "error: a whole day's API calls were used up without retrieving or"
+                " updating any portfolios, stopping instead of waiting for the next reset"
+            )
+            return
+
+        # saved before waiting, so if the tool is stopped in the meantime running it again
+        # carries on from here
+        print("Saving cache...")
+        save_cache()
+        print("Cache saved.")
+        await wait_until_api_reset()
+        waited = True
+
+        START = time.monotonic()
+        collection_runs = [run.restart() for run in collection_runs]
+        if mode != "batch":
+            current_run.set(collection_runs[0])
+
+
 def checkAPIlimit():
     if global_cache.total_api_calls_past_24_hrs >= MAX_API_CALLS_PER_DAY:
         print("According to the cache record, API calls have hit the configured limit")
@@ -1131,30 +3901,47 @@ def checkAPIlimit():
 
 
 async def main():
-    load_cache()
-
-    async with aiohttp.ClientSession() as session:
-        session = RateLimiter(session)
-
-        if mode == "update":
-            if checkAPIlimit():
-                return
+    global profiler, collection_runs
+    profiler = PhaseProfiler(profile_run)
+    profiler.install_task_timer(asyncio.get_running_loop())
+
+    if mode == "batch":
+        if batch_run_mode not in ("review", "update"):
+            print("error: batch_run_mode must be 'review' or 'update'")
+            return
+        try:
+            collection_runs = read_batch_manifest()
+        except (OSError, KeyError) as error:
+            print(f"Could not read the batch manifest {batch_manifest}: {error}")
+            return
+        if not collection_runs:
+            print(f"No collections are listed in {batch_manifest}")
+            return
+    else:
+        collection_runs = [
+            CollectionRun(
+                mode,
+                collectionid,
+                serviceid,
+                public_access_model_code,
+                public_access_model_description,
+            )
+        ]
+        current_run.set(collection_runs[0])
 
-            await update_mode(session)
-            print("Preparing logs. Please wait ...")
-            save_port_log()
-            save_error_log()
-            print("Logs complete.")
+    with profiler.phase("load_cache"):
+        load_cache()
 
-        elif mode == "review":
-            if checkAPIlimit():
-                return
+    async with HttpTransport() as transport:
+        session = RateLimiter(transport)
 
-            await review_mode(session)
-            print("Preparing logs. Please wait ...")
-            save_port_log()
-            save_error_log()
-            print("Logs complete.")
+        if mode in ("update", "review", "retry_failed", "batch"):
+            if wait_for_api_reset:
+                await run_until_finished(session)
+            else:
+                if checkAPIlimit():
+                    return
+                await run_mode(session)
 
         elif mode == "clear_cache_all":
             print("Clearing all cache...")
@@ -1167,6 +3954,7 @@ async def main():
             global_cache.remove_all_portfolios_ready_to_update_by_collection()
             global_cache.remove_all_portfolios_retrieved_by_collection()
             global_cache.remove_all_portfolios_updated_by_collection()
+            global_cache.remove_all_failed_requests_by_collection()
             print("Cache cleared.")
 
         elif mode == "clear_cache_portfolios":
@@ -1232,15 +4020,34 @@ async def main():
                     filtered_ports
                 )
 
+            # get portfolio from the failed requests
+            print("Checking failed requests...")
+            cache_ports = global_cache.get_failed_requests()
+            filtered_ports = list(
+                filter(lambda port: id_to_remove in port["id"], cache_ports)
+            )
+            if len(filtered_ports) < 1:
+                print("Portfolio ID not found in Failed Requests.")
+            else:
+                print("Found ID, removal in process...")
+                filtered_ports = filtered_ports[0]
+
+                global_cache.remove_failed_request(filtered_ports["id"])
+
             print("Selected portfolios removed from cache.")
 
         else:
             print("error: mode variable value not recognized")
 
     print("Saving cache...")
-    save_cache()
+    with profiler.phase("save_cache"):
+        save_cache()
     print("Cache saved.")
+    profiler.save()
+
 
+if __name__ == "__main__":
+    from wakepy import keepawake
 
-with keepawake(keep_screen_awake=False):
-    asyncio.run(main())
+    with keepawake(keep_screen_awake=False):
+        asyncio.run(main())
@@ -0,0 +1,154 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    clock.monotonic = lambda: clock.now
+    monkeypatch.setattr(main, "time", clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def collection():
+    token = main.current_run.set(review_run("61000000000000000"))
+    yield
+    main.current_run.reset(token)
+
+
+def review_run(collection_id):
+    return main.CollectionRun("review", collection_id, "62000000000000000", "", "")
+
+
+def test_limit_grows_by_one_request_per_round_trip():
+    concurrency = main.AdaptiveConcurrency(10)
+    concurrency.in_flight = 10
+    for _ in range(10):
+        concurrency.record_response(200, 0.2)
+
+    assert concurrency.limit == pytest.approx(11, abs=0.05)
+
+
+def test_limit_only_grows_while_it_is_being_used():
+    concurrency = main.AdaptiveConcurrency(10)
+    concurrency.in_flight = 4
+    for _ in range(10):
+        concurrency.record_response(200, 0.2)
+
+    assert concurrency.limit == 10
+
+
+def test_rising_latency_stops_the_limit_growing():
+    concurrency = main.AdaptiveConcurrency(10)
+    concurrency.in_flight = 10
+    concurrency.record_response(200, 0.2)
+    for _ in range(20):
+        concurrency.record_response(200, 2.0)
+    limit = concurrency.limit
+    concurrency.record_response(200, 2.0)
+
+    assert concurrency.smoothed_latency > concurrency.baseline_latency * 1.5
+    assert concurrency.limit == limit
+
+
+def test_limit_is_capped():
+    concurrency = main.AdaptiveConcurrency(main.AdaptiveConcurrency.MAX_LIMIT)
+    concurrency.in_flight = concurrency.MAX_LIMIT
+    concurrency.record_response(200, 0.2)
+
+    assert concurrency.limit == concurrency.MAX_LIMIT
+
+
+def test_failures_halve_the_limit_once_per_round_trip(clock):
+    concurrency = main.AdaptiveConcurrency(40)
+    concurrency.record_response(200, 0.5)
+    concurrency.record_response(503, 0.5)
+    concurrency.record_response(429, 0.5)
+    concurrency.record_failure()
+    assert concurrency.limit == 20
+    assert concurrency.decreases == 1
+
+    clock.now += 0.5
+    concurrency.record_failure()
+    assert concurrency.limit == 10
+
+    for _ in range(10):
+        clock.now += 0.5
+        concurrency.record_failure()
+    assert concurrency.limit == concurrency.MIN_LIMIT
+
+
+def test_waiters_get_a_slot_in_the_order_they_asked(clock):
+    concurrency = main.AdaptiveConcurrency(2)
+    order = []
+
+    async def request(name):
+        async with concurrency:
+            order.append(name)
+            await asyncio.sleep(0)
+
+    async def requests():
+        await asyncio.gather(*(request(name) for name in "abcde"))
+
+    asyncio.run(requests())
+
+    assert order == list("abcde")
+    assert concurrency.in_flight == 0
+    assert not concurrency.waiters
+
+
+def test_cancelled_waiter_gives_up_its_place(clock):
+    concurrency = main.AdaptiveConcurrency(2)
+
+    async def cancel():
+        await concurrency.acquire()
+        await concurrency.acquire()
+        waiter = asyncio.create_task(concurrency.acquire())
+        await asyncio.sleep(0)
+        assert concurrency.in_flight == 2
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        concurrency.release()
+
+    asyncio.run(cancel())
+
+    assert concurrency.in_flight == 1
+    assert not concurrency.waiters
+
+
+def test_collections_take_turns_at_the_free_slots(clock):
+    concurrency = main.AdaptiveConcurrency(2)
+    order = []
+
+    async def request(collection_id, number):
+        main.current_run.set(review_run(collection_id))
+        async with concurrency:
+            order.append(f"{collection_id}{number}")
+            await asyncio.sleep(0)
+
+    async def requests():
+        # the large collection queues all its requests before the small one
+        await concurrency.acquire()
+        await concurrency.acquire()
+        large = [asyncio.create_task(request("a", number)) for number in range(4)]
+        small = [asyncio.create_task(request("b", number)) for number in range(2)]
+        await asyncio.sleep(0)
+        concurrency.release()
+        concurrency.release()
+        await asyncio.gather(*large, *small)
+
+    asyncio.run(requests())
+
+    assert order == ["a0", "b0", "a1", "b1", "a2", "a3"]
+    assert concurrency.in_flight == 0
+    assert not concurrency.waiters
@@ -0,0 +1,226 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+PORTFOLIO_URL = main.BASEURL + "/e-collections/1/e-services/2/portfolios/3"
+
+
+@pytest.fixture
+def budget(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    journal = main.CacheJournal("cache.journal")
+    journal.open()
+    monkeypatch.setattr(main, "global_cache", main.Cache(), raising=False)
+    monkeypatch.setattr(main, "cache_journal", journal, raising=False)
+    monkeypatch.setattr(main, "api_metrics", main.Metrics())
+    budget = main.ApiBudget()
+    monkeypatch.setattr(main, "api_budget", budget)
+    run = main.CollectionRun("review", "61000000000000000", "62000000000000000", "", "")
+    token = main.current_run.set(run)
+    yield budget
+    main.current_run.reset(token)
+    journal.close()
+
+
+def calls_left(count):
+    # as if the rest of the day's calls had been made earlier
+    main.global_cache.api_calls_logged.append(
+        {
+            "count": main.MAX_API_CALLS_PER_DAY - count,
+            "time": main.datetime.datetime.now().astimezone().isoformat(),
+        }
+    )
+    main.global_cache.sum_api_calls()
+
+
+def booked(budget):
+    # the committed, refunded and reserved calls
+    stats = budget.stats()
+    return stats["committed"], stats["refunded"], stats["reserved"]
+
+
+class FakeRequest:
+    # stands in for an aiohttp request context manager
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return types.SimpleNamespace(
+            status=self.status, headers=self.headers, content_length=0
+        )
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+def test_reservations_are_limited_by_the_calls_left(budget):
+    calls_left(2)
+
+    assert budget.reserve()
+    assert budget.reserve()
+    assert not budget.reserve()
+    assert budget.available() == 0
+
+
+def test_commit_counts_the_call_in_the_cache_and_the_journal(budget):
+    calls_left(2)
+    budget.reserve()
+    budget.commit()
+
+    assert booked(budget) == (1, 0, 0)
+    assert main.global_cache.get_remaining_api_calls() == 1
+    assert budget.available() == 1
+
+    main.cache_journal.close()
+    replayed_into = main.Cache()
+    main.CacheJournal("cache.journal").replay(replayed_into)
+    assert replayed_into.total_api_calls_past_24_hrs == 1
+
+
+def test_refund_frees_the_call_without_counting_it(budget):
+    calls_left(1)
+    budget.reserve()
+    budget.refund()
+
+    assert booked(budget) == (0, 1, 0)
+    assert main.global_cache.get_remaining_api_calls() == 1
+    assert budget.reserve()
+
+
+def test_request_is_not_sent_when_the_budget_is_used_up(budget):
+    calls_left(0)
+    limiter = main.RateLimiter(main.HttpTransport())
+
+    with pytest.raises(main.ApiBudgetExhausted):
+        asyncio.run(limiter.reserve_call())
+    assert budget.stats()["reserved"] == 0
+    assert limiter.stats()["requests"] == 0
+
+
+def test_call_waiting_for_the_rate_limiter_is_refunded_on_cancel(budget):
+    calls_left(5)
+    limiter = main.RateLimiter(main.HttpTransport())
+    limiter.tokens = 0
+
+    async def cancel():
+        waiter = asyncio.create_task(limiter.reserve_call())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(cancel())
+
+    assert booked(budget) == (0, 1, 0)
+
+
+def test_each_retry_books_its_own_call(budget, monkeypatch):
+    calls_left(5)
+    limiter = main.RateLimiter(main.HttpTransport())
+    monkeypatch.setattr(limiter, "RETRY_BASE_DELAY", 0.0)
+    responses = iter([503, 503, 200])
+
+    def method(*args, **kwargs):
+        return FakeRequest(next(responses))
+
+    async def request():
+        await limiter.reserve_call()
+        return await main.ApiRequest(
+            limiter, "GET", method, (PORTFOLIO_URL,), {}
+        ).__aenter__()
+
+    response = asyncio.run(request())
+
+    assert response.status == 200
+    assert booked(budget) == (3, 0, 0)
+    assert main.global_cache.get_remaining_api_calls() == 2
+
+
+def test_retry_stops_when_the_budget_cant_cover_it(budget, monkeypatch):
+    calls_left(1)
+    limiter = main.RateLimiter(main.HttpTransport())
+
+    async def request():
+        await limiter.reserve_call()
+        return await main.ApiRequest(
+            limiter, "GET", lambda *args: FakeRequest(503), (PORTFOLIO_URL,), {}
+        ).__aenter__()
+
+    response = asyncio.run(request())
+
+    assert response.status == 503
+    assert booked(budget) == (1, 0, 0)
+    assert limiter.retries == 0
+
+
+def test_institution_headroom_counts_down_from_almas_report(budget, monkeypatch):
+    monkeypatch.setattr(main, "INSTITUTION_API_RESERVE", 100)
+    assert budget.institution_headroom() is None
+
+    budget.observe_remaining("600")
+    assert budget.institution_headroom() == 500
+    for _ in range(3):
+        budget.reserve()
+        budget.commit()
+    assert budget.institution_headroom() == 497
+
+    # a missing or unreadable header leaves the last report in place
+    budget.observe_remaining(None)
+    budget.observe_remaining("lots")
+    assert budget.institution_headroom() == 497
+    assert budget.stats()["institution_remaining"] == 600
+
+
+def test_budget_is_the_smaller_of_the_tools_and_the_institutions(budget, monkeypatch):
+    monkeypatch.setattr(main, "INSTITUTION_API_RESERVE", 100)
+    calls_left(50)
+    budget.observe_remaining("1000")
+    assert budget.remaining() == 50
+
+    budget.observe_remaining("120")
+    assert budget.remaining() == 20
+    budget.observe_remaining("80")
+    assert budget.remaining() == 0
+    assert not budget.reserve()
+
+
+def test_remaining_header_is_read_from_every_response(budget, monkeypatch):
+    monkeypatch.setattr(main, "INSTITUTION_API_RESERVE", 100)
+    limiter = main.RateLimiter(main.HttpTransport())
+    headers = {main.API_REMAINING_HEADER: "350"}
+
+    async def request():
+        await limiter.reserve_call()
+        return await main.ApiRequest(
+            limiter,
+            "GET",
+            lambda *args: FakeRequest(200, headers),
+            (PORTFOLIO_URL,),
+            {},
+        ).__aenter__()
+
+    asyncio.run(request())
+
+    assert budget.institution_headroom() == 250
+
+
+def test_rate_slows_down_as_the_institutions_headroom_runs_out(budget, monkeypatch):
+    monkeypatch.setattr(main, "INSTITUTION_API_RESERVE", 0)
+    monkeypatch.setattr(main, "SLOWDOWN_HEADROOM", 1000)
+    limiter = main.RateLimiter(main.HttpTransport())
+    assert limiter.rate() == limiter.RATE
+
+    budget.observe_remaining("1000")
+    assert limiter.rate() == limiter.RATE
+    budget.observe_remaining("500")
+    assert limiter.rate() == limiter.RATE / 2
+    budget.observe_remaining("0")
+    assert limiter.rate() == limiter.MIN_RATE
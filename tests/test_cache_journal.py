@@ -0,0 +1,228 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+COLLECTION_ID = "61000000000000000"
+
+
+def portfolio(id, pam_value=""):
+    return {
+        "id": id,
+        "resource_metadata": {"title": f"Title {id}", "mms_id": {"value": f"99{id}"}},
+        "public_access_model": {"value": pam_value, "desc": None},
+    }
+
+
+@pytest.fixture(autouse=True)
+def collection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run = main.CollectionRun("update", COLLECTION_ID, "62000000000000000", "UA", "")
+    token = main.current_run.set(run)
+    yield run
+    main.current_run.reset(token)
+
+
+@pytest.fixture
+def prepared_cache():
+    # the cache after an update that was stopped part way: 1 is queued for updating and
+    # its retrieved copy already has the new PAM, 2 already had a PAM, 3 was updated
+    cache = main.Cache()
+    queued = portfolio("1", "UA")
+    cache.portfolios_retrieved.add(COLLECTION_ID, [queued, portfolio("2", "OA")])
+    cache.portfolios_retrieved.add(COLLECTION_ID, [portfolio("3", "UA")])
+    cache.portfolios_ready_to_update.add(COLLECTION_ID, [queued])
+    cache.portfolios_not_updating.add(COLLECTION_ID, [portfolio("2", "OA")])
+    cache.portfolios_updated.add(COLLECTION_ID, [portfolio("3", "UA")])
+    return cache
+
+
+def replay(cache, *entries):
+    # writes the journal a crashed run would have left and replays it into cache
+    journal = main.CacheJournal("cache.journal")
+    journal.open()
+    for op, *args in entries:
+        getattr(journal, "record_" + op)(*args)
+    journal.close()
+    return journal.replay(cache)
+
+
+def test_pipelined_update_resumes_with_the_queued_portfolios(
+    prepared_cache, monkeypatch
+):
+    # the stopped run is carried on with one portfolio still to retrieve
+    updated = []
+
+    async def get_collection_overview(session):
+        return 4
+
+    async def get_port_ids(session, number_of_portfolios):
+        return ["1", "2", "3", "4"]
+
+    async def get_port_api(sem, session, id, *args):
+        return portfolio(id)
+
+    async def update_port(sem, session, port, *args):
+        updated.append(port["id"])
+        return port
+
+    monkeypatch.setattr(main, "global_cache", prepared_cache, raising=False)
+    monkeypatch.setattr(main, "get_collection_overview", get_collection_overview)
+    monkeypatch.setattr(main, "get_port_ids", get_port_ids)
+    monkeypatch.setattr(main, "get_port_api", get_port_api)
+    monkeypatch.setattr(main, "update_port", update_port)
+    session = types.SimpleNamespace(concurrency=None)
+
+    asyncio.run(main.pipelined_update_mode(session))
+
+    assert sorted(updated) == ["1", "4"]
+    assert prepared_cache.portfolios_updated.ids(COLLECTION_ID) == ["3", "1", "4"]
+    assert prepared_cache.portfolios_ready_to_update.ids(COLLECTION_ID) == []
+    assert prepared_cache.portfolios_not_updating.ids(COLLECTION_ID) == ["2"]
+
+
+def test_pipelined_replay_keeps_the_queued_portfolios(prepared_cache):
+    replay(prepared_cache, ("retrieved", portfolio("4"), "portfolio"))
+
+    assert prepared_cache.portfolios_ready_to_update.ids(COLLECTION_ID) == ["1"]
+    assert prepared_cache.portfolios_not_updating.ids(COLLECTION_ID) == ["2"]
+    assert prepared_cache.portfolios_updated.ids(COLLECTION_ID) == ["3"]
+    assert prepared_cache.has_retrieved_portfolio("4")
+    # the new portfolio is prepared from the copy that was journaled before it was changed
+    retrieved = prepared_cache.get_retrieved_portfolio("4")
+    assert retrieved["public_access_model"]["value"] == ""
+
+
+def test_pipelined_replay_clears_a_retrieved_portfolios_own_preparation(
+    prepared_cache,
+):
+    replay(prepared_cache, ("retrieved", portfolio("2", "OA"), "portfolio"))
+
+    assert prepared_cache.portfolios_not_updating.ids(COLLECTION_ID) == []
+    assert prepared_cache.portfolios_ready_to_update.ids(COLLECTION_ID) == ["1"]
+    assert prepared_cache.portfolios_updated.ids(COLLECTION_ID) == ["3"]
+
+
+def test_retry_failed_replay_keeps_the_prepared_portfolios(prepared_cache, monkeypatch):
+    failure = {
+        "id": "4",
+        "operation": "get",
+        "status_code": 500,
+        "attempts": 4,
+        "failed_at": "2026-10-16T00:00:00+00:00",
+    }
+    prepared_cache.failed_requests.add(COLLECTION_ID, [failure])
+    replay(prepared_cache, ("retrieved", portfolio("4"), None))
+
+    assert prepared_cache.portfolios_ready_to_update.ids(COLLECTION_ID) == ["1"]
+    assert prepared_cache.portfolios_not_updating.ids(COLLECTION_ID) == ["2"]
+    assert prepared_cache.portfolios_updated.ids(COLLECTION_ID) == ["3"]
+    assert prepared_cache.count_failed_requests() == 0
+
+    # the next update run prepares the retried portfolio along with the ones it
+    # already had, and the queued one stays queued even though its copy has the new PAM
+    monkeypatch.setattr(main, "global_cache", prepared_cache, raising=False)
+    portfolios_to_update = main.prepare_portfolios_for_update(
+        prepared_cache.get_retrieved_portfolios()
+    )
+    assert [port["id"] for port in portfolios_to_update] == ["1", "4"]
+    assert prepared_cache.portfolios_not_updating.ids(COLLECTION_ID) == ["2"]
+
+
+def test_get_portfolios_replay_clears_the_collections_preparation(prepared_cache):
+    replay(
+        prepared_cache,
+        ("retrieved", portfolio("1")),
+        ("retrieved", portfolio("4")),
+        ("updated", portfolio("4", "UA")),
+    )
+
+    # the collection is prepared again from the new copies, only the journaled update stays
+    assert prepared_cache.portfolios_ready_to_update.ids(COLLECTION_ID) == []
+    assert prepared_cache.portfolios_not_updating.ids(COLLECTION_ID) == []
+    assert prepared_cache.portfolios_updated.ids(COLLECTION_ID) == ["4"]
+    assert prepared_cache.get_retrieved_portfolio("1")["public_access_model"] == {
+        "value": "",
+        "desc": None,
+    }
+    assert prepared_cache.get_retrieved_portfolio("4")["public_access_model"] == {
+        "value": "UA",
+        "desc": None,
+    }
+
+
+def test_replay_of_an_older_journal_clears_the_collections_preparation(
+    prepared_cache,
+):
+    # journals from before the prepared field all came from get_portfolios
+    with open("cache.journal", "wb") as journal:
+        entry = {
+            "op": "retrieved",
+            "data": portfolio("4"),
+            "collection_id": COLLECTION_ID,
+            "time": main.time.time(),
+            "api_calls": 1,
+        }
+        journal.write(main.serializer.dumps(entry) + b"\n")
+    main.CacheJournal("cache.journal").replay(prepared_cache)
+
+    assert prepared_cache.portfolios_ready_to_update.ids(COLLECTION_ID) == []
+    assert prepared_cache.portfolios_not_updating.ids(COLLECTION_ID) == []
+    assert prepared_cache.portfolios_updated.ids(COLLECTION_ID) == []
+    assert prepared_cache.total_api_calls_past_24_hrs == 1
+
+
+def test_replay_counts_api_calls_and_failures():
+    cache = main.Cache()
+    failure = {
+        "id": "5",
+        "operation": "put",
+        "status_code": 429,
+        "attempts": 4,
+        "failed_at": "2026-10-16T00:00:00+00:00",
+    }
+    replayed = replay(cache, ("api_call",), ("api_call",), ("failed", failure))
+
+    assert replayed == 3
+    assert cache.total_api_calls_past_24_hrs == 2
+    assert cache.get_failed_request("5") == failure
+
+
+def test_migrate_legacy_cache(monkeypatch):
+    saved = main.datetime.datetime.now().astimezone().isoformat()
+    now = main.time.time()
+
+    def section(time_key, records):
+        return [{"collection_id": COLLECTION_ID, time_key: now, "data": records}]
+
+    legacy_cache = {
+        "collection_overviews": section("retrieved", [{"id": "1"}, {"id": "2"}]),
+        "portfolios_retrieved": section("retrieved", [portfolio("1"), portfolio("2")]),
+        "portfolios_updated": section("updated", [portfolio("1", "UA")]),
+        "portfolios_ready_to_update": [],
+        "portfolios_not_updating": section("saved", [portfolio("2", "OA")]),
+        "failed_requests": [],
+        "api_calls_logged": [{"count": 7, "time": saved}],
+        "total_api_calls_past_24_hrs": 7,
+    }
+    with open(main.LEGACY_CACHE_FILE, "wb") as cache_file:
+        cache_file.write(main.serializer.dumps(legacy_cache))
+    monkeypatch.setattr(main, "cache_store", main.CacheStore("cache.db"), raising=False)
+
+    main.migrate_legacy_cache()
+    cache = main.cache_store.load([COLLECTION_ID])
+    main.cache_store.close()
+
+    assert cache.get_overview_port_ids() == ["1", "2"]
+    assert cache.get_retrieved_port_ids() == ["1", "2"]
+    assert cache.portfolios_updated.ids(COLLECTION_ID) == ["1"]
+    assert cache.portfolios_not_updating.ids(COLLECTION_ID) == ["2"]
+    assert cache.total_api_calls_past_24_hrs == 7
+    assert not os.path.exists(main.LEGACY_CACHE_FILE)
+    assert os.path.exists(main.LEGACY_CACHE_FILE + ".migrated")
@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import sys
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+COLLECTION_ID = "61000000000000000"
+
+
+def portfolio(id):
+    return {
+        "id": id,
+        "resource_metadata": {"title": f"Title {id}", "mms_id": {"value": f"99{id}"}},
+        "public_access_model": {"value": "", "desc": None},
+    }
+
+
+@pytest.fixture(autouse=True)
+def collection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run = main.CollectionRun("review", COLLECTION_ID, "62000000000000000", "", "")
+    token = main.current_run.set(run)
+    yield run
+    main.current_run.reset(token)
+
+
+def load(path="cache.db"):
+    store = main.CacheStore(path)
+    return store, store.load([COLLECTION_ID])
+
+
+def test_records_are_stored_compressed_in_a_blob():
+    cache = main.Cache()
+    cache.collection_overviews.add(COLLECTION_ID, [{"id": "1"}])
+    cache.portfolios_retrieved.add(COLLECTION_ID, [portfolio("1")])
+    store = main.CacheStore("cache.db")
+    store.save(cache)
+
+    for table in ("portfolios", "portfolio_records"):
+        types = {
+            row[1]: row[2]
+            for row in store.connection.execute(f"PRAGMA table_info({table})")
+        }
+        assert types["data"] == "BLOB"
+    compressed = store.connection.execute(
+        "SELECT compressed FROM portfolio_records"
+    ).fetchall()
+    assert compressed == [(1,)]
+    store.close()
+
+    store, cache = load()
+    assert cache.get_overview_port_ids() == ["1"]
+    assert cache.get_retrieved_portfolio("1") == portfolio("1")
+    store.close()
+
+
+def test_older_database_is_read_by_its_own_format():
+    # cache.db as written before the compressed column, with plain JSON rows from
+    # before the records were compressed next to zlib compressed ones
+    with sqlite3.connect("cache.db") as connection:
+        connection.execute(
+            "CREATE TABLE portfolios (section TEXT NOT NULL,"
+            " collection_id TEXT NOT NULL, portfolio_id TEXT NOT NULL,"
+            " timestamp REAL NOT NULL, data TEXT NOT NULL,"
+            " PRIMARY KEY (section, collection_id, portfolio_id))"
+        )
+        connection.execute(
+            "CREATE TABLE portfolio_records (collection_id TEXT NOT NULL,"
+            " portfolio_id TEXT NOT NULL, title TEXT, mms_id TEXT, pam_value TEXT,"
+            " pam_description TEXT, data TEXT NOT NULL,"
+            " PRIMARY KEY (collection_id, portfolio_id))"
+        )
+        now = main.time.time()
+        connection.executemany(
+            "INSERT INTO portfolios VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    "collection_overviews",
+                    COLLECTION_ID,
+                    "1",
+                    now,
+                    main.serializer.dumps({"id": "1"}),
+                ),
+                (
+                    "collection_overviews",
+                    COLLECTION_ID,
+                    "2",
+                    now,
+                    zlib.compress(main.serializer.dumps({"id": "2"})),
+                ),
+                ("portfolios_retrieved", COLLECTION_ID, "1", now, ""),
+                ("portfolios_retrieved", COLLECTION_ID, "2", now, ""),
+            ],
+        )
+        connection.executemany(
+            "INSERT INTO portfolio_records VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    COLLECTION_ID,
+                    "1",
+                    "Title 1",
+                    "991",
+                    "",
+                    None,
+                    main.serializer.dumps(portfolio("1")),
+                ),
+                (
+                    COLLECTION_ID,
+                    "2",
+                    "Title 2",
+                    "992",
+                    "",
+                    None,
+                    zlib.compress(main.serializer.dumps(portfolio("2"))),
+                ),
+            ],
+        )
+    connection.close()
+
+    store, cache = load()
+
+    assert cache.get_overview_port_ids() == ["1", "2"]
+    assert cache.get_retrieved_portfolio("1") == portfolio("1")
+    assert cache.get_retrieved_portfolio("2") == portfolio("2")
+    summary = cache.portfolio_records.summary(COLLECTION_ID, "2")
+    assert summary.has_pam_description
+    store.close()
@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+PORTFOLIO_URL = main.BASEURL + "/e-collections/1/e-services/2/portfolios/3"
+
+
+def run_metrics():
+    metrics = main.Metrics()
+    metrics.record_response("GET", PORTFOLIO_URL, 200, 0.3, 0)
+    metrics.record_response("PUT", PORTFOLIO_URL, 429, 0.1, 512)
+    metrics.record_connection_error("GET", PORTFOLIO_URL, 0)
+    metrics.record_bytes_received("GET", PORTFOLIO_URL, 2048)
+    return metrics
+
+
+def exported_types(prometheus_text):
+    return dict(
+        line.split()[2:4]
+        for line in prometheus_text.splitlines()
+        if line.startswith("# TYPE")
+    )
+
+
+def test_last_runs_figures_are_exported_as_gauges():
+    prometheus_text = run_metrics().prometheus_text(
+        {"run_duration_seconds": (12.5, "Length of the last run.")}
+    )
+    types = exported_types(prometheus_text)
+
+    assert "counter" not in types.values()
+    for name in (
+        "requests",
+        "connection_errors",
+        "request_body_bytes",
+        "response_body_bytes",
+        "run_duration_seconds",
+    ):
+        assert types["alma_pam_tool_" + name] == "gauge"
+    assert types["alma_pam_tool_request_duration_seconds"] == "histogram"
+    assert (
+        'alma_pam_tool_requests{method="PUT",endpoint="portfolio",status="429"} 1'
+        in prometheus_text.splitlines()
+    )
+    assert (
+        'alma_pam_tool_response_body_bytes{method="GET",endpoint="portfolio"} 2048'
+        in prometheus_text.splitlines()
+    )
+
+
+def test_metrics_survive_the_serializer():
+    metrics = run_metrics().as_dict()
+
+    assert main.serializer.loads(main.serializer.dumps(metrics)) == metrics
@@ -0,0 +1,264 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+COLLECTION_ID = "61000000000000000"
+
+
+def portfolio(id, public_access_model):
+    return {
+        "id": id,
+        "resource_metadata": {"title": f"Title {id}", "mms_id": {"value": f"99{id}"}},
+        "public_access_model": public_access_model,
+    }
+
+
+DESCRIBED = portfolio("1", {"value": "UA", "desc": "Unpaywall"})
+DESC_NONE = portfolio("2", {"value": "", "desc": None})
+NO_DESC = portfolio("3", {"value": ""})
+
+
+def description(port):
+    entry = main.port_log_format(port, 1, 1)
+    return entry.split(" Description: ")[1].split("\n")[0]
+
+
+def test_a_desc_of_none_is_logged_apart_from_a_missing_one():
+    summaries = [
+        main.PortfolioSummary.from_portfolio(port)
+        for port in (DESCRIBED, DESC_NONE, NO_DESC)
+    ]
+
+    assert [description(summary) for summary in summaries] == [
+        "Unpaywall",
+        "None",
+        " ",
+    ]
+
+
+@pytest.mark.parametrize("older_database", [False, True])
+def test_cached_summaries_keep_whether_the_pam_has_a_desc(tmp_path, older_database):
+    path = str(tmp_path / "cache.db")
+    cache = main.Cache()
+    cache.portfolios_retrieved.add(COLLECTION_ID, [DESCRIBED, DESC_NONE, NO_DESC])
+    store = main.CacheStore(path)
+    store.save(cache)
+    store.close()
+    if older_database:
+        with sqlite3.connect(path) as connection:
+            connection.execute(
+                "ALTER TABLE portfolio_records DROP COLUMN has_pam_description"
+            )
+
+    store = main.CacheStore(path)
+    loaded = store.load([COLLECTION_ID])
+    store.close()
+
+    summaries = [
+        loaded.portfolio_records.summary(COLLECTION_ID, port["id"])
+        for port in (DESCRIBED, DESC_NONE, NO_DESC)
+    ]
+    assert [description(summary) for summary in summaries] == [
+        "Unpaywall",
+        "None",
+        " ",
+    ]
+
+
+# the port log as the tool first wrote it, from full portfolio records. the log is
+# now built from summaries and written section by section, the output must not change
+def baseline_port_log_format(port, count, total):
+    if "desc" in port["public_access_model"]:
+        desc = str(port["public_access_model"]["desc"])
+    else:
+        desc = " "
+
+    log_lines = (
+        str(count)
+        + "/"
+        + str(total)
+        + "\n"
+        + "Title: "
+        + port["resource_metadata"]["title"]
+        + "\n"
+        + "MMS ID: "
+        + port["resource_metadata"]["mms_id"]["value"]
+        + "\n"
+        + "Public Access Model: "
+        + str(port["public_access_model"]["value"] + "; ")
+        + " Description: "
+        + desc
+        + "\n"
+        + "Portfolio ID: "
+        + port["id"]
+        + ("\n" * 2)
+    )
+
+    return log_lines
+
+
+def baseline_review_log(review_log_data, elapsed):
+    num_portfolios_reviewed = len(review_log_data["reviewed_portfolios"])
+    list_of_pam_types = list(review_log_data["pam_types"])
+    detailed_log = ""
+    if review_log_data["api_limit_reached"]:
+        api_limit_reached = "\n API limit prevented finishing the review. \n"
+    else:
+        api_limit_reached = ""
+
+    list_of_pams_log_header = "Following PAMS found in collected portfolios:\n"
+
+    for pam in list_of_pam_types:
+        temp_list = []
+
+        detailed_log += f"\n{'-'*20} Portfolios with a PAM that is {'blank' if pam == '' else pam } {'-'*20}\n\n"
+        for port in review_log_data["reviewed_portfolios"]:
+            if port["public_access_model"]["value"] == pam:
+                temp_list.append(port)
+
+        total = len(temp_list)
+
+        for count, port in enumerate(temp_list, start=1):
+            port_log = baseline_port_log_format(port, count, total)
+            detailed_log += port_log
+
+        list_of_pams_log_header += f"{'blank' if pam == '' else pam }: {total}\n"
+
+    return (
+        (
+            f"Number of Portfolios Reviewed: {num_portfolios_reviewed} out of {review_log_data['total_in_collection']} \n"
+            f"Portfolio Review time: {elapsed} \n"
+            f"Total time elapsed: {elapsed} \n"
+            f"\n {'-'*20} {num_portfolios_reviewed}/{review_log_data['total_in_collection']} Portfolios Reviewed {'-'*20} \n"
+        )
+        + list_of_pams_log_header
+        + api_limit_reached
+        + detailed_log
+    )
+
+
+def baseline_update_log(
+    update_log_data, updated, ready_to_update, not_updating_portfolios, elapsed
+):
+    num_portfolios_updated = len(update_log_data["updated_portfolios"])
+    total_num_portfolios_updated = len(updated)
+    num_of_unchanged_ports = len(not_updating_portfolios)
+    num_update_failed_portfolios = len(update_log_data["update_failed_portfolios"])
+
+    if update_log_data["api_limit_reached"]:
+        api_limit_reached = "\n API limit prevented finishing the review. \n"
+    else:
+        api_limit_reached = ""
+
+    detailed_log = f"\n{'-'*20}Portfolios That Failed to Update{'-'*20}\n\n"
+
+    for num, port in enumerate(update_log_data["update_failed_portfolios"], start=1):
+        detailed_log += baseline_port_log_format(
+            port, num, num_update_failed_portfolios
+        )
+
+    detailed_log += f"\n{'-'*20}Portfolios That Updated This Run{'-'*20}\n\n"
+
+    for num, port in enumerate(update_log_data["updated_portfolios"], start=1):
+        detailed_log += baseline_port_log_format(port, num, num_portfolios_updated)
+
+    detailed_log += f"\n{'-'*20}Portfolios That Were Set In Alma Already{'-'*20}\n\n"
+
+    for num, port in enumerate(not_updating_portfolios, start=1):
+        detailed_log += baseline_port_log_format(port, num, num_of_unchanged_ports)
+
+    return (
+        (
+            f"Total Portfolios Updated Across All Runs (according to cache): {total_num_portfolios_updated} out of {total_num_portfolios_updated + len(ready_to_update)} \n"
+            f"Portfolio Update time: {elapsed} \n"
+            f"Total time elapsed: {elapsed} \n"
+            f"{'-'*20} {num_portfolios_updated}/{num_portfolios_updated + num_update_failed_portfolios} Portfolios Updated This Run {'-'*20}\n"
+        )
+        + api_limit_reached
+        + detailed_log
+    )
+
+
+ELAPSED = " 00 hrs: 01 mins: 05 secs."
+
+
+@pytest.fixture
+def port_log(tmp_path, monkeypatch):
+    # runs save_port_log for run and returns what it wrote
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "time_convert", lambda sec: ELAPSED)
+
+    def save(run):
+        token = main.current_run.set(run)
+        try:
+            main.save_port_log()
+        finally:
+            main.current_run.reset(token)
+        (name,) = os.listdir(tmp_path)
+        with open(tmp_path / name, encoding="utf-8") as log_file:
+            return log_file.read()
+
+    return save
+
+
+REVIEWED = [
+    DESCRIBED,
+    DESC_NONE,
+    NO_DESC,
+    portfolio("4", {"value": "OA", "desc": "Open access"}),
+    portfolio("5", {"value": "UA", "desc": ""}),
+    portfolio("6", {"value": "", "desc": "Blank"}),
+]
+
+
+@pytest.mark.parametrize("api_limit_reached", [False, True])
+def test_review_log_matches_the_original_format(port_log, api_limit_reached):
+    run = main.CollectionRun("review", COLLECTION_ID, "62000000000000000", "", "")
+    run.review_log_data["reviewed_portfolios"] = [
+        main.PortfolioSummary.from_portfolio(port) for port in REVIEWED
+    ]
+    run.review_log_data["pam_types"] = {"UA", "", "OA"}
+    run.review_log_data["total_in_collection"] = 8
+    run.review_log_data["api_limit_reached"] = api_limit_reached
+    baseline_data = dict(run.review_log_data, reviewed_portfolios=REVIEWED)
+
+    assert port_log(run) == baseline_review_log(baseline_data, ELAPSED)
+
+
+@pytest.mark.parametrize("api_limit_reached", [False, True])
+def test_update_log_matches_the_original_format(
+    port_log, monkeypatch, api_limit_reached
+):
+    updated = [portfolio("7", {"value": "UA", "desc": "Earlier run"}), DESCRIBED]
+    ready_to_update = [portfolio("8", {"value": "UA"})]
+    not_updating = [DESC_NONE, NO_DESC]
+    failed = [portfolio("5", {"value": "UA", "desc": ""})]
+    cache = main.Cache()
+    cache.portfolios_updated.add(COLLECTION_ID, updated)
+    cache.portfolios_ready_to_update.add(COLLECTION_ID, ready_to_update)
+    cache.portfolios_not_updating.add(COLLECTION_ID, not_updating)
+    monkeypatch.setattr(main, "global_cache", cache, raising=False)
+
+    run = main.CollectionRun("update", COLLECTION_ID, "62000000000000000", "UA", "")
+    run.update_log_data["updated_portfolios"] = [
+        main.PortfolioSummary.from_portfolio(DESCRIBED)
+    ]
+    run.update_log_data["update_failed_portfolios"] = [
+        main.PortfolioSummary.from_portfolio(port) for port in failed
+    ]
+    run.update_log_data["api_limit_reached"] = api_limit_reached
+    baseline_data = dict(
+        run.update_log_data,
+        updated_portfolios=[DESCRIBED],
+        update_failed_portfolios=failed,
+    )
+
+    assert port_log(run) == baseline_update_log(
+        baseline_data, updated, ready_to_update, not_updating, ELAPSED
+    )
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # the limiter's clock stands still, so every wait comes from the tokens alone
+    clock = types.SimpleNamespace(now=1000.0)
+    clock.monotonic = lambda: clock.now
+    monkeypatch.setattr(main, "time", clock)
+    return clock
+
+
+def limiter():
+    return main.RateLimiter(main.HttpTransport())
+
+
+def test_burst_is_granted_without_waiting(clock):
+    rate_limiter = limiter()
+
+    async def burst():
+        for _ in range(rate_limiter.MAX_TOKENS):
+            await rate_limiter.wait_for_token()
+
+    asyncio.run(burst())
+
+    assert rate_limiter.tokens == 0
+    assert rate_limiter.stats()["requests"] == rate_limiter.MAX_TOKENS
+    assert rate_limiter.stats()["total_wait"] == 0.0
+
+
+def test_waiters_are_scheduled_for_their_own_token(clock):
+    rate_limiter = limiter()
+    rate_limiter.tokens = 0
+    granted = []
+
+    async def waiter():
+        await rate_limiter.wait_for_token()
+        granted.append(rate_limiter.total_wait)
+
+    async def queue():
+        await asyncio.gather(*(waiter() for _ in range(4)))
+
+    asyncio.run(queue())
+
+    # each caller sleeps once, until 1/RATE after the caller ahead of it,
+    # so the total wait grows by 1, 2, 3 then 4 token intervals
+    rate = rate_limiter.RATE
+    assert granted == pytest.approx([1 / rate, 3 / rate, 6 / rate, 10 / rate])
+    assert rate_limiter.tokens == -4
+    stats = rate_limiter.stats()
+    assert stats["requests"] == 4
+    assert stats["total_wait"] == pytest.approx(10 / rate)
+    assert stats["average_wait"] == pytest.approx(2.5 / rate)
+
+
+def test_tokens_refill_at_the_rate_up_to_the_bucket_size(clock):
+    rate_limiter = limiter()
+    rate_limiter.tokens = -2
+    clock.now += 1 / rate_limiter.RATE
+    rate_limiter.add_new_tokens()
+    assert rate_limiter.tokens == pytest.approx(-1)
+
+    clock.now += 60
+    rate_limiter.add_new_tokens()
+    assert rate_limiter.tokens == rate_limiter.MAX_TOKENS
+
+
+def test_cancelled_waiter_hands_its_token_back(clock):
+    rate_limiter = limiter()
+    rate_limiter.tokens = 0
+
+    async def cancel():
+        waiter = asyncio.create_task(rate_limiter.wait_for_token())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(cancel())
+
+    assert rate_limiter.tokens == 0
+    assert rate_limiter.stats()["requests"] == 0
+
+
+def test_achieved_rate_is_measured_between_the_first_and_last_grant(clock):
+    rate_limiter = limiter()
+
+    async def spread():
+        for _ in range(11):
+            await rate_limiter.wait_for_token()
+            clock.now += 0.5
+
+    asyncio.run(spread())
+
+    assert rate_limiter.stats()["achieved_rate"] == pytest.approx(2.0)
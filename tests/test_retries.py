@@ -0,0 +1,262 @@
+import asyncio
+import datetime
+import email.utils
+import os
+import sys
+import types
+
+import aiohttp
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setattr(main, "global_cache", main.Cache(), raising=False)
+    return main.RateLimiter(main.HttpTransport())
+
+
+@pytest.fixture
+def collection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "global_cache", main.Cache(), raising=False)
+    monkeypatch.setattr(main, "cache_journal", main.CacheJournal(), raising=False)
+    monkeypatch.setattr(main, "progress", main.ProgressReporter())
+    run = main.CollectionRun("update", "61000000000000000", "62000000000000000", "", "")
+    token = main.current_run.set(run)
+    main.progress.start("Retrieving", 1)
+    main.progress.start("Updating", 1)
+    yield run
+    main.current_run.reset(token)
+
+
+class FailedRequest:
+    # a request whose last attempt failed with error, raised from the response
+    # or, like a payload error, while reading it
+    def __init__(self, error, when_reading=False):
+        self.error = error
+        self.when_reading = when_reading
+        self.attempts = 4
+
+    async def __aenter__(self):
+        if not self.when_reading:
+            raise self.error
+        return types.SimpleNamespace(status=200, read=self.read)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def read(self):
+        raise self.error
+
+
+class FailingSession:
+    def __init__(self, request):
+        self.request = request
+
+    async def get(self, *args, **kwargs):
+        return self.request
+
+    async def put(self, *args, **kwargs):
+        return self.request
+
+
+class AlmaAnswer:
+    # a request Alma answers with status and body
+    def __init__(self, status, body=b"", headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return types.SimpleNamespace(
+            status=self.status,
+            headers=self.headers,
+            content_length=len(self.body),
+            content=types.SimpleNamespace(total_bytes=len(self.body)),
+            read=self.read,
+        )
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def read(self):
+        return self.body
+
+
+def threshold_body(error_code):
+    return main.serializer.dumps(
+        {"errorsExist": True, "errorList": {"error": [{"errorCode": error_code}]}}
+    )
+
+
+@pytest.fixture
+def alma(collection, monkeypatch):
+    # a RateLimiter whose requests Alma answers from the list the test gives it
+    monkeypatch.setattr(main, "api_budget", main.ApiBudget())
+    monkeypatch.setattr(main, "api_metrics", main.Metrics())
+    transport = main.HttpTransport()
+    answers = []
+
+    def get(*args, **kwargs):
+        return answers.pop(0)
+
+    transport.client = types.SimpleNamespace(get=get)
+    limiter = main.RateLimiter(transport)
+    limiter.RETRY_BASE_DELAY = 0.0
+    return limiter, answers
+
+
+def http_date(secs_from_now):
+    retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=secs_from_now
+    )
+    return email.utils.format_datetime(retry_at, usegmt=True)
+
+
+def test_parse_retry_after_seconds():
+    assert main.parse_retry_after("120") == 120.0
+    assert main.parse_retry_after("1.5") == 1.5
+    assert main.parse_retry_after("-3") == 0.0
+
+
+def test_parse_retry_after_http_date():
+    assert main.parse_retry_after(http_date(30)) == pytest.approx(30, abs=1.5)
+    assert main.parse_retry_after(http_date(-30)) == 0.0
+
+
+def test_parse_retry_after_missing_or_unreadable():
+    assert main.parse_retry_after(None) is None
+    assert main.parse_retry_after("soon") is None
+    assert main.parse_retry_after("") is None
+
+
+def test_retry_delay_backs_off_exponentially_up_to_the_cap(limiter, monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: high)
+
+    delays = [limiter.retry_delay(attempt, None) for attempt in range(1, 9)]
+
+    assert delays == [1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 60.0, 60.0]
+
+
+def test_retry_delay_is_jittered_from_zero(limiter, monkeypatch):
+    bounds = []
+
+    def uniform(low, high):
+        bounds.append((low, high))
+        return low
+
+    monkeypatch.setattr(main.random, "uniform", uniform)
+
+    assert limiter.retry_delay(3, None) == 0.0
+    assert bounds == [(0, 4.0)]
+
+
+def test_retry_delay_waits_at_least_the_retry_after(limiter, monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: low)
+
+    assert limiter.retry_delay(1, "20") == 20.0
+    assert limiter.retry_delay(1, http_date(45)) == pytest.approx(45, abs=1.5)
+    # a Retry-After longer than the cap is not waited out in full
+    assert limiter.retry_delay(1, "3600") == limiter.RETRY_MAX_DELAY
+    assert limiter.retry_delay(1, "soon") == 0.0
+
+
+def test_should_retry_by_status_and_attempt(limiter):
+    assert limiter.should_retry(429, 5)
+    assert not limiter.should_retry(429, 6)
+    assert limiter.should_retry(500, 2)
+    assert not limiter.should_retry(500, 3)
+    assert limiter.should_retry(None, 3)
+    assert not limiter.should_retry(None, 4)
+    assert not limiter.should_retry(200, 1)
+    assert not limiter.should_retry(404, 1)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        aiohttp.ClientOSError(104, "Connection reset by peer"),
+        aiohttp.ServerDisconnectedError(),
+        asyncio.TimeoutError(),
+    ],
+)
+def test_request_that_still_fails_is_recorded_not_raised(collection, error):
+    session = FailingSession(FailedRequest(error))
+
+    async def requests():
+        semaphore = asyncio.Semaphore(2)
+        retrieved = await main.get_port_api(semaphore, session, "1")
+        updated = await main.update_port(semaphore, session, {"id": "2"})
+        return retrieved, updated
+
+    assert asyncio.run(requests()) == (None, None)
+    assert len(collection.errors) == 2
+    failures = main.global_cache.get_failed_requests()
+    assert [(failure["id"], failure["operation"]) for failure in failures] == [
+        ("1", "get"),
+        ("2", "put"),
+    ]
+
+
+def test_response_cut_off_while_reading_is_recorded_not_raised(collection):
+    error = aiohttp.ClientPayloadError("Response payload is not completed")
+    session = FailingSession(FailedRequest(error, when_reading=True))
+
+    async def requests():
+        semaphore = asyncio.Semaphore(2)
+        portfolio = await main.get_port_api(semaphore, session, "1")
+        portfolio_list = await main.get_port_list_api(semaphore, session, 0)
+        return portfolio, portfolio_list
+
+    main.progress.start("Portfolio list", 1)
+    assert asyncio.run(requests()) == (None, None)
+    assert len(collection.errors) == 2
+    assert main.global_cache.get_failed_request("1")["status_code"] is None
+
+
+@pytest.mark.parametrize(
+    "answer",
+    [
+        AlmaAnswer(429, threshold_body("DAILY_THRESHOLD")),
+        AlmaAnswer(429, headers={main.API_REMAINING_HEADER: "0"}),
+    ],
+)
+def test_daily_threshold_stops_the_run_instead_of_retrying(collection, alma, answer):
+    limiter, answers = alma
+    answers.append(answer)
+
+    async def request():
+        return await main.get_port_api(asyncio.Semaphore(1), limiter, "1")
+
+    assert asyncio.run(request()) is None
+    assert not answers
+    assert limiter.retries == 0
+    assert main.api_budget.stats()["committed"] == 1
+    assert collection.update_log_data["api_limit_reached"]
+    assert main.global_cache.count_failed_requests() == 0
+    # the requests still waiting aren't sent either
+    assert not main.api_budget.reserve()
+
+
+def test_per_second_threshold_is_retried(collection, alma):
+    limiter, answers = alma
+    answers.append(
+        AlmaAnswer(
+            429,
+            threshold_body("PER_SECOND_THRESHOLD"),
+            {main.API_REMAINING_HEADER: "5000"},
+        )
+    )
+    answers.append(AlmaAnswer(200, main.serializer.dumps({"id": "1"})))
+
+    async def request():
+        return await main.get_port_api(asyncio.Semaphore(1), limiter, "1")
+
+    assert asyncio.run(request()) == {"id": "1"}
+    assert limiter.retries == 1
+    assert main.api_budget.stats()["committed"] == 2
+    assert not collection.update_log_data["api_limit_reached"]
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # a ShardStore whose bucket barely refills while the test runs
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "api_budget", main.ApiBudget())
+    store = main.ShardStore(main.SHARD_STORE)
+    store.create(0.001, 3, 100, None, [1])
+    yield store
+    store.close()
+
+
+def bucket_tokens(store):
+    return store.connection.execute("SELECT tokens FROM bucket").fetchone()[0]
+
+
+def test_tokens_are_taken_from_the_store_off_the_event_loop(store, monkeypatch):
+    limiter = main.SharedRateLimiter(main.HttpTransport(), store)
+    take_token = limiter.bucket.take_token
+    threads = []
+
+    def take_token_in(rate):
+        threads.append(threading.get_ident())
+        return take_token(rate)
+
+    monkeypatch.setattr(limiter.bucket, "take_token", take_token_in)
+
+    async def burst():
+        for _ in range(3):
+            await limiter.wait_for_token()
+
+    asyncio.run(burst())
+    limiter.close()
+
+    assert bucket_tokens(store) == pytest.approx(0, abs=0.01)
+    assert limiter.stats()["requests"] == 3
+    assert len(threads) == 3
+    assert threading.get_ident() not in threads
+
+
+def test_cancelled_waiter_hands_the_stores_token_back(store, monkeypatch):
+    limiter = main.SharedRateLimiter(main.HttpTransport(), store)
+    take_token = limiter.bucket.take_token
+    taking = threading.Event()
+    carry_on = threading.Event()
+
+    def slow_take_token(rate):
+        taking.set()
+        carry_on.wait()
+        return take_token(rate)
+
+    monkeypatch.setattr(limiter.bucket, "take_token", slow_take_token)
+
+    async def cancel():
+        waiter = asyncio.create_task(limiter.wait_for_token())
+        await asyncio.to_thread(taking.wait)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        carry_on.set()
+
+    asyncio.run(cancel())
+    limiter.close()
+
+    assert bucket_tokens(store) == pytest.approx(3, abs=0.01)
+    assert limiter.stats()["requests"] == 0
+
+
+def test_workers_split_the_concurrency_limit(monkeypatch):
+    monkeypatch.setattr(main, "shard_count", 4)
+    assert main.shard_share(main.AdaptiveConcurrency.MAX_LIMIT) == 15
+
+    monkeypatch.setattr(main, "shard_count", 100)
+    assert (
+        main.shard_share(main.AdaptiveConcurrency.MAX_LIMIT)
+        == main.AdaptiveConcurrency.MIN_LIMIT
+    )
+
+
+def test_no_workers_are_started_without_requests(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "shard_count", 4)
+
+    asyncio.run(main.sharded_requests(None, "get", []))
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_saving_the_cache_deletes_the_shard_files(store, monkeypatch):
+    store.close()
+    with open(main.shard_journal_path(0), "w"):
+        pass
+    monkeypatch.setattr(main, "global_cache", main.Cache(), raising=False)
+    monkeypatch.setattr(main, "cache_store", main.CacheStore("cache.db"), raising=False)
+    monkeypatch.setattr(main, "cache_journal", main.CacheJournal(), raising=False)
+    assert main.shard_store_paths()
+
+    main.save_cache()
+    main.cache_store.close()
+
+    assert main.shard_journal_paths() == []
+    assert main.shard_store_paths() == []
+    assert os.path.exists("cache.db")
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+COLLECTION_ID = "61000000000000000"
+
+
+@pytest.fixture
+def days(monkeypatch):
+    # run_until_finished with each day's run_mode retrieving the portfolios the test
+    # lists for it, stopped by the API limit while there are days left
+    run = main.CollectionRun("review", COLLECTION_ID, "62000000000000000", "", "")
+    token = main.current_run.set(run)
+    monkeypatch.setattr(main, "mode", "review")
+    monkeypatch.setattr(main, "collection_runs", [run], raising=False)
+    monkeypatch.setattr(main, "global_cache", main.Cache(), raising=False)
+    monkeypatch.setattr(main, "api_budget", main.ApiBudget())
+    monkeypatch.setattr(main, "save_cache", lambda: None)
+    retrieved_each_day = []
+    waits = []
+
+    async def run_mode(session):
+        ids = retrieved_each_day.pop(0)
+        main.global_cache.portfolios_retrieved.add(
+            COLLECTION_ID, [{"id": id} for id in ids]
+        )
+        main.collection_run().update_log_data["api_limit_reached"] = bool(
+            retrieved_each_day
+        )
+
+    async def wait_until_api_reset():
+        waits.append(len(retrieved_each_day))
+
+    monkeypatch.setattr(main, "run_mode", run_mode)
+    monkeypatch.setattr(main, "wait_until_api_reset", wait_until_api_reset)
+
+    def run_days(*days):
+        retrieved_each_day.extend(days)
+        asyncio.run(main.run_until_finished(None))
+        return retrieved_each_day, waits
+
+    yield run_days
+    main.current_run.reset(token)
+
+
+def test_each_day_carries_on_until_the_run_is_finished(days):
+    left, waits = days(["1", "2"], ["3"], ["4"])
+
+    assert left == []
+    assert waits == [2, 1]
+
+
+def test_a_day_after_the_reset_without_progress_stops_the_run(days, capsys):
+    left, waits = days(["1"], [], ["2"])
+
+    assert left == [["2"]]
+    assert waits == [2]
+    assert "error:" in capsys.readouterr().out
+
+
+def test_a_first_day_without_progress_still_waits_for_the_reset(days):
+    # the calls left on the first day may have run out before any portfolio came back
+    left, waits = days([], ["1"])
+
+    assert left == []
+    assert waits == [1]